@@ -25,7 +25,8 @@ from . import plu
 from . import stocktype
 from . import modifiers
 from . import user
-from .models import Barcode
+from .models import Barcode, StockLine, StockItem
+from sqlalchemy.orm import joinedload
 
 log = logging.getLogger(__name__)
 
@@ -33,7 +34,21 @@ log = logging.getLogger(__name__)
 class barcode:
     def __init__(self, code):
         self.code = code
-        self.binding = td.s.get(Barcode, code)
+        # Load everything the register needs to make a sale through
+        # this barcode in the same query as the barcode itself
+        self.binding = td.s.get(Barcode, code, options=[
+            joinedload(Barcode.stockline)
+            .joinedload(StockLine.stockonsale)
+            .undefer(StockItem.used)
+            .undefer(StockItem.remaining)
+            .undefer(StockItem.lastsale),
+            joinedload(Barcode.stockline)
+            .joinedload(StockLine.stockonsale)
+            .joinedload(StockItem.stocktype),
+            joinedload(Barcode.stockline)
+            .joinedload(StockLine.stocktype),
+            joinedload(Barcode.plu),
+            joinedload(Barcode.stocktype)])
 
     def feedback(self, valid: bool) -> None:
         """Feedback to scanner user
@@ -1,6 +1,7 @@
 from .models import Config, penny
 from . import td
 from . import cmdline
+from sqlalchemy import select
 from decimal import Decimal
 import datetime
 import sys
@@ -31,6 +32,14 @@ class ConfigItem:
     _listener = None
     none_supported = False
 
+    # Once preload() has been called, this is a process-wide snapshot
+    # of the config table: a dict of key to value as stored in the
+    # database.  Config items read their values from it without
+    # querying the database.  version is incremented each time the
+    # snapshot changes.
+    _snapshot = None
+    version = 0
+
     def __init__(self, key, default, type="text",
                  display_name=None, description=None, allow_none=False):
         # NB 'default' may be changed after init simply by setting the
@@ -76,6 +85,29 @@ class ConfigItem:
 
     @classmethod
     def _config_changed(cls, configitem):
+        if cls._snapshot is not None:
+            with td.orm_session():
+                value = td.s.execute(
+                    select(Config.value).where(Config.key == configitem)
+                ).scalar()
+            cls._update_snapshot(configitem, value)
+        cls._item_changed(configitem)
+
+    @classmethod
+    def _update_snapshot(cls, key, value):
+        """Update one key in the snapshot
+
+        value is None if the key no longer exists in the database.
+        """
+        if value is None:
+            cls._snapshot.pop(key, None)
+        else:
+            cls._snapshot[key] = value
+        # Always on ConfigItem, even if called through a subclass
+        ConfigItem.version += 1
+
+    @classmethod
+    def _item_changed(cls, configitem):
         ci = cls._keys.get(configitem)
         if ci:
             log.debug("config changed: %s, clearing cache", configitem)
@@ -93,11 +125,25 @@ class ConfigItem:
 
     @classmethod
     def preload(cls):
-        td.s.query(Config).all()
+        """Load all the config from the database in one query
+
+        Replaces the snapshot, and adds any config items that are
+        missing from the database.
+        """
+        ConfigItem._snapshot = {
+            c.key: c.value for c in td.s.query(Config).all()}
+        ConfigItem.version += 1
         for ci in cls._keys.values():
-            ci._read()
+            ci._read_db()
 
     def _read(self):
+        if self._snapshot is not None and self.key in self._snapshot:
+            self._value = self.from_db(self._snapshot[self.key])
+            self._current = True
+        else:
+            self._read_db()
+
+    def _read_db(self):
         d = td.s.get(Config, self.key)
         if d is None:
             # The config option doesn't exist in the database. Initialise it
@@ -108,6 +154,8 @@ class ConfigItem:
                             display_name=self.display_name,
                             description=self.description))
             self._value = self.default
+            if self._snapshot is not None:
+                self._update_snapshot(self.key, self.to_db(self.default))
         else:
             self._value = self.from_db(d.value)
             if d.type != self.type:
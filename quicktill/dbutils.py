@@ -2,13 +2,17 @@
 """
 
 import os
+import sys
 import argparse
+import csv
+import json
+import datetime
 import tomllib
 from . import cmdline
 from . import td
 from . import models
 from . import tillconfig
-from .models import Session, PayType, Business, zero
+from .models import Session, PayType, Business, StockValuation, zero
 from sqlalchemy import Date, or_
 from sqlalchemy.sql.expression import func, cast
 from sqlalchemy.orm import joinedload, undefer
@@ -253,6 +257,11 @@ class checkdb(cmdline.command):
     create a temporary database and will fail if the current user does
     not have permission to do so.
 
+    It also checks that the running totals of stock used from each
+    stock item and the daily sales of each stock type match the
+    stockout table, and outputs commands to recalculate any that
+    don't.
+
     """
     help = "check database schema"
     database_required = False
@@ -277,6 +286,11 @@ class checkdb(cmdline.command):
             dest="metafilter", default=True,
             help="filter out meta-commands from pg_dump by converting them "
             "to comments")
+        parser.add_argument(
+            "--stock-totals", action=argparse.BooleanOptionalAction,
+            dest="stocktotals", default=True,
+            help="check the stock totals and daily sales tables against "
+            "the stockout table")
 
     @staticmethod
     def connection_options(u):
@@ -295,6 +309,50 @@ class checkdb(cmdline.command):
     def commentmeta(b):
         return b.replace(b"\n\\", b"\n-- \\")
 
+    @staticmethod
+    def check_stock_totals():
+        from sqlalchemy import inspect
+        td.init(tillconfig.database)
+        if not inspect(td.engine).has_table(models.StockTotals.__tablename__):
+            # The schema diff will already have told the user to
+            # create it
+            return
+        with td.orm_session():
+            bad = models.StockTotals.discrepancies(td.s)
+        if bad:
+            print(f"-- Stock totals are incorrect for {len(bad)} stock "
+                  f"item{'s' if len(bad) != 1 else ''}")
+            print("BEGIN;")
+            for stockid in bad:
+                print(f"SELECT stock_totals_recalculate({stockid});")
+            print("COMMIT;")
+        if not inspect(td.engine).has_table(
+                models.StockTypeSales.__tablename__):
+            return
+        with td.orm_session():
+            bad = models.StockTypeSales.discrepancies(td.s)
+        if bad:
+            print(f"-- {len(bad)} daily stock type sales "
+                  f"total{'s are' if len(bad) != 1 else ' is'} incorrect")
+            print("BEGIN;")
+            for stocktype, date in bad:
+                print(f"SELECT stocktype_sales_recalculate("
+                      f"{stocktype}, '{date}');")
+            print("COMMIT;")
+        if not inspect(td.engine).has_table(
+                models.StockValuationItem.__tablename__):
+            return
+        with td.orm_session():
+            bad = models.StockValuation.discrepancies(td.s)
+        if bad:
+            print(f"-- {len(bad)} stock valuation"
+                  f"{'s are' if len(bad) != 1 else ' is'} incorrect; "
+                  f"use \"runtill stockvalue\" to replace them if needed")
+            print("BEGIN;")
+            for valuation in bad:
+                print(f"DELETE FROM stock_valuations WHERE id={valuation};")
+            print("COMMIT;")
+
     @staticmethod
     def run(args):
         import sqlalchemy.engine.url
@@ -365,11 +423,16 @@ class checkdb(cmdline.command):
             else:
                 os.unlink(current.name)
                 os.unlink(pristine.name)
+        if args.stocktotals:
+            checkdb.check_stock_totals()
 
 
 class totals(cmdline.command):
     """Display a table of session totals.
 
+    With --format csv or --format json the totals are written in a
+    form suitable for other programs to read: one row or object per
+    session, with amounts for every payment type and business.
     """
     help = "display table of session totals"
 
@@ -377,6 +440,9 @@ class totals(cmdline.command):
     def add_arguments(parser):
         parser.add_argument("-d", "--days", type=int, dest="days",
                             help="number of days to display", default=40)
+        parser.add_argument("-f", "--format", dest="format",
+                            choices=["table", "csv", "json"],
+                            default="table", help="output format")
 
     @staticmethod
     def run(args):
@@ -390,49 +456,124 @@ class totals(cmdline.command):
                     .options(undefer(Session.total))\
                     .order_by(Session.id)\
                     .all()
+            # Sessions with no total recorded will report actual_total
+            # of None
+            sessions = [s for s in sessions if s.actual_total is not None]
             businesses = td.s.query(Business).order_by(Business.id).all()
             paytypes = td.s.query(PayType)\
                            .order_by(PayType.order, PayType.paytype)\
                            .filter(PayType.paytype.in_({
-                               st.paytype.paytype
+                               st.paytype_id
                                for s in sessions
                                for st in s.actual_totals}))\
                            .all()
-            f = "{s.id:>5} | {s.date} | "
-            h = "  ID  |    Date    | "
-            ptl = max([len(pt.description) for pt in paytypes] + [8])
-            for x in paytypes:
-                f = f + "{p[%s]:>%d} | " % (x.paytype, ptl)
-                h = h + ("{x.description:^%s} | " % ptl).format(x=x)
-            f = f + "{error:>7} | "
-            h = h + " Error  | "
-            for b in businesses:
-                if b.show_vat_breakdown:
-                    f = f + "{b[%s][1]:>10} | {b[%s][2]:>8} | " % (b.id, b.id)
-                    h = h + "{:^10} | {:^8} | ".format(
-                        b.abbrev + " ex-VAT", b.abbrev + " VAT")
-                else:
-                    f = f + "{b[%s][0]:>8} | " % b.id
-                    h = h + "{:^8} | ".format(b.abbrev)
-            f = f[:-2]
-            h = h[:-2]
-            print(h)
+            vatband_totals = Session.vatband_totals_for(td.s, sessions)
+            rows = []
             for s in sessions:
-                # Sessions with no total recorded will report actual_total
-                # of None
-                if s.actual_total is None:
-                    continue
-                vbt = s.vatband_totals
-                p = {}
-                for x in paytypes:
-                    p[x.paytype] = ""
+                p = {x.paytype: None for x in paytypes}
                 for t in s.actual_totals:
                     p[t.paytype_id] = t.amount
-                b = {}
-                for x in businesses:
-                    b[x.id] = (zero, zero, zero)
-                for x in vbt:
-                    o = b[x[0].businessid]
-                    o = (o[0] + x[1], o[1] + x[2], o[2] + x[3])
-                    b[x[0].businessid] = o
-                print(f.format(s=s, p=p, error=s.actual_total - s.total, b=b))
+                b = {x.id: (zero, zero, zero) for x in businesses}
+                for vr, amount, exvat, vat in vatband_totals[s.id]:
+                    o = b[vr.businessid]
+                    b[vr.businessid] = (o[0] + amount, o[1] + exvat,
+                                        o[2] + vat)
+                rows.append((s, p, s.actual_total - s.total, b))
+            if args.format == "csv":
+                totals._write_csv(rows, paytypes, businesses)
+            elif args.format == "json":
+                totals._write_json(rows, businesses)
+            else:
+                totals._write_table(rows, paytypes, businesses)
+
+    @staticmethod
+    def _write_table(rows, paytypes, businesses):
+        f = "{s.id:>5} | {s.date} | "
+        h = "  ID  |    Date    | "
+        ptl = max([len(pt.description) for pt in paytypes] + [8])
+        for x in paytypes:
+            f = f + "{p[%s]:>%d} | " % (x.paytype, ptl)
+            h = h + ("{x.description:^%s} | " % ptl).format(x=x)
+        f = f + "{error:>7} | "
+        h = h + " Error  | "
+        for b in businesses:
+            if b.show_vat_breakdown:
+                f = f + "{b[%s][1]:>10} | {b[%s][2]:>8} | " % (b.id, b.id)
+                h = h + "{:^10} | {:^8} | ".format(
+                    b.abbrev + " ex-VAT", b.abbrev + " VAT")
+            else:
+                f = f + "{b[%s][0]:>8} | " % b.id
+                h = h + "{:^8} | ".format(b.abbrev)
+        f = f[:-2]
+        h = h[:-2]
+        print(h)
+        for s, p, error, b in rows:
+            p = {k: "" if v is None else v for k, v in p.items()}
+            print(f.format(s=s, p=p, error=error, b=b))
+
+    @staticmethod
+    def _write_csv(rows, paytypes, businesses):
+        w = csv.writer(sys.stdout)
+        header = ["id", "date"] + [x.paytype for x in paytypes] + ["error"]
+        for b in businesses:
+            header += [f"{b.abbrev} total", f"{b.abbrev} ex-VAT",
+                       f"{b.abbrev} VAT"]
+        w.writerow(header)
+        for s, p, error, b in rows:
+            w.writerow([s.id, s.date.isoformat()]
+                       + [p[x.paytype] for x in paytypes]
+                       + [error]
+                       + [t for x in businesses for t in b[x.id]])
+
+    @staticmethod
+    def _write_json(rows, businesses):
+        json.dump([{
+            "id": s.id,
+            "date": s.date.isoformat(),
+            "payments": {k: str(v) for k, v in p.items() if v is not None},
+            "error": str(error),
+            "businesses": {
+                x.abbrev: {
+                    "total": str(b[x.id][0]),
+                    "ex_vat": str(b[x.id][1]),
+                    "vat": str(b[x.id][2]),
+                } for x in businesses},
+        } for s, p, error, b in rows], sys.stdout, indent=2)
+        print()
+
+
+class stockvalue(cmdline.command):
+    """Record the value of the stock on the premises.
+
+    A valuation is also recorded automatically when each session
+    ends, unless this is turned off in the till configuration.
+    Valuations are used by the stock value report in the web
+    interface; a valuation recorded at a particular time, for example
+    the end of a month, makes reports for times shortly afterwards
+    quicker.
+    """
+    help = "record a valuation of the stock"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "-t", "--time", type=datetime.datetime.fromisoformat,
+            dest="time", help="time of valuation (default now), for "
+            "example 2024-01-31T23:59")
+        parser.add_argument(
+            "-n", "--dry-run", action="store_true", dest="dryrun",
+            help="show the valuation but don't record it")
+
+    @staticmethod
+    def run(args):
+        time = args.time or datetime.datetime.now()
+        with td.orm_session():
+            if args.dryrun:
+                depts = StockValuation.department_values(td.s, time)
+            else:
+                v = StockValuation.take(td.s, time)
+                depts = [(d.department, d.value) for d in v.departments]
+                td.s.commit()
+        for dept, value in depts:
+            print(f"{dept.description:<30} {value:>12}")
+        print(f"{'Total':<30} {sum((v for _, v in depts), start=zero):>12}")
@@ -1,40 +1,284 @@
 import selectors
+import heapq
+import bisect
+import itertools
 import time
+import datetime
+import os
+import threading
+import queue
+import collections
+import concurrent.futures
 import logging
 
 log = logging.getLogger(__name__)
 
 
+class Histogram:
+    """Distribution of a set of durations, in seconds
+    """
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+               1.0, 2.0, 5.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @classmethod
+    def header(cls):
+        return "".join(f"{_fmt_duration(b, '<'):>7}" for b in cls.buckets) \
+            + f"{_fmt_duration(cls.buckets[-1], '>'):>7}"
+
+    def __str__(self):
+        mean = self.total / self.count if self.count else 0.0
+        return f"{self.count:>8} {self.total:>9.3f} {mean * 1000:>8.2f} " \
+            f"{self.max * 1000:>9.2f}" \
+            + "".join(f"{c:>7}" for c in self.counts)
+
+
+def _fmt_duration(seconds, prefix):
+    if seconds < 1.0:
+        return f"{prefix}{seconds * 1000:g}ms"
+    return f"{prefix}{seconds:g}s"
+
+
+class LoopStats:
+    """Event loop latency statistics
+
+    Records how long each callback takes, keyed by the kind of
+    callback and the description passed to add_fd(), add_timeout()
+    or run_in_worker(); how late timeouts are called compared to when
+    they were due ("loop lag"); and how long fds stay ready for.  The
+    fd ready time is the time from when an fd is first reported ready
+    to the first iteration where it is no longer ready, so an fd whose
+    callback does not consume all its input shows up here.  Only
+    SelectorsMainLoop records fd ready times.
+
+    Statistics are collected while the module-level "stats" variable
+    is set to an instance of this class.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = datetime.datetime.now()
+        self.callbacks = {}
+        self.lag = Histogram()
+        self.fd_ready = {}
+
+    def callback(self, kind, desc, duration):
+        key = (kind, desc or "(no description)")
+        h = self.callbacks.get(key)
+        if not h:
+            h = self.callbacks[key] = Histogram()
+        h.add(duration)
+
+    def timeout_lag(self, lag):
+        self.lag.add(lag)
+
+    def fd_ready_time(self, desc, duration):
+        desc = desc or "(no description)"
+        h = self.fd_ready.get(desc)
+        if not h:
+            h = self.fd_ready[desc] = Histogram()
+        h.add(duration)
+
+    def report(self):
+        """Return the statistics collected so far as text
+        """
+        now = datetime.datetime.now()
+        columns = f"{'count':>8} {'total s':>9} {'mean ms':>8} " \
+            f"{'max ms':>9}" + Histogram.header()
+        lines = [
+            f"Event loop statistics from {self.started:%Y-%m-%d %H:%M:%S} "
+            f"to {now:%Y-%m-%d %H:%M:%S}",
+            "",
+            "Callback durations, slowest total first:",
+            f"{'':<50}{columns}",
+        ]
+        for (kind, desc), h in sorted(
+                list(self.callbacks.items()), key=lambda x: -x[1].total):
+            lines.append(f"{kind + ' ' + desc:<50.50}{h}")
+        lines += [
+            "",
+            "Loop lag (lateness of timeouts):",
+            f"{'':<50}{columns}",
+            f"{'all timeouts':<50}{self.lag}",
+            "",
+            "Time fds stayed ready:",
+            f"{'':<50}{columns}",
+        ]
+        for desc, h in sorted(
+                list(self.fd_ready.items()), key=lambda x: -x[1].total):
+            lines.append(f"{desc:<50.50}{h}")
+        return "\n".join(lines) + "\n"
+
+
+# Set to an instance of LoopStats to collect event loop statistics
+stats = None
+
+
 class time_guard:
+    """Time callbacks from the event loop
+
+    Use as "with guard(description):" around a callback.  Callbacks
+    that take longer than max_time are logged, and if statistics are
+    being collected the time taken is recorded.
+    """
     def __init__(self, name, max_time):
         self._name = name
         self._max_time = max_time
 
+    def __call__(self, desc):
+        return _timed_callback(self, desc)
+
+
+class _timed_callback:
+    __slots__ = ("_guard", "_desc", "_start_time")
+
+    def __init__(self, guard, desc):
+        self._guard = guard
+        self._desc = desc
+
     def __enter__(self):
-        self._start_time = time.time()
+        self._start_time = time.monotonic()
 
     def __exit__(self, type, value, traceback):
-        t = time.time()
-        time_taken = t - self._start_time
-        if time_taken > self._max_time:
-            log.info("time_guard: %s took %f seconds", self._name, time_taken)
+        time_taken = time.monotonic() - self._start_time
+        guard = self._guard
+        if time_taken > guard._max_time:
+            log.info("time_guard: %s %s took %f seconds",
+                     guard._name, self._desc, time_taken)
+        if stats:
+            stats.callback(guard._name, self._desc, time_taken)
 
 
 doread_time_guard = time_guard("doread", 0.5)
 dowrite_time_guard = time_guard("dowrite", 0.5)
 timeout_time_guard = time_guard("timeout", 0.5)
+worker_done_time_guard = time_guard("worker done", 0.5)
+
+
+class WorkerPool:
+    """Run blocking functions in worker threads
+
+    Used by main loop implementations to provide run_in_worker().
+    Functions are run in a small pool of daemon threads, so a worker
+    that is stuck waiting on the network will not prevent the till
+    from exiting.  When a function finishes, a byte is written to a
+    pipe that is watched by the main loop; the completion callback is
+    then called from the main loop.
+    """
+    def __init__(self, mainloop, max_workers=4):
+        self._max_workers = max_workers
+        self._threads = []
+        self._idle = 0
+        self._lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        self._done = collections.deque()
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+        self._watch = mainloop.add_fd(self._rfd, self._doread,
+                                      desc="worker thread completion")
+
+    def submit(self, func, on_done, desc):
+        future = concurrent.futures.Future()
+        self._queue.put((future, func, on_done, desc))
+        with self._lock:
+            if self._idle == 0 and len(self._threads) < self._max_workers:
+                t = threading.Thread(
+                    target=self._worker, daemon=True,
+                    name=f"quicktill-worker-{len(self._threads)}")
+                self._threads.append(t)
+                self._idle += 1
+                t.start()
+        return future
+
+    def _worker(self):
+        while True:
+            future, func, on_done, desc = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            start_time = time.monotonic()
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = func()
+                except BaseException as e:
+                    log.debug("worker: %s raised %s", desc, e)
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            self._done.append((future, on_done, desc,
+                               time.monotonic() - start_time))
+            del future, func, on_done
+            with self._lock:
+                self._idle += 1
+            self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wfd, b"\0")
+        except BlockingIOError:
+            # The pipe is full, so the main loop has plenty of
+            # wakeups pending already
+            pass
+
+    def _doread(self):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._done:
+            future, on_done, desc, time_taken = self._done.popleft()
+            if stats:
+                # Recorded here rather than in the worker thread so
+                # that only the main thread updates the statistics
+                stats.callback("worker", desc, time_taken)
+            if on_done and not future.cancelled():
+                try:
+                    with worker_done_time_guard(desc):
+                        on_done(future)
+                except Exception:
+                    # Make sure we come back for the rest
+                    if self._done:
+                        self._wakeup()
+                    raise
 
 
 class SelectorsMainLoop:
     """Event loop based on selectors module
 
     selectors was introduced in python 3.4
+
+    Timeouts are kept in a heap ordered by the time they are due,
+    measured using the monotonic clock so that changes to the system
+    time do not cause them to fire early or late.  Cancelled timeouts
+    are left in the heap and discarded when they reach the top; if
+    they come to make up more than half the heap it is rebuilt
+    without them.
     """
     def __init__(self):
         self._sel = selectors.DefaultSelector()
         self.exit_code = None
-        # Future events: key is wrapper object, value is time
-        self._timeouts = {}
+        # Future events: heap of (time, sequence number, wrapper object)
+        self._timeouts = []
+        self._cancelled_timeouts = 0
+        self._timeout_seq = itertools.count()
+        self._workers = None
+        # Used when collecting statistics: key is fd, value is
+        # (time first seen ready, description)
+        self._fd_ready_since = {}
 
     def shutdown(self, code):
         self.exit_code = code
@@ -58,10 +302,10 @@ class SelectorsMainLoop:
 
         def _ready(self, mask):
             if self._doread and (mask & selectors.EVENT_READ):
-                with doread_time_guard:
+                with doread_time_guard(self.description):
                     self._doread()
             if self._dowrite and (mask & selectors.EVENT_WRITE):
-                with dowrite_time_guard:
+                with dowrite_time_guard(self.description):
                     self._dowrite()
 
     def add_fd(self, fd, read=None, write=None, desc=None):
@@ -79,35 +323,102 @@ class SelectorsMainLoop:
             self._mainloop = mainloop
             self._func = func
             self.description = desc
+            self._queued = True
 
         def cancel(self):
-            del self._mainloop._timeouts[self], self._func
+            # The entry stays in the heap until it reaches the top or
+            # the heap is compacted.  Cancelling a timeout that has
+            # already been called or cancelled does nothing.
+            if self._func is None:
+                return
+            self._func = None
+            if self._queued:
+                self._mainloop._timeout_cancelled()
 
     def add_timeout(self, timeout, func, desc=None):
         """Add a callback for an amount of time in the future
 
         Returns an object that can be used to cancel the callback.
         """
-        now = time.time()
-        call_at = now + timeout
+        call_at = time.monotonic() + timeout
         wrapper = self._selectors_timeout(self, func, desc)
-        self._timeouts[wrapper] = call_at
+        heapq.heappush(self._timeouts,
+                       (call_at, next(self._timeout_seq), wrapper))
         return wrapper
 
+    def run_in_worker(self, func, on_done=None, desc=None):
+        """Call a function in a worker thread
+
+        func is called with no arguments in a worker thread.  It must
+        not touch the user interface; if it needs the database it
+        must start its own ORM session.
+
+        When func has finished, on_done (if supplied) is called from
+        the main loop with a concurrent.futures.Future as its only
+        argument: call its result() method to obtain the value
+        returned by func, or to re-raise the exception it raised.
+
+        Returns the Future.  Cancelling it before func has started
+        prevents func and on_done from being called.
+        """
+        if not self._workers:
+            self._workers = WorkerPool(self)
+        return self._workers.submit(func, on_done, desc)
+
+    def _timeout_cancelled(self):
+        self._cancelled_timeouts += 1
+        if self._cancelled_timeouts > len(self._timeouts) // 2:
+            self._timeouts = [
+                entry for entry in self._timeouts
+                if entry[2]._func is not None]
+            heapq.heapify(self._timeouts)
+            self._cancelled_timeouts = 0
+
+    def _discard_cancelled_timeouts(self):
+        while self._timeouts and self._timeouts[0][2]._func is None:
+            heapq.heappop(self._timeouts)
+            self._cancelled_timeouts -= 1
+
     def iterate(self):
         # Work out what the earliest timeout is
+        self._discard_cancelled_timeouts()
         timeout = None
         if self._timeouts:
-            t = time.time()
-            earliest = min(self._timeouts.values())
-            timeout = earliest - t
-        for key, mask in self._sel.select(timeout):
+            timeout = max(self._timeouts[0][0] - time.monotonic(), 0)
+        ready = self._sel.select(timeout)
+        if stats:
+            self._record_fd_ready(ready)
+        for key, mask in ready:
             key.data(mask)
-        # Process any events whose time has come
-        t = time.time()
-        todo = [wrapper for wrapper, call_at in self._timeouts.items()
-                if call_at <= t]
-        for i in todo:
-            with timeout_time_guard:
-                del self._timeouts[i]
-                i._func()
+        # Process any events whose time has come.  Timeouts added by
+        # these callbacks are not considered until the next iteration.
+        t = time.monotonic()
+        todo = []
+        while self._timeouts and self._timeouts[0][0] <= t:
+            call_at, _, wrapper = heapq.heappop(self._timeouts)
+            wrapper._queued = False
+            if wrapper._func is None:
+                self._cancelled_timeouts -= 1
+            else:
+                todo.append((call_at, wrapper))
+        for call_at, i in todo:
+            # A callback earlier in this list may have cancelled this one
+            func, i._func = i._func, None
+            if func is not None:
+                if stats:
+                    stats.timeout_lag(time.monotonic() - call_at)
+                with timeout_time_guard(i.description):
+                    func()
+
+    def _record_fd_ready(self, ready):
+        now = time.monotonic()
+        fds = set()
+        for key, mask in ready:
+            fds.add(key.fd)
+            if key.fd not in self._fd_ready_since:
+                self._fd_ready_since[key.fd] = (
+                    now, key.data.__self__.description)
+        for fd in list(self._fd_ready_since.keys()):
+            if fd not in fds:
+                since, desc = self._fd_ready_since.pop(fd)
+                stats.fd_ready_time(desc, now - since)
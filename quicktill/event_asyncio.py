@@ -0,0 +1,186 @@
+import asyncio
+import sys
+import types
+import logging
+from . import event
+from .event import WorkerPool
+log = logging.getLogger(__name__)
+
+
+@types.coroutine
+def _wake_after_each_step(coro, wake):
+    """Run a coroutine, calling wake() each time it yields or finishes
+
+    This is equivalent to "yield from coro.__await__()" except for the
+    calls to wake().  It lets the main loop return from iterate() after
+    each step of the coroutine, so that any changes it makes to the
+    display are drawn promptly.
+    """
+    it = coro.__await__()
+    send, value = it.send, None
+    while True:
+        try:
+            yielded = send(value)
+        except StopIteration as e:
+            wake()
+            return e.value
+        wake()
+        try:
+            value = yield yielded
+            send = it.send
+        except GeneratorExit:
+            it.close()
+            raise
+        except BaseException as e:
+            send, value = it.throw, e
+
+
+class AsyncioMainLoop:
+    """Event loop based on asyncio
+
+    Provides the same interface as the other main loops, so it can be
+    used to run the whole till.  In addition, coroutines can be run
+    on the loop using create_task(), and can await blocking functions
+    run in worker threads using run_blocking().  This makes it
+    possible to write integrations that talk to the network as
+    coroutines rather than as chains of timeout callbacks.
+
+    Each call to iterate() runs the asyncio event loop until at least
+    one fd callback, timeout, worker completion or step of a task
+    started by create_task() has been processed.
+    """
+    def __init__(self):
+        self.exit_code = None
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._wakeup = asyncio.Event()
+        self._exc_info = None
+        self._workers = None
+
+    def shutdown(self, code):
+        self.exit_code = code
+        self._wake()
+
+    def _wake(self):
+        self._wakeup.set()
+
+    def _call(self, guard, desc, func):
+        try:
+            with guard(desc):
+                func()
+        except Exception:
+            self._save_exception(sys.exc_info())
+        self._wake()
+
+    def _save_exception(self, exc_info):
+        # Only one exception can be raised from each call to
+        # iterate(); any others raised in the same iteration are
+        # logged rather than lost
+        if self._exc_info:
+            log.error("Further exception in main loop callback",
+                      exc_info=exc_info)
+        else:
+            self._exc_info = exc_info
+
+    def iterate(self):
+        self._loop.run_until_complete(self._wakeup.wait())
+        self._wakeup.clear()
+        if self._exc_info:
+            exc_info = self._exc_info
+            self._exc_info = None
+            raise exc_info[1].with_traceback(exc_info[2])
+
+    class _asyncio_fd_watch:
+        def __init__(self, mainloop, fd, read, write, desc):
+            self._mainloop = mainloop
+            self._fd = fd
+            self._read = read
+            self._write = write
+            self.description = desc
+            loop = mainloop._loop
+            if read:
+                loop.add_reader(fd, mainloop._call,
+                                event.doread_time_guard, desc, read)
+            if write:
+                loop.add_writer(fd, mainloop._call,
+                                event.dowrite_time_guard, desc, write)
+
+        def remove(self):
+            loop = self._mainloop._loop
+            if self._read:
+                loop.remove_reader(self._fd)
+            if self._write:
+                loop.remove_writer(self._fd)
+            del self._read, self._write
+
+    def add_fd(self, fd, read=None, write=None, desc=None):
+        """Start watching a fd
+
+        Call read or write as appropriate when the fd is ready
+
+        Returns an object with a "remove" method that can be used to
+        cancel the watch.
+        """
+        return self._asyncio_fd_watch(self, fd, read, write, desc)
+
+    class _asyncio_timeout:
+        def __init__(self, mainloop, timeout, func, desc):
+            self.description = desc
+            self._mainloop = mainloop
+            self._func = func
+            self._handle = mainloop._loop.call_later(timeout, self._call)
+
+        def _call(self):
+            if event.stats:
+                event.stats.timeout_lag(
+                    self._mainloop._loop.time() - self._handle.when())
+            self._mainloop._call(
+                event.timeout_time_guard, self.description, self._func)
+
+        def cancel(self):
+            self._handle.cancel()
+
+    def add_timeout(self, timeout, func, desc=None):
+        """Add a callback for an amount of time in the future
+
+        Returns an object that can be used to cancel the callback.
+        """
+        return self._asyncio_timeout(self, timeout, func, desc)
+
+    def run_in_worker(self, func, on_done=None, desc=None):
+        """Call a function in a worker thread
+
+        See SelectorsMainLoop.run_in_worker()
+        """
+        if not self._workers:
+            self._workers = WorkerPool(self)
+        return self._workers.submit(func, on_done, desc)
+
+    async def run_blocking(self, func, desc=None):
+        """Call a function in a worker thread and await its result
+
+        func must not touch the user interface; if it needs the
+        database it must start its own ORM session.
+        """
+        return await asyncio.wrap_future(
+            self.run_in_worker(func, desc=desc), loop=self._loop)
+
+    def create_task(self, coro, desc=None):
+        """Run a coroutine on the main loop
+
+        The coroutine is run as an asyncio Task, which is returned.
+        An exception raised by the coroutine is raised from iterate(),
+        in the same way as exceptions raised by fd and timeout
+        callbacks.  Cancelling the task is not treated as an error.
+        """
+        async def run():
+            return await _wake_after_each_step(coro, self._wake)
+        task = self._loop.create_task(run(), name=desc)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        if not task.cancelled() and task.exception():
+            e = task.exception()
+            self._save_exception((type(e), e, e.__traceback__))
+        self._wake()
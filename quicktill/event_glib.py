@@ -1,4 +1,7 @@
 import sys
+import time
+from . import event
+from .event import WorkerPool
 
 try:
     import gi
@@ -12,6 +15,7 @@ class GLibMainLoop:
     def __init__(self):
         self.exit_code = None
         self._context = GLib.main_context_default()
+        self._workers = None
 
     def shutdown(self, code):
         self.exit_code = code
@@ -41,9 +45,11 @@ class GLibMainLoop:
             try:
                 if (condition & GLib.IOCondition.IN)\
                    or (condition & GLib.IOCondition.HUP):
-                    self._doread()
+                    with event.doread_time_guard(self.description):
+                        self._doread()
                 if condition & GLib.IOCondition.OUT:
-                    self._dowrite()
+                    with event.dowrite_time_guard(self.description):
+                        self._dowrite()
             except Exception:
                 self._mainloop._exc_info = sys.exc_info()
             return True
@@ -60,12 +66,16 @@ class GLibMainLoop:
             self._mainloop = mainloop
             self._func = func
             self.description = desc
+            self._call_at = time.monotonic() + timeout
             self._source = GLib.timeout_add(
                 int(timeout * 1000), self._call)
 
         def _call(self, *args):
             try:
-                self._func()
+                if event.stats:
+                    event.stats.timeout_lag(time.monotonic() - self._call_at)
+                with event.timeout_time_guard(self.description):
+                    self._func()
             except Exception:
                 self._mainloop._exc_info = sys.exc_info()
             return False
@@ -77,6 +87,11 @@ class GLibMainLoop:
     def add_timeout(self, timeout, func, desc=None):
         return self._glib_timeout(self, timeout, func, desc)
 
+    def run_in_worker(self, func, on_done=None, desc=None):
+        if not self._workers:
+            self._workers = WorkerPool(self)
+        return self._workers.submit(func, on_done, desc)
+
 
 if GLib is None:
     GLibMainLoop = None  # noqa: F811
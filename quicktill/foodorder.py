@@ -1,12 +1,11 @@
 import urllib
 from types import ModuleType
-import sys
-import traceback
 import datetime
 import hashlib
 import logging
 from . import ui, keyboard, td, tillconfig, user
 from . import lockscreen
+from . import spooler
 from . import register
 from .models import zero, penny
 from decimal import Decimal
@@ -470,29 +469,32 @@ class popup(user.permission_checked, ui.basicpopup):
         self.dismiss()
         if r == True:
             user = ui.current_user()
+            ml = list(self.ml)
             with ui.exception_guard("printing the customer copy"):
-                print_food_order(tillconfig.receipt_printer, number, self.ml,
-                                 verbose=True, tablenumber=tablenumber,
-                                 footer=self.footer, transid=self.transid,
-                                 print_total=self.print_total)
-            try:
-                for kp in self.kitchenprinters:
-                    print_food_order(
-                        kp, number, self.ml,
-                        verbose=False, tablenumber=tablenumber,
-                        footer=self.footer, transid=self.transid,
-                        user=user.shortname if user else None)
-            except Exception:
-                e = traceback.format_exception_only(
-                    sys.exc_info()[0], sys.exc_info()[1])
-                try:
-                    print_food_order(
-                        tillconfig.receipt_printer, number, self.ml,
-                        verbose=False, tablenumber=tablenumber,
-                        footer=self.footer, transid=self.transid,
-                        user=user.shortname if user else None)
-                except Exception:
-                    pass
+                print_food_order(
+                    spooler.spooled_printer(
+                        tillconfig.receipt_printer,
+                        "printing the customer copy"),
+                    number, ml, verbose=True, tablenumber=tablenumber,
+                    footer=self.footer, transid=self.transid,
+                    print_total=self.print_total)
+
+            printed_here = False
+
+            def print_here(job):
+                # Print one copy here for the order, however many of
+                # the printers fail
+                nonlocal printed_here
+                if printed_here:
+                    return
+                printed_here = True
+                print_food_order(
+                    spooler.spooled_printer(
+                        tillconfig.receipt_printer,
+                        "printing the kitchen copy here"),
+                    number, ml, verbose=False, tablenumber=tablenumber,
+                    footer=self.footer, transid=self.transid,
+                    user=user.shortname if user else None)
                 ui.infopopup(
                     ["There was a problem sending the order to the "
                      "printer in the kitchen, so the kitchen copy has been "
@@ -500,8 +502,18 @@ class popup(user.permission_checked, ui.basicpopup):
                      "so that they can make it.  Check that the printer "
                      "in the kitchen has paper, is turned on, and is plugged "
                      "in to the network.", "", "The error message from the "
-                     "printer is:"] + e, title="Kitchen printer error")
-                return
+                     "printer is:", job.last_error],
+                    title="Kitchen printer error")
+
+            with ui.exception_guard("printing the order in the kitchen"):
+                for kp in self.kitchenprinters:
+                    print_food_order(
+                        spooler.spooled_printer(
+                            kp, "printing the order in the kitchen",
+                            retries=2, on_failure=print_here),
+                        number, ml, verbose=False, tablenumber=tablenumber,
+                        footer=self.footer, transid=self.transid,
+                        user=user.shortname if user else None)
         else:
             if r:
                 ui.infopopup([r], title="Error")
@@ -571,7 +583,8 @@ class message(user.permission_checked, ui.dismisspopup):
         self.dismiss()
         with ui.exception_guard("printing the message in the kitchen"):
             for kp in self.kitchenprinters:
-                with kp as d:
+                with spooler.spooled_printer(
+                        kp, "printing the message in the kitchen") as d:
                     if self.onfield.f:
                         d.printline(
                             f"\tMessage about order {self.onfield.f}",
@@ -589,7 +602,7 @@ class message(user.permission_checked, ui.dismisspopup):
                         d.printline(f"\t{self.messagefield.f}")
                         d.printline()
                     d.printline()
-            ui.infopopup(["The message has been printed in the kitchen."],
+            ui.infopopup(["The message has been sent to the kitchen."],
                          title="Message sent",
                          colour=ui.colour_info, dismiss=keyboard.K_CASH)
 
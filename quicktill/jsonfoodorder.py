@@ -1,11 +1,10 @@
 import requests
-import sys
-import traceback
 import datetime
 import logging
 from . import ui, keyboard, td, tillconfig, user
 from .user import log as userlog
 from . import lockscreen
+from . import spooler
 from . import register
 from .models import zero
 from decimal import Decimal
@@ -597,37 +596,52 @@ class _popup(user.permission_checked, ui.basicpopup):
             ui.infopopup([r], title="Error")
             return
         user = ui.current_user()
+        ml = list(self.ml)
+        footer = self.menu.footer
         with ui.exception_guard("printing the customer copy"):
-            print_order(tillconfig.receipt_printer, number, self.ml,
-                        verbose=True, tablenumber=tablenumber,
-                        footer=self.menu.footer, transid=self.transid)
-        try:
-            for p in self.plugin.printers:
-                print_order(
-                    p, number, self.ml,
-                    verbose=False, tablenumber=tablenumber,
-                    footer=self.menu.footer, transid=self.transid,
-                    user=user.shortname)
-        except Exception:
-            e = traceback.format_exception_only(
-                sys.exc_info()[0], sys.exc_info()[1])
-            try:
-                print_order(
-                    tillconfig.receipt_printer, number, self.ml,
-                    verbose=False, tablenumber=tablenumber,
-                    footer=self.menu.footer, transid=self.transid,
-                    user=user.shortname)
-            except Exception:
-                pass
+            print_order(
+                spooler.spooled_printer(
+                    tillconfig.receipt_printer, "printing the customer copy"),
+                number, ml, verbose=True, tablenumber=tablenumber,
+                footer=footer, transid=self.transid)
+        plugin = self.plugin
+
+        printed_here = False
+
+        def print_here(job):
+            # Print one copy here for the order, however many of
+            # the printers fail
+            nonlocal printed_here
+            if printed_here:
+                return
+            printed_here = True
+            print_order(
+                spooler.spooled_printer(
+                    tillconfig.receipt_printer,
+                    f"printing the {plugin.name} copy here"),
+                number, ml, verbose=False, tablenumber=tablenumber,
+                footer=footer, transid=self.transid,
+                user=user.shortname)
             ui.infopopup(
                 [f"There was a problem sending the order to the "
-                 f"{self.plugin.name} printer, so that copy has been "
+                 f"{plugin.name} printer, so that copy has been "
                  f"printed here instead.  You must now take it through "
                  f"so that they can make it.  Check that the order printer "
                  f"has paper, is turned on, and is plugged "
                  f"in to the network.", "", "The error message from the "
-                 "printer is:"] + e,
-                title=f"{self.plugin.name_capital} printer error")
+                 "printer is:", job.last_error],
+                title=f"{plugin.name_capital} printer error")
+
+        with ui.exception_guard(
+                f"printing the order in {plugin.definite_name}"):
+            for p in plugin.printers:
+                print_order(
+                    spooler.spooled_printer(
+                        p, f"printing the order in {plugin.definite_name}",
+                        retries=2, on_failure=print_here),
+                    number, ml, verbose=False, tablenumber=tablenumber,
+                    footer=footer, transid=self.transid,
+                    user=user.shortname)
 
     def _printer_problem(self):
         for p in self.plugin.printers:
@@ -701,7 +715,9 @@ class message(user.permission_checked, ui.dismisspopup):
         with ui.exception_guard(
                 f"printing the message in {self.plugin.definite_name}"):
             for p in self.plugin.printers:
-                with p as d:
+                with spooler.spooled_printer(
+                        p, f"printing the message in "
+                        f"{self.plugin.definite_name}") as d:
                     if self.onfield.f:
                         d.printline(
                             f"\tMessage about order {self.onfield.f}",
@@ -720,7 +736,7 @@ class message(user.permission_checked, ui.dismisspopup):
                         d.printline()
                     d.printline()
             ui.infopopup(
-                [f"The message has been printed on the "
+                [f"The message has been sent to the "
                  f"{self.plugin.name} order printer."],
                 title="Message sent",
                 colour=ui.colour_info, dismiss=keyboard.K_CASH)
@@ -1,8 +1,10 @@
-from . import keyboard, ui, td, user
+from . import keyboard, ui, td, user, listen
 from .models import KeyCap, KeyboardBinding, StockLine, PriceLookup
 from sqlalchemy import text
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy.sql import select, update
 
+import time
 import logging
 log = logging.getLogger(__name__)
 
@@ -281,9 +283,120 @@ class move_keys(user.permission_checked, ui.dismisspopup):
             super().keypress(k)
 
 
+class BindingCache(listen.NotifiedCache):
+    """Keyboard bindings cached in memory, keyed by keycode
+
+    Resolving a line key press normally needs a query for the
+    keyboard bindings and everything they refer to.  This cache keeps
+    detached copies of the bindings for each keycode, loaded with
+    query_options, and merges them into the current ORM session
+    without a query.
+
+    Entries are dropped when the database notifies a change to a
+    keyboard binding, or to a stock line, price lookup or stock type
+    that they refer to; stock lines are notified when stock is put on
+    sale on them or taken off.  Stock items change every time stock
+    is sold, so they are expired when the bindings are merged and are
+    reloaded when needed.  Other changes that are not notified, for
+    example to departments, are picked up when an entry reaches
+    max_age seconds old.
+    """
+    max_age = 600
+
+    def __init__(self, query_options=None):
+        super().__init__()
+        self._query_options = query_options
+        self._entries = {}  # keycode name: (time, tags, bindings)
+        self.hits = 0
+        self.misses = 0
+
+    def _listen(self, listener):
+        listener.listen_for('keyboard_change', self._keycode_changed)
+        for channel, tag in (('stockline_change', 'stockline'),
+                             ('plu_change', 'plu'),
+                             ('stocktype_change', 'stocktype')):
+            listener.listen_for(
+                channel, lambda payload, tag=tag: self._invalidate(
+                    (tag, int(payload))))
+
+    def _keycode_changed(self, keycode):
+        self._entries.pop(keycode, None)
+
+    def _invalidate(self, tag):
+        for keycode in [k for k, (_, tags, _) in self._entries.items()
+                        if tag in tags]:
+            del self._entries[keycode]
+
+    def clear(self):
+        self._entries.clear()
+
+    @staticmethod
+    def _tags(bindings):
+        """Things the bindings depend on, as (kind, id) tuples
+        """
+        tags = set()
+        for kb in bindings:
+            if kb.stockline:
+                sl = kb.stockline
+                tags.add(('stockline', sl.id))
+                if sl.stocktype_id:
+                    tags.add(('stocktype', sl.stocktype_id))
+                for item in sl.stockonsale:
+                    tags.add(('stocktype', item.stocktype_id))
+            if kb.plu:
+                tags.add(('plu', kb.plu.id))
+        return tags
+
+    def _query(self, session, keycode):
+        # Everything _tags() looks at must be loaded here
+        q = session.query(KeyboardBinding)\
+                   .filter(KeyboardBinding.keycode == keycode)\
+                   .options(joinedload(KeyboardBinding.stockline)
+                            .joinedload(StockLine.stockonsale),
+                            joinedload(KeyboardBinding.plu))
+        if self._query_options:
+            q = self._query_options(q)
+        return q.all()
+
+    def bindings(self, keycode):
+        """Keyboard bindings for a keycode name, in the current session
+        """
+        if not self._usable():
+            self.misses += 1
+            return self._query(td.s, keycode)
+        entry = self._entries.get(keycode)
+        if entry and time.monotonic() - entry[0] < self.max_age:
+            self.hits += 1
+            cached = entry[2]
+        else:
+            entry = None
+            self.misses += 1
+            # The cached objects are loaded in a session of their
+            # own so they are not expired when td.s is committed.  It
+            # uses td.s's connection and transaction, and leaves them
+            # open when it is closed.
+            with Session(td.s.connection()) as session:
+                cached = self._query(session, keycode)
+            self._entries[keycode] = (
+                time.monotonic(), self._tags(cached), cached)
+        bindings = [td.s.merge(kb, load=False) for kb in cached]
+        if entry is None:
+            # Stock items were loaded just now
+            return bindings
+        for kb in bindings:
+            if kb.stockline:
+                for item in kb.stockline.stockonsale:
+                    td.s.expire(item)
+        return bindings
+
+    def __str__(self):
+        return f"{len(self._entries)} keycodes cached; " \
+            f"{self.hits} hits, {self.misses} misses"
+
+
 def linemenu(keycode, func, allow_stocklines=True, allow_plus=False,
              allow_mods=False, add_query_options=None,
-             suppress_modifier_display=False):
+             suppress_modifier_display=False, cache=None):
     """Resolve a keycode to a keyboard binding
 
     Given a keycode, find out what is bound to it.  If there's more
@@ -293,22 +406,31 @@ def linemenu(keycode, func, allow_stocklines=True, allow_plus=False,
     there's only one keyboard binding in the list, shortcut to the
     function.
 
+    If cache is a BindingCache, the bindings are looked up in it
+    instead of being queried; add_query_options is not used.
+
     This function returns the number of keyboard bindings found.  Some
     callers may wish to use this to inform the user that a key has no
     bindings rather than having an uninformative empty menu pop up.
     """
-    kb = td.s.query(KeyboardBinding)\
-             .filter(KeyboardBinding.keycode == keycode.name)
-    if not allow_stocklines:
-        kb = kb.filter(KeyboardBinding.stocklineid == None)
-    if not allow_plus:
-        kb = kb.filter(KeyboardBinding.pluid == None)
-    if not allow_mods:
-        kb = kb.filter((KeyboardBinding.stocklineid != None)
-                       | (KeyboardBinding.pluid != None))
-    if add_query_options:
-        kb = add_query_options(kb)
-    kb = kb.all()
+    if cache:
+        kb = [x for x in cache.bindings(keycode.name)
+              if (allow_stocklines or not x.stocklineid)
+              and (allow_plus or not x.pluid)
+              and (allow_mods or x.stocklineid or x.pluid)]
+    else:
+        kb = td.s.query(KeyboardBinding)\
+                 .filter(KeyboardBinding.keycode == keycode.name)
+        if not allow_stocklines:
+            kb = kb.filter(KeyboardBinding.stocklineid == None)
+        if not allow_plus:
+            kb = kb.filter(KeyboardBinding.pluid == None)
+        if not allow_mods:
+            kb = kb.filter((KeyboardBinding.stocklineid != None)
+                           | (KeyboardBinding.pluid != None))
+        if add_query_options:
+            kb = add_query_options(kb)
+        kb = kb.all()
 
     if len(kb) == 1:
         func(kb[0])
@@ -320,18 +442,22 @@ def linemenu(keycode, func, allow_stocklines=True, allow_plus=False,
               and not suppress_modifier_display
               else x.name,
               _linemenu_chosen,
-              (x.keycode, x.menukey, func, add_query_options))
+              (x.keycode, x.menukey, func, add_query_options, cache))
              for x in kb], key=lambda x: str(x[0]))
         ui.keymenu(il, title=keycode.keycap, colour=ui.colour_line)
     return len(kb)
 
 
-def _linemenu_chosen(keycode, menukey, func, add_query_options):
-    kb = td.s.query(KeyboardBinding)\
-             .filter(KeyboardBinding.keycode == keycode)\
-             .filter(KeyboardBinding.menukey == menukey)
-    if add_query_options:
-        kb = add_query_options(kb)
-    kb = kb.one_or_none()
+def _linemenu_chosen(keycode, menukey, func, add_query_options, cache):
+    if cache:
+        kb = next((x for x in cache.bindings(keycode)
+                   if x.menukey == menukey), None)
+    else:
+        kb = td.s.query(KeyboardBinding)\
+                 .filter(KeyboardBinding.keycode == keycode)\
+                 .filter(KeyboardBinding.menukey == menukey)
+        if add_query_options:
+            kb = add_query_options(kb)
+        kb = kb.one_or_none()
     if kb:
         func(kb)
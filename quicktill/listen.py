@@ -106,6 +106,42 @@ class db_listener:
                 f._func(notify.payload)
 
 
+class NotifiedCache:
+    """Base class for caches kept up to date by database notifications
+
+    Notifications may be missed while the database listener is
+    disconnected, so the cache is cleared whenever the listener's
+    connection changes and is bypassed while there is no connection.
+
+    Subclasses override _listen() to listen for the notifications
+    that affect them, and clear().
+    """
+    def __init__(self):
+        self._connection = None
+        self._listening = False
+
+    def _listen(self, listener):
+        pass
+
+    def clear(self):
+        pass
+
+    def _usable(self):
+        """Can the cache be used now?
+
+        If not, the caller should query the database instead.
+        """
+        if not listener or not listener.connection:
+            return False
+        if not self._listening:
+            self._listen(listener)
+            self._listening = True
+        if listener.connection is not self._connection:
+            self.clear()
+            self._connection = listener.connection
+        return True
+
+
 # listener is set to an instance of db_listener during quicktill
 # initialisation but this ought to go somewhere else like
 # tillconfig...
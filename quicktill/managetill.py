@@ -5,7 +5,7 @@ import sys
 import os
 from . import ui, keyboard, td, printer, session, user
 from . import tillconfig, linekeys, stocklines, plu, modifiers
-from . import barcode, payment
+from . import barcode, payment, register, spooler
 from .models import Transaction, UserToken
 from .version import version
 import subprocess
@@ -50,7 +50,10 @@ class receiptprint(user.permission_checked, ui.dismisspopup):
         user.log(f"Printed {trans.state} transaction {trans.logref} "
                  f"from transaction number")
         with ui.exception_guard("printing the receipt", title="Printer error"):
-            printer.print_receipt(tillconfig.receipt_printer, rn)
+            printer.print_receipt(
+                spooler.spooled_printer(
+                    tillconfig.receipt_printer, "printing the receipt"),
+                rn)
 
 
 @user.permission_required('version', 'See version information')
@@ -160,6 +163,7 @@ def sys_menu():
             ("4", "Enter fullscreen mode", fullscreen, (True,)),
             ("5", "Leave fullscreen mode", fullscreen, (False,)),
         ]
+    menu.append(("6", "Print queue", spooler.status, None))
     ui.keymenu(menu, title="System information and settings")
 
 
@@ -197,6 +201,11 @@ def debug_menu():
         ui.menu(lines, title="User tokens",
                 blurb="Choose a user token and press Cash/Enter.")
 
+    def cache_stats():
+        ui.infopopup([f"Line key binding cache: {register.binding_cache}",
+                      f"User permission cache: {user.permission_cache}"],
+                     title="Cache statistics", colour=ui.colour_info)
+
     def defer_all_open_transactions():
         for t in td.s.query(Transaction)\
                      .filter(Transaction.closed == False).all():
@@ -211,6 +220,7 @@ def debug_menu():
         ("5", "Fake a usertoken", send_usertoken, None),
         ("6", "Defer all open transactions (dangerous!)",
          defer_all_open_transactions, None),
+        ("7", "Cache statistics", cache_stats, None),
     ]
     ui.keymenu(menu, title="Debug")
 
@@ -11,12 +11,14 @@ from sqlalchemy.sql.expression import text, case, literal
 from sqlalchemy.orm import relationship, backref, object_session
 from sqlalchemy.orm import joinedload, lazyload
 from sqlalchemy.orm import contains_eager, column_property
-from sqlalchemy.orm import undefer_group
+from sqlalchemy.orm import undefer, undefer_group
 from sqlalchemy.orm import aliased
 from sqlalchemy.orm import deferred
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql import select, func, desc
+from sqlalchemy.sql import insert, update
 from sqlalchemy import event
 from sqlalchemy import distinct
 from sqlalchemy import inspect
@@ -455,12 +457,28 @@ class Session(Base, Logged):
         if accounts:
             return accounts.url_for_invoice(self.accinfo)
 
+    @property
+    def summarised(self):
+        """Are this session's totals available from SessionSummary?
+
+        This is true for closed sessions: the summary is written by a
+        trigger when the session's endtime is set.
+        """
+        return self.endtime is not None
+
     @property
     def dept_totals(self):
         """Transaction lines broken down by Department.
 
         Returns list of (Department, total) keyed tuples.
         """
+        if self.summarised:
+            return object_session(self)\
+                .query(Department, SessionDeptTotal.total.label("total"))\
+                .join(SessionDeptTotal)\
+                .filter(SessionDeptTotal.sessionid == self.id)\
+                .order_by(Department.id)\
+                .all()
         return object_session(self)\
             .query(Department, func.sum(
                 Transline.items * Transline.amount).label("total"))\
@@ -483,6 +501,20 @@ class Session(Base, Logged):
         using keys not indices, so that
         """
         s = object_session(self)
+        if self.summarised:
+            return s.query(
+                Department,
+                SessionDeptTotal.total.label("total"),
+                SessionDeptTotal.closed_total.label("paid"),
+                func.nullif(SessionDeptTotal.total
+                            - SessionDeptTotal.closed_total, zero)
+                .label("pending"),
+                SessionDeptTotal.discount_total.label("discount_total"))\
+                .outerjoin(SessionDeptTotal,
+                           (SessionDeptTotal.dept_id == Department.id)
+                           & (SessionDeptTotal.sessionid == self.id))\
+                .order_by(Department.id)\
+                .all()
         tot_all = s.query(func.sum(Transline.items * Transline.amount))\
                    .select_from(Transline.__table__)\
                    .join(Transaction)\
@@ -506,6 +538,13 @@ class Session(Base, Logged):
     @property
     def user_totals(self):
         "Transaction lines broken down by User; also count of items sold."
+        if self.summarised:
+            return object_session(self)\
+                .query(User, SessionUserTotal.items, SessionUserTotal.total)\
+                .join(SessionUserTotal)\
+                .filter(SessionUserTotal.sessionid == self.id)\
+                .order_by(desc(SessionUserTotal.total))\
+                .all()
         return object_session(self)\
             .query(User, func.sum(Transline.items), func.sum(
                 Transline.items * Transline.amount))\
@@ -552,14 +591,23 @@ class Session(Base, Logged):
 
         Returns (VatRate, amount, ex-vat amount, vat)
         """
-        vt = object_session(self)\
-            .query(VatBand, func.sum(Transline.items * Transline.amount))\
-            .select_from(Session)\
-            .filter(Session.id == self.id)\
-            .join(Transaction)\
-            .join(Transline)\
-            .join(Department)\
-            .join(VatBand)\
+        if self.summarised:
+            vt = object_session(self)\
+                .query(VatBand, func.sum(SessionDeptTotal.total))\
+                .select_from(SessionDeptTotal)\
+                .filter(SessionDeptTotal.sessionid == self.id)\
+                .join(Department)\
+                .join(VatBand)
+        else:
+            vt = object_session(self)\
+                .query(VatBand, func.sum(Transline.items * Transline.amount))\
+                .select_from(Session)\
+                .filter(Session.id == self.id)\
+                .join(Transaction)\
+                .join(Transline)\
+                .join(Department)\
+                .join(VatBand)
+        vt = vt\
             .order_by(VatBand.band)\
             .group_by(VatBand)\
             .options(joinedload(VatBand.business),
@@ -582,6 +630,37 @@ class Session(Base, Logged):
             businesses[b] = (t[0] + amount, t[1] + exvat, t[2] + vat)
         return [(b, t[0], t[1], t[2]) for b, t in businesses.items()]
 
+    @classmethod
+    def vatband_totals_for(cls, session, sessions):
+        """Transaction lines broken down by VatBand for many sessions
+
+        Equivalent to reading vatband_totals from each of the sessions,
+        but uses a single query for all of them.  Returns a dict of
+        session ID to list of (VatRate, amount, ex-vat amount, vat).
+        """
+        sessions = list(sessions)
+        sdt = SessionDeptTotal.all_sessions()
+        vatbands = {
+            vb.band: vb for vb in session.query(VatBand).options(
+                joinedload(VatBand.business),
+                joinedload(VatBand.vatrates).joinedload(VatRate.business))
+            .all()}
+        totals = session.query(
+            sdt.c.sessionid, Department.vatband, func.sum(sdt.c.total))\
+            .select_from(sdt)\
+            .join(Department, Department.id == sdt.c.dept)\
+            .filter(sdt.c.sessionid.in_([s.id for s in sessions]))\
+            .group_by(sdt.c.sessionid, Department.vatband)\
+            .order_by(sdt.c.sessionid, Department.vatband)\
+            .all()
+        dates = {s.id: s.date for s in sessions}
+        r = {s.id: [] for s in sessions}
+        for sessionid, band, amount in totals:
+            vr = vatbands[band].at(dates[sessionid])
+            r[sessionid].append(
+                (vr, amount, vr.inc_to_exc(amount), vr.inc_to_vat(amount)))
+        return r
+
     @property
     def stock_sold(self):
         "Returns a list of (StockType, quantity) tuples."
@@ -1316,6 +1395,11 @@ class Transline(Base, Logged):
             name="discount_name_constraint"),
     )
 
+    # Fetch time and the other server defaults when inserting, so
+    # the register doesn't have to load them separately to display a
+    # new line
+    __mapper_args__ = {"eager_defaults": True}
+
     # The original_amount instance attribute may be accessed before
     # the instance is committed to the database, and at this point
     # self.discount may be None; treat this as zero
@@ -1486,32 +1570,282 @@ DROP FUNCTION check_modify_closed_trans_line();
 """)  # noqa: E501
 
 
+class SessionSummary(Base):
+    """Totals for a closed session
+
+    Calculating session totals from the transaction lines every time
+    they are needed gets slow when there are many sessions to list.
+    The totals for a session are written to this table, and to
+    SessionDeptTotal and SessionUserTotal, when the session is
+    closed.  If any of the transaction lines or transactions in a
+    closed session are changed later, the totals are recalculated.
+    This is all done by triggers; these tables must not be written to
+    directly.
+
+    Open sessions do not have an entry here.
+    """
+    __tablename__ = 'session_summaries'
+    sessionid = Column(Integer, ForeignKey('sessions.sessionid',
+                                           ondelete='CASCADE'),
+                       nullable=False, primary_key=True)
+    total = Column(money, nullable=False)
+    closed_total = Column(money, nullable=False)
+    discount_total = Column(money, nullable=False)
+
+
+class SessionDeptTotal(Base):
+    """Totals for a closed session broken down by Department
+
+    Totals by VatBand are calculated from these using the current
+    VatBand of each Department, in the same way as for open sessions.
+    """
+    __tablename__ = 'session_dept_totals'
+    sessionid = Column(Integer, ForeignKey('session_summaries.sessionid',
+                                           ondelete='CASCADE'),
+                       nullable=False, primary_key=True)
+    dept_id = Column('dept', Integer, ForeignKey('departments.dept'),
+                     nullable=False, primary_key=True)
+    total = Column(money, nullable=False)
+    closed_total = Column(money, nullable=False)
+    discount_total = Column(money, nullable=False)
+
+    @classmethod
+    def all_sessions(cls):
+        """Totals broken down by Department for all sessions
+
+        Returns a subquery with sessionid, dept, total, closed_total
+        and discount_total columns.  The totals are read from this
+        table where possible, and calculated from the transaction
+        lines for sessions that don't have a summary (for example the
+        current session).
+        """
+        line_total = Transline.items * Transline.amount
+        unsummarised = select(Session.id)\
+            .where(~select(SessionSummary.sessionid)
+                   .where(SessionSummary.sessionid == Session.id)
+                   .exists())
+        calculated = select(
+            Transaction.sessionid,
+            Transline.dept_id.label('dept'),
+            func.sum(line_total).label('total'),
+            func.coalesce(func.sum(line_total).filter(Transaction.closed),
+                          zero).label('closed_total'),
+            func.sum(Transline.items * Transline.discount)
+            .label('discount_total'))\
+            .select_from(Transaction.__table__.join(Transline.__table__))\
+            .where(Transaction.sessionid.in_(unsummarised))\
+            .group_by(Transaction.sessionid, Transline.dept_id)
+        summarised = select(
+            cls.sessionid, cls.dept_id.label('dept'), cls.total,
+            cls.closed_total, cls.discount_total)
+        return summarised.union_all(calculated).subquery()
+
+
+class SessionUserTotal(Base):
+    """Totals for a closed session broken down by User
+    """
+    __tablename__ = 'session_user_totals'
+    sessionid = Column(Integer, ForeignKey('session_summaries.sessionid',
+                                           ondelete='CASCADE'),
+                       nullable=False, primary_key=True)
+    user_id = Column('user', Integer, ForeignKey('users.id'),
+                     nullable=False, primary_key=True)
+    items = Column(Integer, nullable=False)
+    total = Column(money, nullable=False)
+
+
+# Session summaries are written when a session is closed, and
+# rewritten whenever a statement changes the transaction lines or
+# transactions in a closed session.  The triggers on translines and
+# transactions are per statement so that bulk changes only rewrite
+# each affected summary once.
+add_ddl(metadata, """
+CREATE OR REPLACE FUNCTION session_summary_refresh(sid integer)
+  RETURNS void AS $$
+BEGIN
+  DELETE FROM session_summaries WHERE sessionid = sid;
+  IF NOT EXISTS (SELECT 1 FROM sessions
+                 WHERE sessionid = sid AND endtime IS NOT NULL) THEN
+    RETURN;
+  END IF;
+  INSERT INTO session_summaries
+    (sessionid, total, closed_total, discount_total)
+    SELECT sid,
+      COALESCE(SUM(tl.items * tl.amount), 0.00),
+      COALESCE(SUM(tl.items * tl.amount) FILTER (WHERE t.closed), 0.00),
+      COALESCE(SUM(tl.items * tl.discount), 0.00)
+    FROM transactions t JOIN translines tl ON tl.transid = t.transid
+    WHERE t.sessionid = sid;
+  INSERT INTO session_dept_totals
+    (sessionid, dept, total, closed_total, discount_total)
+    SELECT sid, tl.dept,
+      SUM(tl.items * tl.amount),
+      COALESCE(SUM(tl.items * tl.amount) FILTER (WHERE t.closed), 0.00),
+      SUM(tl.items * tl.discount)
+    FROM transactions t JOIN translines tl ON tl.transid = t.transid
+    WHERE t.sessionid = sid
+    GROUP BY tl.dept;
+  INSERT INTO session_user_totals (sessionid, "user", items, total)
+    SELECT sid, tl.user, SUM(tl.items), SUM(tl.items * tl.amount)
+    FROM transactions t JOIN translines tl ON tl.transid = t.transid
+    WHERE t.sessionid = sid AND tl.user IS NOT NULL
+    GROUP BY tl.user;
+END;
+$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION session_summary_session_changed()
+  RETURNS trigger AS $$
+BEGIN
+  PERFORM session_summary_refresh(NEW.sessionid);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER session_summary_endtime
+  AFTER UPDATE OF endtime ON sessions
+  FOR EACH ROW WHEN (OLD.endtime IS DISTINCT FROM NEW.endtime)
+  EXECUTE PROCEDURE session_summary_session_changed();
+CREATE OR REPLACE FUNCTION session_summary_translines_changed()
+  RETURNS trigger AS $$
+DECLARE
+  sid integer;
+BEGIN
+  IF (TG_OP = 'INSERT') THEN
+    FOR sid IN SELECT DISTINCT t.sessionid
+      FROM new_rows n
+      JOIN transactions t ON t.transid = n.transid
+      JOIN sessions s ON s.sessionid = t.sessionid
+      WHERE s.endtime IS NOT NULL
+    LOOP
+      PERFORM session_summary_refresh(sid);
+    END LOOP;
+  ELSIF (TG_OP = 'DELETE') THEN
+    FOR sid IN SELECT DISTINCT t.sessionid
+      FROM old_rows o
+      JOIN transactions t ON t.transid = o.transid
+      JOIN sessions s ON s.sessionid = t.sessionid
+      WHERE s.endtime IS NOT NULL
+    LOOP
+      PERFORM session_summary_refresh(sid);
+    END LOOP;
+  ELSE
+    FOR sid IN SELECT DISTINCT t.sessionid
+      FROM old_rows o
+      JOIN new_rows n ON n.translineid = o.translineid
+      JOIN transactions t ON t.transid IN (o.transid, n.transid)
+      JOIN sessions s ON s.sessionid = t.sessionid
+      WHERE s.endtime IS NOT NULL
+        AND (o.transid, o.items, o.amount, o.dept, o.user, o.discount)
+          IS DISTINCT FROM
+          (n.transid, n.items, n.amount, n.dept, n.user, n.discount)
+    LOOP
+      PERFORM session_summary_refresh(sid);
+    END LOOP;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER session_summary_translines_insert
+  AFTER INSERT ON translines REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE session_summary_translines_changed();
+CREATE TRIGGER session_summary_translines_update
+  AFTER UPDATE ON translines
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE session_summary_translines_changed();
+CREATE TRIGGER session_summary_translines_delete
+  AFTER DELETE ON translines REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE session_summary_translines_changed();
+CREATE OR REPLACE FUNCTION session_summary_transactions_changed()
+  RETURNS trigger AS $$
+DECLARE
+  sid integer;
+BEGIN
+  IF (TG_OP = 'DELETE') THEN
+    FOR sid IN SELECT DISTINCT o.sessionid
+      FROM old_rows o
+      JOIN sessions s ON s.sessionid = o.sessionid
+      WHERE s.endtime IS NOT NULL
+    LOOP
+      PERFORM session_summary_refresh(sid);
+    END LOOP;
+  ELSE
+    FOR sid IN SELECT DISTINCT s.sessionid
+      FROM old_rows o
+      JOIN new_rows n ON n.transid = o.transid
+      JOIN sessions s ON s.sessionid IN (o.sessionid, n.sessionid)
+      WHERE s.endtime IS NOT NULL
+        AND (o.sessionid, o.closed) IS DISTINCT FROM (n.sessionid, n.closed)
+    LOOP
+      PERFORM session_summary_refresh(sid);
+    END LOOP;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER session_summary_transactions_update
+  AFTER UPDATE ON transactions
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE session_summary_transactions_changed();
+CREATE TRIGGER session_summary_transactions_delete
+  AFTER DELETE ON transactions REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE PROCEDURE session_summary_transactions_changed();
+""", """
+DROP TRIGGER session_summary_transactions_delete ON transactions;
+DROP TRIGGER session_summary_transactions_update ON transactions;
+DROP FUNCTION session_summary_transactions_changed();
+DROP TRIGGER session_summary_translines_delete ON translines;
+DROP TRIGGER session_summary_translines_update ON translines;
+DROP TRIGGER session_summary_translines_insert ON translines;
+DROP FUNCTION session_summary_translines_changed();
+DROP TRIGGER session_summary_endtime ON sessions;
+DROP FUNCTION session_summary_session_changed();
+DROP FUNCTION session_summary_refresh(integer);
+""")
+
+
+def _session_summary_or(column, calculated):
+    """Read a total from SessionSummary, or calculate it if not present
+    """
+    return func.coalesce(
+        select(column)
+        .where(SessionSummary.sessionid == Session.id)
+        .correlate(Session.__table__)
+        .scalar_subquery(),
+        calculated
+        .correlate(Session.__table__)
+        .scalar_subquery())
+
+
 # Add "total" column property to the Session class now that
 # transactions and translines are defined
 Session.total = column_property(
-    select(func.coalesce(func.sum(Transline.items * Transline.amount), zero))
-    .where(Transline.transid == Transaction.id,
-           Transaction.sessionid == Session.id)
-    .correlate(Session.__table__)
+    _session_summary_or(
+        SessionSummary.total,
+        select(func.coalesce(func.sum(Transline.items * Transline.amount),
+                             zero))
+        .where(Transline.transid == Transaction.id,
+               Transaction.sessionid == Session.id))
     .label('total'),
     deferred=True,
     doc="Transaction lines total")
 
 Session.closed_total = column_property(
-    select(func.coalesce(func.sum(Transline.items * Transline.amount), zero))
-    .where(Transline.transid == Transaction.id,
-           Transaction.closed,
-           Transaction.sessionid == Session.id)
-    .correlate(Session.__table__)
+    _session_summary_or(
+        SessionSummary.closed_total,
+        select(func.coalesce(func.sum(Transline.items * Transline.amount),
+                             zero))
+        .where(Transline.transid == Transaction.id,
+               Transaction.closed,
+               Transaction.sessionid == Session.id))
     .label('closed_total'),
     deferred=True,
     doc="Transaction lines total, closed transactions only")
 
 Session.discount_total = column_property(
-    select(func.coalesce(func.sum(Transline.items * Transline.discount), zero))
-    .where(Transline.transid == Transaction.id,
-           Transaction.sessionid == Session.id)
-    .correlate(Session.__table__)
+    _session_summary_or(
+        SessionSummary.discount_total,
+        select(func.coalesce(func.sum(Transline.items * Transline.discount),
+                             zero))
+        .where(Transline.transid == Transaction.id,
+               Transaction.sessionid == Session.id))
     .label('discount_total'),
     deferred=True,
     doc="Discount total")
@@ -1819,6 +2153,8 @@ class StockLine(Base, Logged):
         # Reject negative quantities
         if qty < Decimal("0.0"):
             return ([], qty, None)
+        if self.linetype in ("regular", "display"):
+            self._load_stockonsale()
         if self.linetype == "regular":
             if len(self.stockonsale) == 0:
                 return ([], qty, Decimal("0.0"))
@@ -1842,6 +2178,31 @@ class StockLine(Base, Logged):
         elif self.linetype == "continuous":
             return self.stocktype.calculate_sale(qty)
 
+    def _load_stockonsale(self):
+        """Load the stock on sale and its quantities in one query
+
+        calculate_sale() needs the quantities of every item on sale.
+        If they, or the list of items itself, haven't already been
+        loaded, fetch them all at once rather than with one query per
+        item.
+        """
+        if "stockonsale" not in inspect(self).unloaded \
+           and not any("remaining" in inspect(item).unloaded
+                       for item in self.stockonsale):
+            return
+        items = object_session(self)\
+            .query(StockItem)\
+            .filter(StockItem.stockline == self)\
+            .options(undefer(StockItem.used),
+                     undefer(StockItem.remaining),
+                     undefer(StockItem.lastsale),
+                     joinedload(StockItem.stocktype))\
+            .order_by(desc(func.coalesce(StockItem.displayqty, 0)),
+                      StockItem.id)\
+            .all()
+        if "stockonsale" in inspect(self).unloaded:
+            set_committed_value(self, "stockonsale", items)
+
     def other_lines_same_stocktype(self):
         """Return other stocklines with the same linetype and stocktype."""
         return object_session(self)\
@@ -1851,6 +2212,89 @@ class StockLine(Base, Logged):
             .filter(StockLine.id != self.id)\
             .all()
 
+    @classmethod
+    def auto_allocate(cls, session, deliveryid=None, user=None):
+        """Put unallocated stock on display stock lines
+
+        Stock items from checked deliveries that are not finished and
+        are not on a stock line are put on the display stock line for
+        their stock type, if there is exactly one such line.  All the
+        items are allocated by a single UPDATE, and their annotations
+        are inserted together.  If deliveryid is specified, only
+        items from that delivery are considered.
+
+        Returns (allocated, manual): allocated is a list of the
+        StockItems that were put on sale, and manual is a list of
+        (StockItem, list of StockLine) tuples for items that could go
+        on more than one display stock line.
+        """
+        display = select(cls.stocktype_id,
+                         func.min(cls.id).label('stocklineid'),
+                         func.count().label('lines'))\
+            .where(cls.linetype == "display")\
+            .group_by(cls.stocktype_id)\
+            .subquery()
+        candidate = [
+            StockItem.finished == None,
+            StockItem.stocklineid == None,
+            StockItem.deliveryid == Delivery.id,
+            Delivery.checked == True,
+            StockItem.stocktype_id == display.c.stocktype_id,
+        ]
+        if deliveryid:
+            candidate.append(Delivery.id == deliveryid)
+        # The log_stocktype rule on stock inserts a row into
+        # stockline_stocktype_log for every updated item, and only
+        # pairs that are already in the log are ignored: log each
+        # pair once here so a multi-row update can't insert duplicates
+        session.execute(
+            insert(StockLineTypeLog).from_select(
+                ['stocklineid', 'stocktype'],
+                select(display.c.stocklineid, StockItem.stocktype_id)
+                .distinct()
+                .where(*candidate, display.c.lines == 1)))
+        allocated = session.execute(
+            update(StockItem)
+            .where(*candidate, display.c.lines == 1)
+            .values(stocklineid=display.c.stocklineid,
+                    displayqty=StockItem.used.expression,
+                    onsale=func.current_timestamp())
+            .returning(StockItem.id, display.c.stocklineid)
+            .execution_options(synchronize_session='fetch')).all()
+        if allocated:
+            names = dict(session.execute(
+                select(cls.id, cls.name)
+                .where(cls.id.in_({lineid for _, lineid in allocated}))
+            ).all())
+            session.execute(insert(StockAnnotation), [
+                {'stockid': stockid, 'atype': 'start',
+                 'text': f"{names[lineid]} (auto-allocate)",
+                 'user_id': user.id if user else None}
+                for stockid, lineid in allocated])
+        allocated = session.query(StockItem)\
+                           .filter(StockItem.id.in_(
+                               [stockid for stockid, _ in allocated]))\
+                           .options(joinedload(StockItem.stocktype),
+                                    joinedload(StockItem.stockline))\
+                           .order_by(StockItem.id)\
+                           .all() if allocated else []
+        manual = session.query(StockItem)\
+                        .filter(*candidate, display.c.lines > 1)\
+                        .options(joinedload(StockItem.stocktype))\
+                        .order_by(StockItem.id)\
+                        .all()
+        lines = {}
+        if manual:
+            for line in session.query(cls)\
+                               .filter(cls.linetype == "display")\
+                               .filter(cls.stocktype_id.in_(
+                                   {item.stocktype_id for item in manual}))\
+                               .order_by(cls.id)\
+                               .all():
+                lines.setdefault(line.stocktype_id, []).append(line)
+        return allocated, [(item, lines[item.stocktype_id])
+                           for item in manual]
+
     @classmethod
     def locations(cls, session):
         return [x[0] for x in session.query(distinct(cls.location))
@@ -1925,6 +2369,27 @@ class PriceLookup(Base, Logged):
     tillweb_index_viewname = "tillweb-plus"
 
 
+add_ddl(PriceLookup.__table__, """
+CREATE OR REPLACE FUNCTION notify_plu_change() RETURNS trigger AS $$
+DECLARE
+BEGIN
+  IF (TG_OP = 'DELETE') THEN
+    PERFORM pg_notify('plu_change', CAST(OLD.id AS text));
+  ELSE
+    PERFORM pg_notify('plu_change', CAST(NEW.id AS text));
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER plu_changed
+  AFTER INSERT OR UPDATE OR DELETE ON pricelookups
+  FOR EACH ROW EXECUTE PROCEDURE notify_plu_change();
+""", """
+DROP TRIGGER plu_changed ON pricelookups;
+DROP FUNCTION notify_plu_change();
+""")
+
+
 suppliers_seq = Sequence('suppliers_seq')
 
 
@@ -2028,6 +2493,76 @@ class Delivery(Base, Logged):
         return items
 
 
+accounts_export_seq = Sequence('accounts_export_seq')
+
+
+class AccountsExport(Base):
+    """Work waiting to be sent to the accounting system
+
+    Accounting integrations queue invoices and payments for sessions,
+    and bills for deliveries, here and send them in the background,
+    several at a time.  The queue is in the database so that work
+    isn't lost if the till is restarted before it has been sent.  A
+    row is deleted once it has been sent successfully.
+
+    Rows are sent from next_attempt onwards; if a row can't be sent
+    its next_attempt is moved later.  Rows that need someone to look
+    at them, for example because the accounting system rejected
+    them, are marked as failed and are not tried again until they
+    are retried by hand.
+
+    Rows are sent in batches.  Once a batch has been sent its rows
+    stay together until they have been sent successfully, so that if
+    the reply is lost exactly the same request can be made again.
+    """
+    __tablename__ = 'accounts_export_queue'
+    id = Column(Integer, accounts_export_seq, nullable=False,
+                primary_key=True)
+    kind = Column(String(), nullable=False)
+    sessionid = Column(
+        Integer, ForeignKey('sessions.sessionid', ondelete='CASCADE'),
+        nullable=True)
+    deliveryid = Column(
+        Integer, ForeignKey('deliveries.deliveryid', ondelete='CASCADE'),
+        nullable=True)
+    # For invoices: should the invoice be approved, if possible?
+    approve = Column(Boolean, nullable=False, server_default=literal(False))
+    queued = Column(DateTime, nullable=False,
+                    server_default=func.current_timestamp())
+    attempts = Column(Integer, nullable=False, server_default=literal(0))
+    next_attempt = Column(DateTime, nullable=False,
+                          server_default=func.current_timestamp())
+    last_error = Column(String(), nullable=True)
+    failed = Column(Boolean, nullable=False, server_default=literal(False))
+    # Set when a row is first sent; the rows of a batch are always
+    # sent together again if the reply is lost
+    batch = Column(String(), nullable=True)
+
+    session = relationship(Session)
+    delivery = relationship(Delivery)
+
+    __table_args__ = (
+        CheckConstraint(
+            "(kind IN ('invoice', 'payments') AND sessionid IS NOT NULL "
+            "AND deliveryid IS NULL) OR "
+            "(kind = 'bill' AND deliveryid IS NOT NULL "
+            "AND sessionid IS NULL)",
+            name="kind_matches_target"),
+    )
+
+    def __str__(self):
+        if self.kind == 'bill':
+            return f"bill for delivery {self.deliveryid}"
+        return f"{self.kind} for session {self.sessionid}"
+
+    @classmethod
+    def due(cls):
+        """Condition for rows that should be sent now
+        """
+        return (cls.failed == False) \
+            & (cls.next_attempt <= func.current_timestamp())
+
+
 stocktake_seq = Sequence('stocktake_seq')
 
 
@@ -2138,6 +2673,12 @@ class StockTake(Base, Logged):
         object_session(self).execute(exc)
 
     def commit_snapshot(self, user):
+        """Apply the stock take to the stock items in it
+
+        This is done with a few statements that each deal with all
+        the stock items at once, so it doesn't slow down as the stock
+        take gets bigger.
+        """
         if not self.start_time:
             return
         if self.commit_time:
@@ -2145,25 +2686,46 @@ class StockTake(Base, Logged):
         s = object_session(self)
         self.commit_time = func.current_timestamp()
         self.commit_user = user
-        for ss in self.snapshots:
-            if ss.finishcode:
-                ss.stockitem.finishcode = ss.finishcode
-                ss.stockitem.stockline = None
-                ss.stockitem.displayqty = None
-                if not ss.stockitem.finished:
-                    ss.stockitem.finished = func.current_timestamp()
-            if not ss.finishcode:
-                ss.stockitem.finishcode = None
-                ss.stockitem.finished = None
-            ss.stockitem.bestbefore = ss.newbestbefore
-            # XXX commit newdisplayqty once implemented, too
-            for a in ss.adjustments:
-                s.add(StockOut(
-                    stockitem=ss.stockitem,
-                    time=func.current_timestamp(),
-                    removecode=a.removecode,
-                    stocktake=self,
-                    qty=a.qty))
+        finished = StockTakeSnapshot.finishcode_id != None
+        # Items that stay on a stock line are logged by the
+        # log_stocktype rule; log each pair once first so that the
+        # multi-row update below can't insert duplicates
+        s.execute(
+            StockLineTypeLog.__table__.insert().from_select(
+                ['stocklineid', 'stocktype'],
+                select(StockItem.stocklineid, StockItem.stocktype_id)
+                .distinct()
+                .where(StockItem.id == StockTakeSnapshot.stock_id)
+                .where(StockTakeSnapshot.stocktake_id == self.id)
+                .where(StockItem.stocklineid != None)
+                .where(~finished)))
+        s.query(StockItem)\
+         .filter(StockItem.id == StockTakeSnapshot.stock_id)\
+         .filter(StockTakeSnapshot.stocktake_id == self.id)\
+         .update({
+             StockItem.finishcode_id: StockTakeSnapshot.finishcode_id,
+             StockItem.finished: case(
+                 (finished, func.coalesce(
+                     StockItem.finished, func.current_timestamp())),
+                 else_=None),
+             # Finished items come off sale
+             StockItem.stocklineid: case(
+                 (finished, None), else_=StockItem.stocklineid),
+             StockItem.displayqty: case(
+                 (finished, None), else_=StockItem.displayqty),
+             StockItem.bestbefore: StockTakeSnapshot.newbestbefore,
+             # XXX commit newdisplayqty once implemented, too
+         }, synchronize_session='fetch')
+        s.execute(
+            StockOut.__table__.insert().from_select(
+                ['stockid', 'removecode', 'stocktake_id', 'qty'],
+                select(StockTakeAdjustment.stock_id,
+                       StockTakeAdjustment.removecode_id,
+                       StockTakeAdjustment.stocktake_id,
+                       StockTakeAdjustment.qty)
+                .where(StockTakeAdjustment.stocktake_id == self.id)
+                .order_by(StockTakeAdjustment.stock_id,
+                          StockTakeAdjustment.removecode_id)))
         s.query(StockType).filter(StockType.stocktake == self).update({
             StockType.stocktake_id: None})
 
@@ -2746,7 +3308,7 @@ class StockItem(Base, Logged):
         return self.size - self.displayqty_or_zero
 
     # used and remaining column properties are added after the
-    # StockOut class is defined
+    # StockTotals class is defined
     @property
     def checkdigits(self):
         """Three digits that will annoy lazy staff
@@ -2970,49 +3532,156 @@ DROP FUNCTION notify_stockout_change();
 """)
 
 
+class StockTotals(Base):
+    """Running totals of the stock used from each stock item
+
+    Summing the stockout table every time we need to know how much of
+    a stock item remains gets slow once the table is large.  This
+    table holds the totals for each stock item that has at least one
+    stockout row; it is maintained by a trigger on the stockout table
+    and must not be written to directly.
+
+    Stock items with no stockout rows have no entry here.
+
+    "runtill checkdb" compares the totals against the stockout table.
+    """
+    __tablename__ = 'stock_totals'
+    stockid = Column(Integer, ForeignKey('stock.stockid', ondelete='CASCADE'),
+                     nullable=False, primary_key=True)
+    used = Column(quantity, nullable=False, server_default=text("0.0"))
+    sold = Column(quantity, nullable=False, server_default=text("0.0"))
+    firstsale = Column(DateTime, nullable=True)
+    lastsale = Column(DateTime, nullable=True)
+
+    @classmethod
+    def discrepancies(cls, session):
+        """Stock items whose totals do not match the stockout table
+
+        Returns a list of stock IDs.  This should always be empty; if
+        it isn't, the totals for each item can be fixed by calling the
+        stock_totals_recalculate() database function.  Must be passed
+        a suitable sqlalchemy session in which to run the query.
+        """
+        is_sold = StockOut.removecode_id == 'sold'
+        raw = select(
+            StockOut.stockid,
+            func.sum(StockOut.qty).label('used'),
+            func.sum(StockOut.qty).filter(is_sold).label('sold'),
+            func.min(StockOut.time).filter(is_sold).label('firstsale'),
+            func.max(StockOut.time).filter(is_sold).label('lastsale'))\
+            .group_by(StockOut.stockid)\
+            .subquery()
+        return session.execute(
+            select(func.coalesce(raw.c.stockid, cls.stockid))
+            .select_from(raw.join(
+                cls, cls.stockid == raw.c.stockid, full=True))
+            .where(
+                (func.coalesce(raw.c.used, 0) != func.coalesce(cls.used, 0))
+                | (func.coalesce(raw.c.sold, 0) != func.coalesce(cls.sold, 0))
+                | raw.c.firstsale.is_distinct_from(cls.firstsale)
+                | raw.c.lastsale.is_distinct_from(cls.lastsale))
+            .order_by(func.coalesce(raw.c.stockid, cls.stockid)))\
+            .scalars().all()
+
+
+# Inserts into stockout (almost every sale) update the totals
+# incrementally.  Updates and deletes are rare, and may move the time
+# of the first or last sale, so the totals for the affected items are
+# recalculated from scratch.
+add_ddl(metadata, """
+CREATE OR REPLACE FUNCTION stock_totals_recalculate(sid integer)
+  RETURNS void AS $$
+BEGIN
+  INSERT INTO stock_totals AS t (stockid, used, sold, firstsale, lastsale)
+    SELECT sid,
+      COALESCE(SUM(qty), 0.0),
+      COALESCE(SUM(qty) FILTER (WHERE removecode = 'sold'), 0.0),
+      MIN(time) FILTER (WHERE removecode = 'sold'),
+      MAX(time) FILTER (WHERE removecode = 'sold')
+    FROM stockout WHERE stockid = sid
+  ON CONFLICT (stockid) DO UPDATE SET
+    used = EXCLUDED.used,
+    sold = EXCLUDED.sold,
+    firstsale = EXCLUDED.firstsale,
+    lastsale = EXCLUDED.lastsale;
+END;
+$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION update_stock_totals() RETURNS trigger AS $$
+DECLARE
+BEGIN
+  IF (TG_OP = 'INSERT') THEN
+    INSERT INTO stock_totals AS t (stockid, used, sold, firstsale, lastsale)
+      VALUES (NEW.stockid, NEW.qty,
+        CASE WHEN NEW.removecode = 'sold' THEN NEW.qty ELSE 0.0 END,
+        CASE WHEN NEW.removecode = 'sold' THEN NEW.time END,
+        CASE WHEN NEW.removecode = 'sold' THEN NEW.time END)
+    ON CONFLICT (stockid) DO UPDATE SET
+      used = t.used + EXCLUDED.used,
+      sold = t.sold + EXCLUDED.sold,
+      firstsale = LEAST(t.firstsale, EXCLUDED.firstsale),
+      lastsale = GREATEST(t.lastsale, EXCLUDED.lastsale);
+  ELSE
+    PERFORM stock_totals_recalculate(OLD.stockid);
+    IF (TG_OP = 'UPDATE' AND NEW.stockid != OLD.stockid) THEN
+      PERFORM stock_totals_recalculate(NEW.stockid);
+    END IF;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER stock_totals_update
+  AFTER INSERT OR UPDATE OR DELETE ON stockout
+  FOR EACH ROW EXECUTE PROCEDURE update_stock_totals();
+""", """
+DROP TRIGGER stock_totals_update ON stockout;
+DROP FUNCTION update_stock_totals();
+DROP FUNCTION stock_totals_recalculate(integer);
+""")
+
+
+def _stock_total(column):
+    """Total from StockTotals for the stock item, or zero if none
+    """
+    return func.coalesce(
+        select(column)
+        .correlate(StockItem.__table__)
+        .where(StockTotals.stockid == StockItem.id)
+        .scalar_subquery(),
+        text("0.0"))
+
+
 # These are added to the StockItem class here because they refer
-# directly to the StockOut class, defined just above.
+# directly to the StockTotals class, defined just above.
 StockItem.used = column_property(
-    select(func.coalesce(func.sum(StockOut.qty), text("0.0")))
-    .correlate(StockItem.__table__)
-    .where(StockOut.stockid == StockItem.id)
-    .label('used'),
+    _stock_total(StockTotals.used).label('used'),
     deferred=True,
     group="qtys",
     doc="Amount of this item that has been used for any reason")
 
 StockItem.sold = column_property(
-    select(func.coalesce(func.sum(StockOut.qty), text("0.0")))
-    .correlate(StockItem.__table__)
-    .where(StockOut.stockid == StockItem.id)
-    .where(StockOut.removecode_id == "sold")
-    .label('sold'),
+    _stock_total(StockTotals.sold).label('sold'),
     deferred=True,
     group="qtys",
     doc="Amount of this item that has been used by being sold")
 
 StockItem.remaining = column_property(
-    select(StockItem.size - func.coalesce(func.sum(StockOut.qty), text("0.0")))
-    .where(StockOut.stockid == StockItem.id)
-    .label('remaining'),
+    (StockItem.size - _stock_total(StockTotals.used)).label('remaining'),
     deferred=True,
     group="qtys",
     doc="Amount of this item remaining")
 
 StockItem.firstsale = column_property(
-    select(func.min(StockOut.time))
+    select(StockTotals.firstsale)
     .correlate(StockItem.__table__)
-    .where(StockOut.stockid == StockItem.id)
-    .where(StockOut.removecode_id == 'sold')
+    .where(StockTotals.stockid == StockItem.id)
     .label('firstsale'),
     deferred=True,
     doc="Time of first sale of this item")
 
 StockItem.lastsale = column_property(
-    select(func.max(StockOut.time))
+    select(StockTotals.lastsale)
     .correlate(StockItem.__table__)
-    .where(StockOut.stockid == StockItem.id)
-    .where(StockOut.removecode_id == 'sold')
+    .where(StockTotals.stockid == StockItem.id)
     .label('lastsale'),
     deferred=True,
     doc="Time of last sale of this item")
@@ -3028,11 +3697,9 @@ StockType.instock = column_property(
     select(
         func.coalesce(
             func.sum(
-                StockItem.size - select(
-                    func.coalesce(func.sum(StockOut.qty), text("0.0")))
-                .where(StockOut.stockid == StockItem.id)
-                .scalar_subquery()),
+                StockItem.size - func.coalesce(StockTotals.used, text("0.0"))),
             text("0.0")))
+    .select_from(StockItem.__table__.outerjoin(StockTotals.__table__))
     .where(StockItem.stocktype_id == StockType.id,
            StockItem.finished == None,
            StockItem.stocklineid == None,
@@ -3051,11 +3718,9 @@ StockType.all_instock = column_property(
     select(
         func.coalesce(
             func.sum(
-                StockItem.size - select(
-                    func.coalesce(func.sum(StockOut.qty), text("0.0")))
-                .where(StockOut.stockid == StockItem.id)
-                .scalar_subquery()),
+                StockItem.size - func.coalesce(StockTotals.used, text("0.0"))),
             text("0.0")))
+    .select_from(StockItem.__table__.outerjoin(StockTotals.__table__))
     .where(StockItem.stocktype_id == StockType.id,
            StockItem.finished == None,
            StockItem.checked == True)
@@ -3075,6 +3740,340 @@ StockType.lastsale = column_property(
     doc="Date of last sale")
 
 
+class StockTypeSales(Base):
+    """Amount of each stock type sold on each day
+
+    The buying list needs the rate of sale of each stock type over
+    the last few months.  Working that out from the stockout table
+    means adding up every sale in the period, which is slow on a busy
+    till.  This table holds one row per stock type per day on which
+    it was sold; it is maintained by triggers on the stockout and
+    stock tables and must not be written to directly.
+
+    "runtill checkdb" compares the table against the stockout table.
+    """
+    __tablename__ = 'stocktype_sales'
+    stocktype_id = Column('stocktype', Integer,
+                          ForeignKey('stocktypes.stocktype',
+                                     ondelete='CASCADE'),
+                          nullable=False, primary_key=True)
+    date = Column(Date, nullable=False, primary_key=True)
+    sold = Column(quantity, nullable=False)
+
+    @classmethod
+    def discrepancies(cls, session):
+        """Days on which sales of a stock type do not match stockout
+
+        Returns a list of (stocktype ID, date) tuples.  This should
+        always be empty; if it isn't, each entry can be fixed by
+        calling the stocktype_sales_recalculate() database function.
+        Must be passed a suitable sqlalchemy session in which to run
+        the query.
+        """
+        day = func.cast(StockOut.time, Date)
+        raw = select(
+            StockItem.stocktype_id.label('stocktype'),
+            day.label('date'),
+            func.sum(StockOut.qty).label('sold'))\
+            .join(StockOut.stockitem)\
+            .where(StockOut.removecode_id == 'sold')\
+            .group_by(StockItem.stocktype_id, day)\
+            .subquery()
+        stocktype = func.coalesce(raw.c.stocktype, cls.stocktype_id)
+        date = func.coalesce(raw.c.date, cls.date)
+        return [tuple(r) for r in session.execute(
+            select(stocktype, date)
+            .select_from(raw.join(
+                cls, (cls.stocktype_id == raw.c.stocktype)
+                & (cls.date == raw.c.date), full=True))
+            .where(raw.c.sold.is_distinct_from(cls.sold))
+            .order_by(stocktype, date))]
+
+
+# Inserts into stockout (almost every sale) update the day's total
+# incrementally.  Updates and deletes, and moving a stock item to a
+# different stock type, are rare; the totals for the affected days
+# are recalculated from scratch.
+add_ddl(metadata, """
+CREATE OR REPLACE FUNCTION stocktype_sales_recalculate(st integer, d date)
+  RETURNS void AS $$
+BEGIN
+  DELETE FROM stocktype_sales WHERE stocktype = st AND date = d;
+  INSERT INTO stocktype_sales (stocktype, date, sold)
+    SELECT st, d, SUM(so.qty)
+    FROM stockout so JOIN stock s ON s.stockid = so.stockid
+    WHERE s.stocktype = st
+      AND so.removecode = 'sold'
+      AND CAST(so.time AS date) = d
+    HAVING COUNT(*) > 0;
+END;
+$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION update_stocktype_sales() RETURNS trigger AS $$
+DECLARE
+  st integer;
+BEGIN
+  IF (TG_OP = 'INSERT') THEN
+    IF (NEW.removecode = 'sold') THEN
+      SELECT stocktype INTO st FROM stock WHERE stockid = NEW.stockid;
+      INSERT INTO stocktype_sales AS t (stocktype, date, sold)
+        VALUES (st, CAST(NEW.time AS date), NEW.qty)
+      ON CONFLICT (stocktype, date) DO UPDATE SET
+        sold = t.sold + EXCLUDED.sold;
+    END IF;
+    RETURN NULL;
+  END IF;
+  IF (OLD.removecode = 'sold') THEN
+    SELECT stocktype INTO st FROM stock WHERE stockid = OLD.stockid;
+    PERFORM stocktype_sales_recalculate(st, CAST(OLD.time AS date));
+  END IF;
+  IF (TG_OP = 'UPDATE' AND NEW.removecode = 'sold') THEN
+    SELECT stocktype INTO st FROM stock WHERE stockid = NEW.stockid;
+    PERFORM stocktype_sales_recalculate(st, CAST(NEW.time AS date));
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER stocktype_sales_update
+  AFTER INSERT OR UPDATE OF stockid, qty, removecode, time OR DELETE
+  ON stockout
+  FOR EACH ROW EXECUTE PROCEDURE update_stocktype_sales();
+CREATE OR REPLACE FUNCTION move_stocktype_sales() RETURNS trigger AS $$
+DECLARE
+  d date;
+BEGIN
+  FOR d IN SELECT DISTINCT CAST(time AS date) FROM stockout
+      WHERE stockid = NEW.stockid AND removecode = 'sold' LOOP
+    PERFORM stocktype_sales_recalculate(OLD.stocktype, d);
+    PERFORM stocktype_sales_recalculate(NEW.stocktype, d);
+  END LOOP;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER stocktype_sales_move
+  AFTER UPDATE OF stocktype ON stock
+  FOR EACH ROW WHEN (OLD.stocktype != NEW.stocktype)
+  EXECUTE PROCEDURE move_stocktype_sales();
+""", """
+DROP TRIGGER stocktype_sales_move ON stock;
+DROP FUNCTION move_stocktype_sales();
+DROP TRIGGER stocktype_sales_update ON stockout;
+DROP FUNCTION update_stocktype_sales();
+DROP FUNCTION stocktype_sales_recalculate(integer, date);
+""")
+
+
+stock_valuation_seq = Sequence('stock_valuation_seq')
+
+
+class StockValuation(Base):
+    """The value of the stock on the premises at a point in time
+
+    Working out the value of the stock at a time in the past means
+    adding up everything used from each stock item before that time,
+    which gets slow once the stockout table is large.  A valuation
+    records the amount used from each stock item that was in stock,
+    and the total value of each department, at its time.  The value
+    at any later time can then be worked out from the nearest earlier
+    valuation and the stock used since.
+
+    Valuations are taken when a session ends, and by the "runtill
+    stockvalue" command.  Stock items are valued at their cost price
+    reduced in proportion to the amount used; only stock items that
+    arrived in a delivery are included.
+    """
+    __tablename__ = 'stock_valuations'
+    id = Column(Integer, stock_valuation_seq, nullable=False,
+                primary_key=True)
+    time = Column(DateTime, nullable=False, unique=True)
+
+    departments = relationship(
+        "StockValuationDepartment", back_populates="valuation",
+        order_by="StockValuationDepartment.dept_id",
+        cascade="all,delete-orphan", passive_deletes=True)
+
+    @property
+    def total(self):
+        return sum((d.value for d in self.departments), start=zero)
+
+    @classmethod
+    def nearest(cls, session, time):
+        """The latest valuation taken at or before time, or None
+        """
+        return session.query(cls)\
+                      .filter(cls.time <= time)\
+                      .order_by(cls.time.desc())\
+                      .first()
+
+    @classmethod
+    def items_at(cls, session, time):
+        """Stock items on the premises at a time
+
+        Returns a subquery with columns "stockid" and "used", giving
+        the amount used from each stock item before the time.
+        """
+        # XXX consider what happens for stock items discovered
+        # during a stock take — although their cost price will
+        # generally be null so will not affect this query.  The
+        # correct appropach would probably be to add a column
+        # property to StockItem for "delivery date" which can pull
+        # from the Delivery or StockTake as appropriate.
+        in_stock = (Delivery.date < time) & (
+            (StockItem.finished == None) | (StockItem.finished >= time))
+
+        def used_before(t):
+            return select(func.sum(StockOut.qty))\
+                .correlate(StockItem.__table__)\
+                .where(StockOut.stockid == StockItem.id)\
+                .where(StockOut.time < t)\
+                .scalar_subquery()
+
+        base = cls.nearest(session, time)
+        if not base:
+            return select(
+                StockItem.id.label('stockid'),
+                func.coalesce(used_before(time), text("0.0")).label('used'))\
+                .join(Delivery)\
+                .where(in_stock)\
+                .subquery()
+
+        # The condition on the date of the stockout row is redundant,
+        # but lets the database use the stockout_date_key index
+        day = func.cast(StockOut.time, Date)
+        since = select(StockOut.stockid, func.sum(StockOut.qty).label('qty'))\
+            .where(day >= base.time.date(), day <= time.date())\
+            .where(StockOut.time >= base.time, StockOut.time < time)\
+            .group_by(StockOut.stockid)\
+            .subquery()
+        # Items that weren't in stock when the base valuation was
+        # taken (usually because they were delivered since) need to
+        # have their usage before it added up in full
+        return select(
+            StockItem.id.label('stockid'),
+            (func.coalesce(StockValuationItem.used,
+                           used_before(base.time), text("0.0"))
+             + func.coalesce(since.c.qty, text("0.0"))).label('used'))\
+            .join(Delivery)\
+            .outerjoin(StockValuationItem,
+                       (StockValuationItem.valuation_id == base.id)
+                       & (StockValuationItem.stockid == StockItem.id))\
+            .outerjoin(since, since.c.stockid == StockItem.id)\
+            .where(in_stock)\
+            .subquery()
+
+    @classmethod
+    def department_values(cls, session, time):
+        """The value of the stock in each department at a time
+
+        Returns a list of (Department, value) tuples.
+        """
+        items = cls.items_at(session, time)
+        return session.query(Department, func.sum(
+            func.cast(
+                func.coalesce(StockItem.costprice, zero)
+                * ("1.0" - (items.c.used / StockItem.size)),
+                money)))\
+            .select_from(StockItem)\
+            .join(items, items.c.stockid == StockItem.id)\
+            .join(StockType)\
+            .join(Department)\
+            .group_by(Department)\
+            .order_by(Department.id)\
+            .all()
+
+    @classmethod
+    def take(cls, session, time=None):
+        """Record a valuation of the stock
+
+        The time defaults to now.  Does not commit.
+        """
+        time = time or datetime.datetime.now()
+        items = cls.items_at(session, time)
+        v = cls(time=time)
+        session.add(v)
+        session.flush()
+        session.execute(
+            StockValuationItem.__table__.insert().from_select(
+                ['valuation', 'stockid', 'used'],
+                select(literal(v.id), items.c.stockid, items.c.used)))
+        # This now starts from the item rows we've just added
+        for dept, value in cls.department_values(session, time):
+            v.departments.append(
+                StockValuationDepartment(department=dept, value=value))
+        session.flush()
+        return v
+
+    @classmethod
+    def discrepancies(cls, session):
+        """Valuations whose stock item usage does not match stockout
+
+        Returns a list of valuation IDs.  This should always be
+        empty; if it isn't, those valuations can be deleted, and
+        taken again if they are needed.  Must be passed a suitable
+        sqlalchemy session in which to run the query.
+        """
+        used = select(func.sum(StockOut.qty))\
+            .correlate(StockItem.__table__, cls.__table__)\
+            .where(StockOut.stockid == StockItem.id)\
+            .where(StockOut.time < cls.time)\
+            .scalar_subquery()
+        raw = select(
+            cls.id.label('valuation'),
+            StockItem.id.label('stockid'),
+            func.coalesce(used, text("0.0")).label('used'))\
+            .select_from(cls)\
+            .join(StockItem, literal(True))\
+            .join(Delivery, StockItem.deliveryid == Delivery.id)\
+            .where(Delivery.date < cls.time)\
+            .where((StockItem.finished == None)
+                   | (StockItem.finished >= cls.time))\
+            .subquery()
+        valuation = func.coalesce(raw.c.valuation,
+                                  StockValuationItem.valuation_id)
+        return session.execute(
+            select(valuation)
+            .select_from(raw.join(
+                StockValuationItem,
+                (StockValuationItem.valuation_id == raw.c.valuation)
+                & (StockValuationItem.stockid == raw.c.stockid),
+                full=True))
+            .where(raw.c.used.is_distinct_from(StockValuationItem.used))
+            .group_by(valuation)
+            .order_by(valuation))\
+            .scalars().all()
+
+    def __str__(self):
+        return f"Stock valuation at {self.time:%Y-%m-%d %H:%M}"
+
+
+class StockValuationItem(Base):
+    """Amount used from a stock item as at a stock valuation
+    """
+    __tablename__ = 'stock_valuation_items'
+    valuation_id = Column('valuation', Integer,
+                          ForeignKey('stock_valuations.id',
+                                     ondelete='CASCADE'),
+                          nullable=False, primary_key=True)
+    stockid = Column(Integer, ForeignKey('stock.stockid', ondelete='CASCADE'),
+                     nullable=False, primary_key=True)
+    used = Column(quantity, nullable=False)
+
+
+class StockValuationDepartment(Base):
+    """Value of the stock in a department as at a stock valuation
+    """
+    __tablename__ = 'stock_valuation_departments'
+    valuation_id = Column('valuation', Integer,
+                          ForeignKey('stock_valuations.id',
+                                     ondelete='CASCADE'),
+                          nullable=False, primary_key=True)
+    dept_id = Column('dept', Integer, ForeignKey('departments.dept'),
+                     nullable=False, primary_key=True)
+    value = Column(money, nullable=False)
+
+    valuation = relationship(StockValuation, back_populates="departments")
+    department = relationship(Department, lazy="joined")
+
+
 class StockTakeSnapshot(Base):
     """Snapshot of stock levels at the start of a stock take
 
@@ -3272,6 +4271,30 @@ class KeyboardBinding(Base):
         return object_session(self).get(KeyCap, self.keycode)
 
 
+add_ddl(KeyboardBinding.__table__, """
+CREATE OR REPLACE FUNCTION notify_keyboard_change() RETURNS trigger AS $$
+DECLARE
+BEGIN
+  IF (TG_OP = 'DELETE') THEN
+    PERFORM pg_notify('keyboard_change', OLD.keycode);
+  ELSE
+    PERFORM pg_notify('keyboard_change', NEW.keycode);
+    IF (TG_OP = 'UPDATE' AND OLD.keycode != NEW.keycode) THEN
+      PERFORM pg_notify('keyboard_change', OLD.keycode);
+    END IF;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER keyboard_changed
+  AFTER INSERT OR UPDATE OR DELETE ON keyboard
+  FOR EACH ROW EXECUTE PROCEDURE notify_keyboard_change();
+""", """
+DROP TRIGGER keyboard_changed ON keyboard;
+DROP FUNCTION notify_keyboard_change();
+""")
+
+
 class KeyCap(Base):
     __tablename__ = 'keycaps'
     keycode = Column(String(20), nullable=False, primary_key=True)
@@ -6,9 +6,17 @@ Passwords are stored as strings of the form
 This format is compatible with Django, and the default pbkdf2_sha256
 algorithm implemented in this module is compatible with
 `django.contrib.auth.hashers.PBKDF2PasswordHasher`
+
+Checking a password takes deliberately long; the till checks
+passwords in a worker thread so that the user interface isn't held up.
+The number of iterations used for new hashes can be chosen to suit the
+slowest till hardware using calibrate().  Hashes with a different
+number of iterations still check correctly; must_update() says whether
+a hash should be replaced the next time the user logs in.
 """
 
 import secrets
+import time
 import hashlib
 import math
 import base64
@@ -31,13 +39,14 @@ def get_hasher(algorithm):
     raise ValueError(f"Unknown password hashing algorithm {algorithm}")
 
 
-def encode_password(password, algorithm=None):
+def encode_password(password, algorithm=None, iterations=None):
     """Computes the password hash for storage in the database.
 
     Returns a string in the format `algorithm$iterations$salt$hash`.
+    If iterations is not specified, the hasher's default is used.
     """
     hasher = get_hasher(algorithm)
-    return hasher.encode(password, hasher.salt())
+    return hasher.encode(password, hasher.salt(), iterations)
 
 
 def check_password(password, encoded):
@@ -47,6 +56,28 @@ def check_password(password, encoded):
     return hasher.verify(password, encoded)
 
 
+def must_update(encoded, algorithm=None, iterations=None):
+    """Should an encoded password be replaced?
+
+    Returns True if the password was not encoded using the specified
+    algorithm and number of iterations; in that case it should be
+    encoded again the next time the plain text password is available.
+    """
+    hasher = get_hasher(algorithm)
+    if identify_hasher(encoded).algorithm != hasher.algorithm:
+        return True
+    return hasher.must_update(encoded, iterations)
+
+
+def calibrate(target_time, algorithm=None):
+    """Work out how many iterations take target_time seconds
+
+    The answer is for this machine, so this should be run on the
+    slowest machine that will need to check passwords.
+    """
+    return get_hasher(algorithm).calibrate(target_time)
+
+
 class PasswordHasher(metaclass=plugins.ClassPluginMount):
     algorithm = None
     salt_entropy = 128
@@ -58,13 +89,21 @@ class PasswordHasher(metaclass=plugins.ClassPluginMount):
     def verify(self, password, encoded):
         raise NotImplementedError("provide a verify() method")
 
-    def encode(self, password, salt):
+    def encode(self, password, salt, iterations=None):
         raise NotImplementedError("provide an encode() method")
 
+    def must_update(self, encoded, iterations=None):
+        return False
+
+    def calibrate(self, target_time):
+        raise NotImplementedError("provide a calibrate() method")
+
 
 class PBKDF2Hasher(PasswordHasher):
     algorithm = "pbkdf2_sha256"
     iterations = 100000
+    # calibrate() will not suggest fewer iterations than this
+    min_iterations = 10000
 
     def encode(self, password, salt, iterations=None):
         iterations = iterations or self.iterations
@@ -80,3 +119,22 @@ class PBKDF2Hasher(PasswordHasher):
         assert algorithm == self.algorithm
         reencoded = self.encode(password, salt, iterations)
         return encoded == reencoded
+
+    def must_update(self, encoded, iterations=None):
+        stored = int(encoded.split("$", 2)[1])
+        return stored != (iterations or self.iterations)
+
+    def calibrate(self, target_time):
+        # Time a short run a few times and take the fastest, to
+        # reduce the effect of anything else the machine is doing
+        sample = self.min_iterations
+        elapsed = min(self._time_encode(sample) for _ in range(3))
+        iterations = int(sample * target_time / elapsed)
+        # Round to two significant figures
+        iterations = round(iterations, 1 - len(str(iterations)))
+        return max(iterations, self.min_iterations)
+
+    def _time_encode(self, iterations):
+        start = time.perf_counter()
+        self.encode("password", self.salt(), iterations)
+        return time.perf_counter() - start
@@ -1,4 +1,7 @@
 import socket
+import select
+import threading
+import time
 import tempfile
 import io
 import textwrap
@@ -8,6 +11,8 @@ import array
 import sys
 import cups
 import glob
+import hashlib
+import collections
 try:
     import qrcode
     _qrcode_supported = True
@@ -112,6 +117,7 @@ class QRCodeElement(ReceiptElement):
 
 class ImageElement(ReceiptElement):
     def __init__(self, image):
+        self.image = image
         self.image_data = io.BytesIO(image)
 
     def __str__(self):
@@ -427,11 +433,42 @@ class autodetect_printer:
 
 class netprinter(printer):
     """Print to a network socket.  connection is a (hostname, port) tuple.
+
+    Each job is sent over a new connection that is closed as soon as
+    the job has been sent, so that other tills sharing the printer
+    can use it in between.  If keepalive is True the connection is
+    instead kept open between jobs, and closed after it has been idle
+    for idle_timeout seconds; this saves connecting for every job, but
+    nobody else can use the printer while the connection is open.
+
+    Whether the printer is online is checked by connecting to it from
+    a background thread, at most once every probe_interval seconds
+    and only when somebody asks; the outcome of each job counts as a
+    check.  offline() returns the most recent result without waiting
+    for the network; until the first check has finished, the printer
+    is assumed to be online.
     """
+    connect_timeout = 2
+    io_timeout = 10
+
     def __init__(self, connection, driver, description=None,
-                 family=socket.AF_INET):
+                 family=socket.AF_INET, keepalive=False,
+                 probe_interval=60, idle_timeout=30):
         self._connection = connection
         self._family = family
+        self._keepalive = keepalive
+        self._probe_interval = probe_interval
+        self._idle_timeout = idle_timeout
+        # Held while using or replacing the connection
+        self._lock = threading.Lock()
+        self._socket = None
+        self._file = None
+        self._last_used = None
+        self._idle_timer = None
+        # None if online, otherwise a description of the problem
+        self._status = None
+        self._status_time = None
+        self._probe_thread = None
         super().__init__(driver, description=description)
 
     def __str__(self):
@@ -443,38 +480,172 @@ class netprinter(printer):
         If the printer is unavailable for any reason, return a description
         of that reason; otherwise return None.
         """
-        host = self._connection[0]
-        if not test_ping(host):
-            return f"Printer {host} did not respond to ping"
+        if self._status_time is None \
+           or time.monotonic() - self._status_time > self._probe_interval:
+            self._start_probe()
+        return self._status
 
-    def _connect(self):
-        s = socket.socket(self._family)
-        s.connect(self._connection)
-        f = s.makefile('wb')
-        return s, f
+    def _set_status(self, status):
+        if status != self._status:
+            if status:
+                log.info("%s: offline: %s", self, status)
+            else:
+                log.info("%s: online", self)
+        self._status = status
+        self._status_time = time.monotonic()
 
-    # XXX there's too much copy-and-paste here for my liking
-    def print_canvas(self, canvas):
-        offline = self.offline()
-        if offline:
-            raise PrinterError(self, offline)
-        s, f = self._connect()
+    def _start_probe(self):
+        if self._probe_thread and self._probe_thread.is_alive():
+            return
+        self._probe_thread = threading.Thread(
+            target=self._probe_in_thread, name=f"probe {self._connection}",
+            daemon=True)
+        self._probe_thread.start()
+
+    def _probe_in_thread(self):
         try:
-            self._driver.process_canvas(canvas, f)
+            self._probe()
+        except Exception:
+            log.exception("%s: probe failed", self)
+
+    def _probe(self):
+        # If the lock is held the printer is in use, and the outcome
+        # of that job will update the status
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self._socket and self._connection_alive():
+                self._set_status(None)
+                return
+            try:
+                self._open_socket().close()
+                self._set_status(None)
+            except OSError as e:
+                self._set_status(f"Could not connect to printer: {e}")
         finally:
-            f.close()
+            self._lock.release()
+
+    def _connection_alive(self):
+        """Check the persistent connection without blocking
+
+        Discards anything the printer has sent us, for example
+        automatic status reports.  Closes the connection and returns
+        False if the printer has closed it or it is in an error state.
+        """
+        try:
+            while select.select([self._socket], [], [], 0)[0]:
+                if not self._socket.recv(1024):
+                    self._disconnect()
+                    return False
+        except OSError:
+            self._disconnect()
+            return False
+        return True
+
+    def _open_socket(self):
+        s = socket.socket(self._family)
+        s.settimeout(self.connect_timeout)
+        try:
+            s.connect(self._connection)
+        except Exception:
             s.close()
+            raise
+        return s
 
-    def kickout(self):
-        offline = self.offline()
-        if offline:
-            raise PrinterError(self, offline)
-        s, f = self._connect()
+    def _connect(self):
+        # Must be called with the lock held
+        if self._socket and self._connection_alive():
+            return self._file
         try:
-            self._driver.kickout(f)
+            s = self._open_socket()
+        except OSError as e:
+            self._set_status(f"Could not connect to printer: {e}")
+            raise PrinterError(self, self._status)
+        s.settimeout(self.io_timeout)
+        self._socket = s
+        self._file = s.makefile('wb')
+        return self._file
+
+    def _disconnect(self):
+        # Must be called with the lock held
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._socket.close()
+        self._socket = None
+        self._file = None
+
+    def _close_if_idle(self):
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self._socket and \
+               time.monotonic() - self._last_used >= self._idle_timeout:
+                self._disconnect()
+        finally:
+            self._lock.release()
+
+    def _send_kept_open(self, func):
+        # Must be called with the lock held
+        f = self._connect()
+        try:
+            func(f)
+            f.flush()
+        except OSError as e:
+            self._disconnect()
+            self._set_status(f"Error sending to printer: {e}")
+            raise PrinterError(self, self._status)
+        self._last_used = time.monotonic()
+        self._set_status(None)
+        if self._idle_timer:
+            self._idle_timer.cancel()
+        self._idle_timer = threading.Timer(
+            self._idle_timeout, self._close_if_idle)
+        self._idle_timer.daemon = True
+        self._idle_timer.start()
+
+    def _send_once(self, func):
+        try:
+            s = self._open_socket()
+        except OSError as e:
+            self._set_status(f"Could not connect to printer: {e}")
+            raise PrinterError(self, self._status)
+        try:
+            s.settimeout(self.io_timeout)
+            with s.makefile('wb') as f:
+                func(f)
+        except OSError as e:
+            self._set_status(f"Error sending to printer: {e}")
+            raise PrinterError(self, self._status)
         finally:
-            f.close()
             s.close()
+        self._set_status(None)
+
+    def _send(self, func, wait=True):
+        if not self._lock.acquire(blocking=wait):
+            # The printer is busy and the caller can't wait for it:
+            # try a connection of our own
+            self._send_once(func)
+            return
+        try:
+            if self._keepalive:
+                self._send_kept_open(func)
+            else:
+                self._send_once(func)
+        finally:
+            self._lock.release()
+
+    # There's no need to check offline() before sending: connecting
+    # to the printer is the check, and it doesn't leave us waiting
+    # for the next probe after the printer comes back.
+    def print_canvas(self, canvas):
+        self._send(lambda f: self._driver.process_canvas(canvas, f))
+
+    def kickout(self):
+        # Don't wait for a print job that is in progress: the drawer
+        # should open straight away
+        self._send(self._driver.kickout, wait=False)
 
 
 class tmpfileprinter(printer):
@@ -572,6 +743,21 @@ class cupsprinter(printer):
         f.close()
 
 
+# Images converted to ESC/POS commands by escpos drivers, keyed by
+# (hash of image file, dots per line).  The same logo is usually
+# printed on every receipt.
+_raster_cache = collections.OrderedDict()
+_raster_cache_size = 8
+_raster_cache_lock = threading.Lock()
+
+
+def clear_image_cache():
+    """Forget all images converted for printing
+    """
+    with _raster_cache_lock:
+        _raster_cache.clear()
+
+
 class escpos:
     """The ESC/POS protocol for controlling receipt printers.
     """
@@ -694,8 +880,8 @@ class escpos:
                         ("%s%s%s%s%s\n" % (
                             left, ' ' * padl, center, ' ' * padr, right))
                         .encode(self.coding))
-            elif hasattr(i, 'image_data'):
-                self._image(i.image_data, f)
+            elif hasattr(i, 'image'):
+                self._image(i.image, f)
             elif hasattr(i, 'qrcode_data'):
                 self._qrcode(i.qrcode_data, f)
             else:
@@ -709,10 +895,28 @@ class escpos:
             f.flush()
 
     def _image(self, image, f):
+        key = (hashlib.sha256(image).digest(), self.dpl)
+        with _raster_cache_lock:
+            raster = _raster_cache.get(key)
+            if raster is not None:
+                _raster_cache.move_to_end(key)
+        if raster is None:
+            raster = self._rasterise(image)
+            with _raster_cache_lock:
+                _raster_cache[key] = raster
+                while len(_raster_cache) > _raster_cache_size:
+                    _raster_cache.popitem(last=False)
+        f.write(raster)
+
+    def _rasterise(self, image):
+        """Convert an image file to ESC/POS commands to print it
+
+        Returns the commands as bytes.
+        """
         try:
-            image = Image.open(image)
+            image = Image.open(io.BytesIO(image))
         except Exception:
-            return
+            return b''
 
         # If image is too wide, resize it
         if image.size[0] > self.dpl:
@@ -739,39 +943,30 @@ class escpos:
         # Remove colour
         primg = primg.convert("L")
 
-        # Convert to black and white
+        # Convert to black and white: 1 bits are black
         primg = ImageOps.invert(primg).convert("1")
 
         # Update width and height from padded image
         width, height = primg.size
 
-        # data is an iterator yielding pixel values, 0 for white and
-        # 255 for black
-        data = iter(primg.getdata())
-
         # Set up printer for image output
-        f.write(escpos.ep_line_spacing_none)
-        f.write(escpos.ep_unidirectional_on)
-        width_info = width.to_bytes(length=2, byteorder="little")
-
-        # Process image as rows of 24 lines each
-        def _readline():
-            return [bool(next(data)) for _ in range(width)]
-        try:
-            while True:
-                lines = [_readline() for _ in range(24)]
-                row = b''.join(
-                    int(''.join("1" if bit else "0" for bit in column),
-                        base=2).to_bytes(length=3, byteorder="big")
-                    for column in zip(*lines))
-                f.write(escpos.ep_bitimage_dd_v24 + width_info + row + b'\n')
-        except StopIteration:
-            pass
+        out = [escpos.ep_line_spacing_none, escpos.ep_unidirectional_on]
+        header = escpos.ep_bitimage_dd_v24 \
+            + width.to_bytes(length=2, byteorder="little")
+
+        # Process image as rows of 24 lines each.  The printer wants
+        # each column of a row as three bytes, top dot in the most
+        # significant bit: that's exactly how PIL packs the rows of
+        # the transposed row.
+        for y in range(0, height, 24):
+            row = primg.crop((0, y, width, y + 24))\
+                       .transpose(Image.Transpose.TRANSPOSE).tobytes()
+            out.append(header + row + b'\n')
 
         # Restore regular output settings and make a small gap
-        f.write(escpos.ep_unidirectional_off)
-        f.write(escpos.ep_line_spacing_default)
-        f.write(b'\r\n')
+        out += [escpos.ep_unidirectional_off, escpos.ep_line_spacing_default,
+                b'\r\n']
+        return b''.join(out)
 
     def _qrcode_native(self, data, f):
         # Set the size of a "module", in dots.  The default is apparently
@@ -840,6 +1035,11 @@ class escpos:
         f.write(self._ep_2d_cmd(49, 81, 48))
         f.write(escpos.ep_left)
 
+    # Dots printed for each pair of modules in the emulated QR code,
+    # indexed by 2 * top module + bottom module; a bytes.translate()
+    # table
+    _qrcode_emulated_dots = bytes([0x00, 0x1c, 0xe0, 0xfc]) + bytes(252)
+
     def _qrcode_emulated(self, data, f):
         if not _qrcode_supported:
             f.write("qrcode library not installed".encode(self.coding))
@@ -848,40 +1048,36 @@ class escpos:
                           error_correction=qrcode.constants.ERROR_CORRECT_H)
         q.add_data(data)
         code = q.get_matrix()
-        f.write(escpos.ep_unidirectional_on)
+        out = bytearray(escpos.ep_unidirectional_on)
         # To get a good print, we print two rows at a time - but only
         # feed the paper through by one row.  This means that each
         # part of the code should be printed twice.  We're also
         # printing each pair of rows twice, advancing the paper by
         # half a dot in between.  We only use 6 of the 8 pins of the
-        # printer to keep this code simple.
-        lt = {
-            (False, False): bytes([0x00]),
-            (False, True): bytes([0x1c]),
-            (True, False): bytes([0xe0]),
-            (True, True): bytes([0xfc]),
-        }
-        while len(code) > 0:
-            if len(code) > 1:
-                row = zip(code[0], code[1])
-            else:
-                row = zip(code[0], [False] * len(code[0]))
-            code = code[1:]
-            row = b''.join(lt[x] * 3 for x in row)
-            width = len(row)
-            if width > self.dpl:
-                # Code too wide for paper
-                break
+        # printer to keep this code simple.  Each module is three
+        # dots wide.
+        modules = len(code[0])
+        width = modules * 3
+        if width <= self.dpl:
             padding = (self.dpl - width) // 2
-            width = width + padding
-            padchars = bytes([0]) * padding
             header = escpos.ep_bitimage_sd \
-                + bytes([width & 0xff, (width >> 8) & 0xff])
-            f.write(header + padchars + row + b'\r')
-            f.write(escpos.ep_half_dot_feed)
-            f.write(header + padchars + row + b'\r')
-            f.write(escpos.ep_short_feed)
-        f.write(escpos.ep_unidirectional_off)
+                + (width + padding).to_bytes(length=2, byteorder="little") \
+                + bytes(padding)
+            # Each row of the matrix as an integer with one byte per
+            # module, 1 for black and 0 for white
+            rows = [int.from_bytes(bytes(row), "big") for row in code] + [0]
+            dots = bytearray(width)
+            for top, bottom in zip(rows, rows[1:]):
+                # No carries: each byte of the sum is at most 3
+                pair = (top * 2 + bottom).to_bytes(modules, "big")\
+                                         .translate(self._qrcode_emulated_dots)
+                dots[0::3] = pair
+                dots[1::3] = pair
+                dots[2::3] = pair
+                out += header + dots + b'\r' + escpos.ep_half_dot_feed
+                out += header + dots + b'\r' + escpos.ep_short_feed
+        out += escpos.ep_unidirectional_off
+        f.write(out)
 
     def kickout(self, f):
         f.write(escpos.ep_pulse)
@@ -16,6 +16,29 @@ checkdigit_print = config.BooleanConfigItem(
     description="Should check digits be printed on stock labels?")
 
 
+# The decoded publogo, kept until the config item changes
+_publogo = None
+
+
+def publogo():
+    """The pub logo image file, or None if there isn't one
+    """
+    global _publogo
+    if _publogo is None:
+        logo = tillconfig.publogo()
+        _publogo = base64.b64decode(logo) if logo else b''
+    return _publogo or None
+
+
+def _publogo_changed():
+    global _publogo
+    _publogo = None
+    pdrivers.clear_image_cache()
+
+
+tillconfig.publogo.notify_on_change(_publogo_changed)
+
+
 # All of these functions assume there's a database session in td.s
 # This should be the case if called during a keypress!  If being used
 # in any other context, use with td.orm_session(): around the call.
@@ -27,8 +50,8 @@ def print_receipt(printer, transid):
     if not trans.lines and not trans.payments:
         return
     with printer as d:
-        if tillconfig.publogo():
-            image = base64.b64decode(tillconfig.publogo())
+        image = publogo()
+        if image:
             d.printimage(image)
         d.printline(f"\t{tillconfig.pubname}", emph=1)
         for i in tillconfig.pubaddr().splitlines():
@@ -329,14 +352,19 @@ def print_restock_list(printer, rl):
 def kickout(drawer):
     """Kick out the cash drawer.
 
-    Returns True if successful.
+    The drawer is kicked out from a worker thread, so that the till
+    doesn't wait for the printer it is attached to.  If it can't be
+    kicked out the user is told once the attempt has failed.
     """
+    tillconfig.mainloop.run_in_worker(
+        drawer.kickout, _kickout_done, desc="kick out cash drawer")
+
+
+def _kickout_done(future):
     with ui.exception_guard("kicking out the cash drawer",
                             title="Printer error"):
         try:
-            drawer.kickout()
+            future.result()
         except pdrivers.PrinterError as e:
             ui.infopopup([f"Could not kick out the cash drawer: {e.desc}"],
                          title="Printer problem")
-            return False
-    return True
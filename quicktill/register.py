@@ -30,7 +30,7 @@
 from . import tillconfig
 import math
 import time
-from . import td, ui, keyboard, printer
+from . import td, ui, keyboard, printer, spooler
 import quicktill.stocktype
 from . import linekeys
 from . import modifiers
@@ -410,6 +410,10 @@ class tline(ui.lrline):
         tl = td.s.get(Transline, self.transline)
         self.transtime = tl.time
         self.protected = tl.protected
+        # Contribution of this line to the transaction totals; the
+        # register adds these up instead of querying the database
+        self.total = tl.items * tl.amount
+        self.discount_total = tl.items * tl.discount
         if tl.voided_by_id:
             self.voided = True
             self.ltext = "(Voided) " + tl.description
@@ -922,7 +926,6 @@ class page(ui.basicpage):
                     .options(joinedload(Transaction.lines)
                              .joinedload(Transline.user))\
                     .options(joinedload(Transaction.meta))\
-                    .options(undefer(Transaction.total))\
                     .one()
         self.transid = trans.id
         if trans.user:
@@ -950,7 +953,10 @@ class page(ui.basicpage):
                 self.transaction_locked.append("")
                 self.transaction_locked.append(open_transaction_lock_message())
         self._redraw_note()
-        self.close_if_balanced()
+        # The display list was built from the lines and payments we
+        # have just loaded, so there is no need to check the totals
+        # against the database before closing
+        self.close_if_balanced(verify=False)
         self.repeat = None
         self.update_balance()
         self.prompt = self.defaultprompt
@@ -995,9 +1001,34 @@ class page(ui.basicpage):
         # the caller is almost certainly going to do other things first).
         self.s.cursor = len(self.dl)
 
+    def running_totals(self):
+        """Totals for the current transaction
+
+        Returns (total, discount_total, payments_total).  These are
+        added up from the lines and payments on the display, each of
+        which records its own contribution when it is created or
+        updated, so this does not query the database.  They are
+        checked against the database before the transaction is
+        closed.
+        """
+        total = zero
+        discount_total = zero
+        payments_total = zero
+        for l in self.dl:
+            if isinstance(l, tline):
+                total += l.total
+                discount_total += l.discount_total
+            elif isinstance(l, payment.pline):
+                payments_total += l.amount
+        return total, discount_total, payments_total
+
     def update_balance(self):
         trans = self._gettrans()
-        self.balance = trans.balance if trans else zero
+        if trans:
+            total, _, payments_total = self.running_totals()
+            self.balance = total - payments_total
+        else:
+            self.balance = zero
         if self.balance < zero:
             self.current_refund_help_text = refund_help_text()
             for i in RegisterPlugin.instances:
@@ -1006,11 +1037,41 @@ class page(ui.basicpage):
                     self.current_refund_help_text = x
                     break
 
-    def close_if_balanced(self):
+    def _running_totals_consistent(self, trans):
+        """Check the running totals against the database
+        """
+        running = self.running_totals()
+        td.s.expire(trans, ['total', 'discount_total', 'payments_total'])
+        stored = tuple(td.s.query(Transaction.total,
+                                  Transaction.discount_total,
+                                  Transaction.payments_total)
+                       .filter(Transaction.id == trans.id)
+                       .one())
+        if running == stored:
+            return True
+        log.error("Register: running totals %s for transaction %d do not "
+                  "match database totals %s", running, trans.id, stored)
+        return False
+
+    def close_if_balanced(self, verify=True):
+        """Close the current transaction if it is balanced
+
+        Unless verify is False, the running totals are checked against
+        the database first.  If they don't match, the transaction is
+        reloaded from the database, which closes it if the stored
+        totals balance.
+        """
         trans = self._gettrans()
-        if trans and not trans.closed \
-           and (trans.lines or trans.payments) \
-           and trans.total == trans.payments_total:
+        if trans and not trans.closed and self.dl:
+            # The database may have changed in ways the running totals
+            # don't know about, so check them before deciding whether
+            # the transaction is balanced
+            if verify and not self._running_totals_consistent(trans):
+                self._loadtrans(trans.id)
+                return
+            total, _, payments_total = self.running_totals()
+            if total != payments_total:
+                return
             # XXX check that there are no pending payments
             if self.hook("close_transaction", trans):
                 return
@@ -1277,7 +1338,6 @@ class page(ui.basicpage):
             user.log(f"Price override on {plu.logref} to "
                      f"{tillconfig.fc(sale.price)} for transaction "
                      f"line {tl.logref}")
-        td.s.refresh(tl, ['time'])  # load time from database
         self.dl.append(tline(tl.id))
         self.repeat = repeatinfo(plu=plu.id, mod=mod)
         td.s.expire(trans, ['total'])
@@ -1287,6 +1347,34 @@ class page(ui.basicpage):
         self.prompt = self.defaultprompt
         self._redraw()
 
+    def _add_stock_sale(self, trans, items, sale, sell):
+        """Add a transaction line for a sale of stock
+
+        sell is a list of (stockitem, qty) pairs as returned by
+        calculate_sale().  The transaction line and all its stock
+        usage records are sent to the database in a single flush.
+        Returns the new transaction line.
+        """
+        tl = Transline(
+            transaction=trans, items=items,
+            amount=sale.price,
+            department=sale.stocktype.department,
+            transcode='S', text=sale.description,
+            user=self.user.dbuser,
+            source=tillconfig.terminal_name)
+        td.s.add(tl)
+        removecode_id = sold_removecode_id()
+        for stockitem, items_to_sell in sell:
+            td.s.add(StockOut(
+                transline=tl, stockitem=stockitem,
+                qty=items_to_sell, removecode_id=removecode_id))
+            td.s.expire(
+                stockitem,
+                ['used', 'sold', 'remaining', 'firstsale', 'lastsale'])
+        self._apply_discount(tl)
+        td.s.flush()
+        return tl
+
     @user.permission_required('sell-stocktype', 'Sell a type of stock')
     def _sell_stocktype(self, stocktype, mod):
         st = stocktype
@@ -1427,30 +1515,12 @@ class page(ui.basicpage):
                          f" of {stockitem.stocktype} in one go."],
                         title="Error")
                     return
-            tl = Transline(
-                transaction=trans, items=items,
-                amount=sale.price,
-                department=sale.stocktype.department,
-                transcode='S', text=sale.description,
-                user=self.user.dbuser,
-                source=tillconfig.terminal_name)
-            td.s.add(tl)
-            for stockitem, items_to_sell in sell:
-                so = StockOut(
-                    transline=tl, stockitem=stockitem,
-                    qty=items_to_sell, removecode_id=sold_removecode_id())
-                td.s.add(so)
-                td.s.expire(
-                    stockitem,
-                    ['used', 'sold', 'remaining', 'firstsale', 'lastsale'])
-            self._apply_discount(tl)
-            td.s.flush()
+            tl = self._add_stock_sale(trans, items, sale, sell)
             if explicitprice:
                 logmsg = f"Price override to {tillconfig.fc(sale.price)} " \
                     f"for transaction line {tl.logref} stock item "
                 for stockitem, items_to_sell in sell:
                     user.log(logmsg + stockitem.logref)
-            td.s.refresh(tl, ['time'])  # load time from database
             self.dl.append(tline(tl.id))
 
         self.repeat = repeatinfo(stocktype_id=st.id, mod=mod)
@@ -1629,7 +1699,14 @@ class page(ui.basicpage):
             # pullthrough; the lastsale time will change once we start
             # committing StockOut objects to the database.
             item = sell[0][0]
-            if td.stock_checkpullthru(item.id, '11:00:00'):
+            # The time of the last sale of the item was loaded along
+            # with the stockline; if it was recent there's no need to
+            # ask the database about pullthroughs as well.
+            sold_recently = item.lastsale and \
+                datetime.datetime.now() - item.lastsale \
+                < datetime.timedelta(hours=11)
+            if not sold_recently \
+               and td.stock_checkpullthru(item.id, '11:00:00'):
                 unit = item.stocktype.unit
                 ui.infopopup(
                     [f"According to the till records, {item.stocktype} "
@@ -1657,46 +1734,29 @@ class page(ui.basicpage):
                          f"{stockitem.stocktype} in one go."],
                         title="Error")
                     return
-            tl = Transline(
-                transaction=trans, items=items,
-                amount=sale.price,
-                department=sale.stocktype.department,
-                transcode='S', text=sale.description,
-                user=self.user.dbuser,
-                source=tillconfig.terminal_name)
-            td.s.add(tl)
-            for stockitem, items_to_sell in sell:
-                so = StockOut(
-                    transline=tl, stockitem=stockitem,
-                    qty=items_to_sell, removecode_id=sold_removecode_id())
-                td.s.add(so)
-                td.s.expire(
-                    stockitem,
-                    ['used', 'sold', 'remaining', 'firstsale', 'lastsale'])
-            self._apply_discount(tl)
-            td.s.flush()
+            tl = self._add_stock_sale(trans, items, sale, sell)
             if explicitprice:
                 logmsg = f"Price override to {tillconfig.fc(sale.price)} " \
                     f"for transaction line {tl.logref} stock item "
                 for stockitem, items_to_sell in sell:
                     user.log(logmsg + stockitem.logref)
-            td.s.refresh(tl, ['time'])  # load time from database
             self.dl.append(tline(tl.id))
 
         self.repeat = repeatinfo(stocklineid=stockline.id, mod=mod)
 
         if stockline.linetype == "regular":
-            # We are using the last value of so from either the
-            # previous for loop, or the handling of may_repeat
-            stockitem = so.stockitem
+            # Regular stocklines sell from a single item.
+            # calculate_sale() has already worked out how much of it
+            # is left, so there's no need to ask the database again.
+            stockitem = sell[0][0]
             unit = stockitem.stocktype.unit
             self.prompt = f"{stockline.name}: "\
-                f"{unit.format_stock_qty(stockitem.remaining)} "\
+                f"{unit.format_stock_qty(remaining)} "\
                 f"of {stockitem.stocktype} remaining"
-            if stockitem.remaining < Decimal("0.0"):
+            if remaining < Decimal("0.0"):
                 user.log(f"Negative stock level on {stockline.logref}: "
                          f"Item {stockitem.logref} has "
-                         f"{unit.format_stock_qty(stockitem.remaining)} "
+                         f"{unit.format_stock_qty(remaining)} "
                          f"remaining")
                 ui.infopopup(
                     ["There appears to be {} of {} left!  Please "
@@ -1704,7 +1764,7 @@ class page(ui.basicpage):
                      "started using a new item, tell the till about it "
                      "using the '{}' button after dismissing this "
                      "message.".format(
-                         unit.format_stock_qty(stockitem.remaining),
+                         unit.format_stock_qty(remaining),
                          stockitem.stocktype,
                          stockitem.id,
                          keyboard.K_USESTOCK),
@@ -1898,10 +1958,10 @@ class page(ui.basicpage):
                     if self.hook("nosale"):
                         return
                     if tillconfig.cash_drawer:
-                        if printer.kickout(tillconfig.cash_drawer):
-                            ui.toast("No Sale has been recorded.")
-                            # Finally!  We're not lying any more!
-                            user.log("No Sale")
+                        printer.kickout(tillconfig.cash_drawer)
+                        ui.toast("No Sale has been recorded.")
+                        # Finally!  We're not lying any more!
+                        user.log("No Sale")
                     else:
                         ui.toast("No Sale")
                     if lock_after_nosale():
@@ -2114,12 +2174,26 @@ class page(ui.basicpage):
         if not trans or trans.closed:
             return
         # Expire the transaction because the wrong balance may have
-        # been cached.
+        # been cached.  Flush first: new payments that are only
+        # attached to the transaction through its payments collection
+        # would otherwise be lost as orphans.
+        td.s.flush()
         td.s.expire(trans)
-        # Update all the payment lines in our display list
+        # Update all the payment lines in our display list.  The
+        # payment method may have added payments to the transaction
+        # (for example when a card payment was split across several
+        # cards) or removed them, so bring the display list in line
+        # with the database.
+        payment_ids = {p.id for p in trans.payments}
+        self.dl[:] = [d for d in self.dl if not isinstance(d, payment.pline)
+                      or d.payment_id in payment_ids]
         for d in self.dl:
             if isinstance(d, payment.pline):
                 d.update()
+                payment_ids.discard(d.payment_id)
+        for p in trans.payments:
+            if p.id in payment_ids:
+                self.dl.append(payment.pline(p))
         self.update_balance()
         self.close_if_balanced()
         self.cursor_off()
@@ -2266,7 +2340,10 @@ class page(ui.basicpage):
                  f"from register")
         ui.toast("The receipt is being printed.")
         with ui.exception_guard("printing the receipt", title="Printer error"):
-            printer.print_receipt(tillconfig.receipt_printer, trans.id)
+            printer.print_receipt(
+                spooler.spooled_printer(
+                    tillconfig.receipt_printer, "printing the receipt"),
+                trans.id)
 
     def cancelkey(self):
         """The cancel key was pressed.
@@ -3350,7 +3427,8 @@ class page(ui.basicpage):
                 .options(joinedload(KeyboardBinding.stockline)
                          .joinedload(StockLine.stockonsale)
                          .undefer(StockItem.used)
-                         .undefer(StockItem.remaining))\
+                         .undefer(StockItem.remaining)
+                         .undefer(StockItem.lastsale))\
                 .options(joinedload(KeyboardBinding.stockline)
                          .joinedload(StockLine.stockonsale)
                          .joinedload(StockItem.stocktype))\
@@ -3380,8 +3458,8 @@ class page(ui.basicpage):
             linekeys.linemenu(
                 k, self.linekey, allow_stocklines=True,
                 allow_plus=True, allow_mods=True,
-                add_query_options=self._add_linemenu_query_options,
-                suppress_modifier_display=self.mod)
+                suppress_modifier_display=self.mod,
+                cache=binding_cache)
             return
         self.repeat = None
         if hasattr(k, 'notevalue'):
@@ -3480,6 +3558,12 @@ class page(ui.basicpage):
             self.deselect()
 
 
+# Keyboard bindings for line keys, shared by all the register pages
+# on this till and loaded with everything needed to make a sale
+binding_cache = linekeys.BindingCache(
+    query_options=page._add_linemenu_query_options)
+
+
 def handle_login(u, *args, **kwargs):
     """Login handler for the register.
 
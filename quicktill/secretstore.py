@@ -44,14 +44,17 @@ class Secrets:
     def find(cls, secret_name):
         return cls._key_names.get(secret_name)
 
-    def fetch(self, secret_name, max_age=None, lock_for_update=False):
+    def fetch(self, secret_name, max_age=None, lock_for_update=False,
+              session=None):
+        session = session or td.s
         if lock_for_update:
-            s = td.s.query(Secret).filter(Secret.key_name == self._key_name)\
-                                  .filter(Secret.secret_name == secret_name)\
-                                  .with_for_update()\
-                                  .one_or_none()
+            s = session.query(Secret)\
+                       .filter(Secret.key_name == self._key_name)\
+                       .filter(Secret.secret_name == secret_name)\
+                       .with_for_update()\
+                       .one_or_none()
         else:
-            s = td.s.get(Secret, (self._key_name, secret_name))
+            s = session.get(Secret, (self._key_name, secret_name))
         if not s:
             raise SecretDoesNotExist
         if not self._fernet:
@@ -61,17 +64,18 @@ class Secrets:
         except InvalidToken:
             raise SecretNotAvailable
 
-    def store(self, secret_name, value, create=False):
+    def store(self, secret_name, value, create=False, session=None):
         if not isinstance(value, str):
             raise TypeError("Secret value must be a str()")
         if not self._fernet:
             raise SecretNotAvailable
-        s = td.s.get(Secret, (self._key_name, secret_name))
+        session = session or td.s
+        s = session.get(Secret, (self._key_name, secret_name))
         if not s:
             if not create:
                 raise SecretDoesNotExist
             s = Secret(key_name=self._key_name, secret_name=secret_name)
-            td.s.add(s)
+            session.add(s)
         s.token = self._fernet.encrypt(value.encode('utf-8'))
 
 
@@ -2,8 +2,10 @@
 
 from . import ui, keyboard, td, printer, tillconfig, user, managestock
 from . import payment
+from . import spooler
 from . import config
 from .models import PayType, Session, SessionTotal, Transaction, zero
+from .models import StockValuation
 import sqlalchemy.exc
 from sqlalchemy.orm import undefer
 from sqlalchemy.sql import select, func, desc
@@ -26,6 +28,13 @@ sessioncountup_print = config.BooleanConfigItem(
     description="Should a counting-up sheet be printed when a session "
     "is closed?")
 
+stock_valuation_at_session_end = config.BooleanConfigItem(
+    'core:stock_valuation_at_session_end', True,
+    display_name="Record stock valuation at end of session?",
+    description="Should the value of the stock on the premises be recorded "
+    "when a session is ended?  Recorded valuations make the stock value "
+    "report in the web interface much quicker.")
+
 session_date_rollover_time = config.TimeConfigItem(
     'session:date_rollover_time', datetime.time(23, 0),
     display_name="Session date rollover time",
@@ -169,6 +178,17 @@ def checkendsession():
     return sc
 
 
+def _take_stock_valuation(time):
+    with td.orm_session():
+        StockValuation.take(td.s, time)
+
+
+def _stock_valuation_taken(future):
+    with td.orm_session():
+        with ui.exception_guard("valuing the stock at the end of the session"):
+            future.result()
+
+
 def confirmendsession():
     r = checkendsession()
     if not r:
@@ -183,6 +203,12 @@ def confirmendsession():
     r.endtime = datetime.datetime.now()
     log.info("End of session %d confirmed.", r.id)
     user.log(f"Ended session {r.logref}")
+    if stock_valuation_at_session_end():
+        # Valuing the stock can take a while on a large database
+        endtime = r.endtime
+        tillconfig.mainloop.run_in_worker(
+            lambda: _take_stock_valuation(endtime),
+            _stock_valuation_taken, desc="stock valuation")
     ui.infopopup([f"Session {r.id} has ended.",
                   "",
                   "Please count the cash in the drawer and enter the "
@@ -193,7 +219,11 @@ def confirmendsession():
         ui.toast("Printing the countup sheet.")
         with ui.exception_guard("printing the session countup sheet",
                                 title="Printer error"):
-            printer.print_sessioncountup(tillconfig.receipt_printer, r.id)
+            printer.print_sessioncountup(
+                spooler.spooled_printer(
+                    tillconfig.receipt_printer,
+                    "printing the session countup sheet"),
+                r.id)
         if tillconfig.cash_drawer:
             printer.kickout(tillconfig.cash_drawer)
     managestock.stock_purge_internal(source="session end")
@@ -492,7 +522,10 @@ class record(ui.dismisspopup):
             with ui.exception_guard("printing the confirmed session totals",
                                     title="Printer error"):
                 printer.print_sessiontotals(
-                    tillconfig.receipt_printer, session.id)
+                    spooler.spooled_printer(
+                        tillconfig.receipt_printer,
+                        "printing the confirmed session totals"),
+                    session.id)
         else:
             ui.toast(f"Totals for session {session.id} confirmed.")
 
@@ -0,0 +1,258 @@
+"""Send printer output in the background
+
+The spooler keeps a queue of finished canvases for each printer and
+sends them to the printer from worker threads, so the till never
+waits for a printer.  Jobs for a printer are sent one at a time in
+the order they were submitted.  If a job fails it is tried again
+after an increasing delay, and the rest of that printer's queue
+waits behind it; other printers are not affected.  If a job still
+hasn't been printed after its retries have been used up it is
+removed from the queue and the user is told.
+"""
+
+import datetime
+import logging
+from collections import deque
+from . import ui, td, tillconfig, user
+
+log = logging.getLogger(__name__)
+
+
+class PrintJob:
+    """A finished canvas waiting to be sent to a printer
+    """
+    def __init__(self, printer, canvas, description, retries, on_failure):
+        self.printer = printer
+        self.canvas = canvas
+        self.description = description
+        self.retries = retries
+        self.on_failure = on_failure
+        self.submitted = datetime.datetime.now()
+        self.attempts = 0
+        self.last_error = None
+
+    def __str__(self):
+        return self.description
+
+
+class _PrinterQueue:
+    """Jobs waiting for one printer
+    """
+    def __init__(self, printer):
+        self.printer = printer
+        self.jobs = deque()
+        # Set while the job at the head of the queue is being sent
+        self.sending = False
+        # Set while waiting to try the job at the head of the queue again
+        self.retry_timeout = None
+        self.retry_at = None
+
+    @property
+    def state(self):
+        if self.sending:
+            return "printing"
+        if self.retry_timeout:
+            return f"waiting until {self.retry_at:%H:%M:%S} to retry"
+        if self.jobs:
+            return "waiting"
+        return "idle"
+
+
+class Spooler:
+    """Per-printer queues of print jobs
+
+    The delay before the first retry of a job is min_delay seconds,
+    doubling for each subsequent retry up to max_delay seconds.
+    """
+    min_delay = 2
+    max_delay = 60
+
+    def __init__(self):
+        self._queues = {}
+        self.printed = 0
+        self.failed = 0
+
+    @property
+    def queues(self):
+        return list(self._queues.values())
+
+    def submit(self, printer, canvas, description, retries=4,
+               on_failure=None):
+        """Add a finished canvas to the queue for a printer
+
+        description is used in messages to the user and should read
+        like "printing the receipt".  If the job can't be printed
+        after retries retries, on_failure is called from the main
+        loop with the PrintJob as its only argument, inside a
+        database session; if on_failure is not supplied, a popup
+        reports the problem instead.
+
+        Returns the PrintJob.
+        """
+        job = PrintJob(printer, canvas, description, retries, on_failure)
+        q = self._queues.get(printer)
+        if not q:
+            q = self._queues[printer] = _PrinterQueue(printer)
+        q.jobs.append(job)
+        self._run(q)
+        return job
+
+    def _run(self, q):
+        if q.sending or q.retry_timeout or not q.jobs:
+            return
+        job = q.jobs[0]
+        job.attempts += 1
+        q.sending = True
+        tillconfig.mainloop.run_in_worker(
+            lambda: q.printer.print_canvas(job.canvas),
+            lambda future: self._sent(q, job, future),
+            desc=job.description)
+
+    def _sent(self, q, job, future):
+        q.sending = False
+        try:
+            future.result()
+        except Exception as e:
+            job.last_error = str(e)
+            log.warning("%s: attempt %d failed: %s",
+                        job.description, job.attempts, e)
+            if job in q.jobs:
+                if job.attempts > job.retries:
+                    q.jobs.remove(job)
+                    self.failed += 1
+                    self._give_up(job)
+                else:
+                    if job.attempts == 1:
+                        ui.toast(f"Problem {job.description}: {e}.  "
+                                 f"Will try again.")
+                    self._schedule_retry(q, job)
+        else:
+            if job in q.jobs:
+                q.jobs.remove(job)
+            self.printed += 1
+        self._run(q)
+
+    def _schedule_retry(self, q, job):
+        delay = min(self.min_delay * 2 ** (job.attempts - 1),
+                    self.max_delay)
+        q.retry_at = datetime.datetime.now() \
+            + datetime.timedelta(seconds=delay)
+        q.retry_timeout = tillconfig.mainloop.add_timeout(
+            delay, lambda: self.retry_now(q),
+            desc=f"retry {job.description}")
+
+    def _give_up(self, job):
+        log.error("%s: giving up after %d attempts", job.description,
+                  job.attempts)
+        if job.on_failure:
+            with td.orm_session():
+                with ui.exception_guard(job.description,
+                                        title="Printer error"):
+                    job.on_failure(job)
+            return
+        ui.infopopup(
+            [f"There was a problem {job.description} on {job.printer}, "
+             f"and it could not be printed after {job.attempts} attempts.",
+             "", f"The problem was: {job.last_error}"],
+            title="Printer error")
+
+    def retry_now(self, q):
+        """Try the job at the head of a queue without further delay
+        """
+        if q.retry_timeout:
+            q.retry_timeout.cancel()
+            q.retry_timeout = None
+            q.retry_at = None
+        self._run(q)
+
+    def cancel(self, q, job):
+        """Remove a job from a queue
+
+        If the job is being sent at the moment it is too late to stop
+        it, but it will not be tried again if it fails.
+        """
+        if job not in q.jobs:
+            return
+        was_head = job is q.jobs[0]
+        q.jobs.remove(job)
+        if was_head:
+            self.retry_now(q)
+
+    def __str__(self):
+        return (f"{sum(len(q.jobs) for q in self._queues.values())} "
+                f"jobs queued, {self.printed} printed, "
+                f"{self.failed} failed")
+
+
+spooler = Spooler()
+
+
+class spooled_printer:
+    """Send output to a printer through the spooler
+
+    Use in place of a printer in the "with printer as d:" idiom: the
+    canvas is filled in as usual, and is then queued for the printer.
+    Any problem sending it is reported to the user later.
+    """
+    def __init__(self, printer, description, retries=4, on_failure=None):
+        self._printer = printer
+        self._description = description
+        self._retries = retries
+        self._on_failure = on_failure
+        self._canvas = None
+
+    def offline(self):
+        return self._printer.offline()
+
+    def __enter__(self):
+        if self._canvas:
+            raise Exception("Already started in __enter__()")
+        self._canvas = self._printer.get_canvas()
+        return self._canvas
+
+    def __exit__(self, type, value, tb):
+        canvas = self._canvas
+        self._canvas = None
+        if tb is None:
+            spooler.submit(self._printer, canvas, self._description,
+                           retries=self._retries,
+                           on_failure=self._on_failure)
+
+    def __str__(self):
+        return str(self._printer)
+
+
+def _queue_menu(q):
+    ui.keymenu([
+        ("1", "Try the first job again now", spooler.retry_now, (q,)),
+    ], title=str(q.printer))
+
+
+def _job_menu(q, job):
+    ui.keymenu([
+        ("1", "Try again now", spooler.retry_now, (q,)),
+        ("2", "Cancel this job", spooler.cancel, (q, job)),
+    ], title=f"{job.description} on {q.printer}")
+
+
+@user.permission_required('print-queue', 'View and manage the print queue')
+def status():
+    """Show the print queue
+    """
+    log.info("Print queue popup")
+    f = ui.tableformatter(' l L r l ')
+    header = f("Submitted", "Job", "Attempts", "Last error")
+    lines = []
+    for q in spooler.queues:
+        lines.append((f"{q.printer}: {q.state}", _queue_menu, (q,)))
+        for job in q.jobs:
+            lines.append((
+                f(f"{job.submitted:%H:%M:%S}", job.description,
+                  job.attempts, job.last_error or ""),
+                _job_menu, (q, job)))
+    if not lines:
+        ui.infopopup(["Nothing has been printed yet."], title="Print queue",
+                     colour=ui.colour_info)
+        return
+    ui.menu(lines, title="Print queue",
+            blurb=[str(spooler), header])
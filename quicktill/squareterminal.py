@@ -462,15 +462,46 @@ class _SquareAPISession:
         return PaymentRefund(d["refund"]) if "refund" in d else None
 
 
-class _SquarePaymentProgress(ui.basicpopup):
+class _SquareBackgroundCalls:
+    """Mixin for popups that call the Square API
+
+    Calls to the Square API are made in a worker thread, so that the
+    user interface remains responsive while we wait for Square to
+    respond. At most one call is in progress at a time. The popup's
+    API session must be in self.session; it is closed when the popup
+    is dismissed, or when the call in progress finishes if that is
+    later.
+    """
+    _pending = None
+    _dismissed = False
+
+    def _api_call(self, func, on_done, desc):
+        def done(future):
+            self._pending = None
+            if self._dismissed:
+                if self.session:
+                    self.session.close()
+                return
+            if on_done:
+                on_done(future)
+        self._pending = tillconfig.mainloop.run_in_worker(func, done, desc)
+
+    def _close_session(self):
+        self._dismissed = True
+        if not self._pending and self.session:
+            self.session.close()
+
+
+class _SquarePaymentProgress(_SquareBackgroundCalls, ui.basicpopup):
     """Popup window that progresses a Square payment
     """
     def __init__(self, register, payment_instance):
         # At this point, register is guaranteed to be current. Every
-        # other time we are called (keypress or timeout) the register
-        # may have ceased to be current and this should be checked
-        # using register.entry_noninteractive(); if it returns False
-        # we should clean up and exit since the payment will now be
+        # other time we are called (keypress, timeout or completion of
+        # a call to Square) the register may have ceased to be current
+        # and this should be checked using
+        # register.entry_noninteractive(); if it returns False we
+        # should clean up and exit since the payment will now be
         # progressing on another terminal.
         log.debug("SquarePaymentProgress starting")
         self.register = register
@@ -487,6 +518,7 @@ class _SquarePaymentProgress(ui.basicpopup):
             checkout_device_name_key).value)
         self.status = ui.label(4, 16, 43, contents="Connecting to Square")
         self.session = payment_instance.paytype.driver.api_session()
+        self._cancel_requested = False
         # NB if timeout is set to "0" then update() is called before the
         # display is flushed
         self.timeout = tillconfig.mainloop.add_timeout(
@@ -505,31 +537,77 @@ class _SquarePaymentProgress(ui.basicpopup):
 
     def dismiss(self):
         log.debug("SquarePaymentProgress dismiss")
-        self.session.close()
-        del self.session
+        self._close_session()
         super().dismiss()
 
     def keypress(self, k):
-        self.timeout.cancel()
-        self.timeout = None
-        if k == K_CANCEL:
-            self.update(cancel=True)
-        elif k == K_RECALLTRANS:
+        if self.timeout:
+            self.timeout.cancel()
+            self.timeout = None
+        if k == K_RECALLTRANS:
             self.dismiss()
             self.register.clear()
             ui.toast("The Square payment is still proceeding in the "
                      "background. Recall the transaction to check the "
                      "payment status.")
+        elif self._pending:
+            # We are already waiting for Square; deal with a cancel
+            # request when the response arrives
+            if k == K_CANCEL:
+                self._cancel_requested = True
         else:
-            self.update(cancel=False)
+            self.update(cancel=k == K_CANCEL)
 
     def _timer_update(self):
         # Timer doesn't start database session
         with td.orm_session():
             self.update()
 
+    def _call_square(self, what, func, args, cont):
+        """Call the Square API in the background
+
+        what describes the call for error messages. When the call
+        completes, cont is called with the Payment and the result of
+        the call.
+        """
+        self._api_call(lambda: func(*args),
+                       lambda future: self._square_call_done(
+                           what, future, cont),
+                       f"square progress {what}")
+
+    def _square_call_done(self, what, future, cont):
+        # Completion of a call to Square doesn't start database session
+        with td.orm_session():
+            if not self.register.entry_noninteractive():
+                self.dismiss()
+                return
+            p = td.s.get(Payment, self.payment_id,
+                         options=[joinedload(Payment.meta)])
+            try:
+                result = future.result()
+            except _SquareAPIError as e:
+                self.status.set(f"API error {what}; retrying...")
+                log.error("Square API error %s: %s", what, e)
+                self.timeout = tillconfig.mainloop.add_timeout(
+                    10, self._timer_update, "square progress error")
+                return
+            except requests.exceptions.RequestException as e:
+                self.status.set(f"Network error {what}; retrying...")
+                log.error("Request error %s: %s", what, e)
+                self.timeout = tillconfig.mainloop.add_timeout(
+                    10, self._timer_update, "square network error")
+                return
+            cont(p, result)
+            if self._cancel_requested and self.timeout:
+                # Cancel was pressed while we were waiting for Square
+                self.timeout.cancel()
+                self.timeout = None
+                self.update()
+
     def update(self, cancel=False):
         # Called by timer or if Cancel key is pressed
+        cancel = cancel or self._cancel_requested
+        self._cancel_requested = False
         log.debug("SquarePaymentProgress update(cancel=%s)", cancel)
         self.timeout = None
         if not self.register.entry_noninteractive():
@@ -542,34 +620,10 @@ class _SquarePaymentProgress(ui.basicpopup):
             # The checkout has been created; we need to read it for
             # an update. If we are cancelling, read it by posting to
             # the cancel endpoint instead
-            try:
-                if cancel:
-                    try:
-                        checkout = self.session.cancel_terminal_checkout(
-                            p.meta[checkout_id_key].value)
-                    except _SquareAPIError as e:
-                        # If the checkout has already completed, this API
-                        # call will return error code 'BAD_REQUEST'; we
-                        # should try again with a 'get' call
-                        if 'BAD_REQUEST' in e:
-                            cancel = False
-                        else:
-                            raise
-                if not cancel:
-                    checkout = self.session.get_terminal_checkout(
-                        p.meta[checkout_id_key].value)
-            except _SquareAPIError as e:
-                self.status.set("API error fetching checkout; retrying...")
-                log.error("Square API error fetching terminal checkout: %s", e)
-                self.timeout = tillconfig.mainloop.add_timeout(
-                    10, self._timer_update, "square progress error")
-                return
-            except requests.exceptions.RequestException as e:
-                self.status.set("Network error fetching checkout; retrying...")
-                log.error("Request error fetching terminal checkout: %s", e)
-                self.timeout = tillconfig.mainloop.add_timeout(
-                    10, self._timer_update, "square network error")
-                return
+            self._call_square(
+                "fetching checkout", self._get_checkout,
+                (p.meta[checkout_id_key].value, cancel),
+                self._checkout_updated)
         else:
             # Post the checkout, even if we are supposed to be
             # cancelling: there is no guarantee that we haven't
@@ -588,20 +642,29 @@ class _SquarePaymentProgress(ui.basicpopup):
                     "note": f"Transaction {p.transaction.id} payment {p.id}",
                 },
             }
+            self._call_square(
+                "creating checkout", self.session.create_terminal_checkout,
+                (c,), self._checkout_updated)
+
+    def _get_checkout(self, checkout_id, cancel):
+        # Called in a worker thread
+        if cancel:
             try:
-                checkout = self.session.create_terminal_checkout(c)
+                return self.session.cancel_terminal_checkout(checkout_id)
             except _SquareAPIError as e:
-                self.status.set("API error creating checkout; retrying...")
-                log.error("Square API error creating terminal checkout: %s", e)
-                self.timeout = tillconfig.mainloop.add_timeout(
-                    10, self._timer_update, "square progress error")
-                return
-            except requests.exceptions.RequestException as e:
-                self.status.set("Network error creating checkout; retrying...")
-                log.error("Request error creating terminal checkout: %s", e)
-                self.timeout = tillconfig.mainloop.add_timeout(
-                    10, self._timer_update, "square network error")
-                return
+                # If the checkout has already completed, this API
+                # call will return error code 'BAD_REQUEST'; we
+                # should try again with a 'get' call
+                if 'BAD_REQUEST' not in e:
+                    raise
+        return self.session.get_terminal_checkout(checkout_id)
+
+    def _get_payments(self, square_payment_ids):
+        # Called in a worker thread
+        return [(square_payment_id, self.session.get_payment(square_payment_id))
+                for square_payment_id in square_payment_ids]
+
+    def _checkout_updated(self, p, checkout):
         p.set_meta(checkout_id_key, checkout.id)
         p.set_meta(checkout_key, json.dumps(checkout.source_data))
         if checkout.status == "PENDING":
@@ -633,52 +696,13 @@ class _SquarePaymentProgress(ui.basicpopup):
             self.register.payments_update()
             return
         elif checkout.status == "COMPLETED":
-            # Fetch the payments. If there is more than one payment, insert
-            # additional payments in the transaction.
-            for idx, square_payment_id in enumerate(checkout.payment_ids):
-                try:
-                    square_payment = self.session.get_payment(square_payment_id)
-                except _SquareAPIError as e:
-                    self.status.set("API error fetching payment; retrying...")
-                    log.error("Square API error fetching payment: %s", e)
-                    self.timeout = tillconfig.mainloop.add_timeout(
-                        10, self._timer_update, "square progress error")
-                    td.s.rollback()  # may already have processed a payment
-                    return
-                except requests.exceptions.RequestException as e:
-                    self.status.set("Network error fetching payment; "
-                                    "retrying...")
-                    log.error("Network error fetching payment: %s", e)
-                    self.timeout = tillconfig.mainloop.add_timeout(
-                        10, self._timer_update, "square network error")
-                    td.s.rollback()  # may already have processed a payment
-                    return
-                value = square_payment.total_money.as_decimal()
-                if square_payment.status in ("FAILED", "CANCELED"):
-                    # This payment has zero value
-                    log.warning("payment %s in state %s", square_payment_id,
-                                square_payment.status)
-                    value = zero
-                if idx == 0:
-                    payment = p
-                else:
-                    payment = Payment(
-                        transaction=p.transaction,
-                        paytype=p.paytype,
-                        user=p.user,
-                        source=p.source,
-                    )
-                    td.s.add(payment)
-                payment.set_meta(payment_id_key, square_payment_id)
-                payment.set_meta(
-                    payment_key, json.dumps(square_payment.source_data))
-                payment.amount = value
-                payment.pending = False
-                payment.text = f"{payment.paytype.description} "\
-                    f"{square_payment_id[:6]}"
-            # XXX insert additional payments into register dl?
-            self.register.payments_update()
-            self.dismiss()
+            # Fetch the payments. The checkout details have been
+            # recorded, so if this fails we will fetch the checkout
+            # again before retrying.
+            self.status.set("Fetching payment details")
+            self._call_square(
+                "fetching payment", self._get_payments,
+                (checkout.payment_ids,), self._payments_fetched)
             return
         else:
             self.status.set(f"Unrecognised checkout status {checkout.status}")
@@ -686,16 +710,50 @@ class _SquarePaymentProgress(ui.basicpopup):
                 20, self._timer_update, "square progress wait unknown status")
             return
 
+    def _payments_fetched(self, p, square_payments):
+        # If there is more than one payment, insert additional
+        # payments in the transaction.
+        for idx, (square_payment_id, square_payment) in enumerate(
+                square_payments):
+            value = square_payment.total_money.as_decimal()
+            if square_payment.status in ("FAILED", "CANCELED"):
+                # This payment has zero value
+                log.warning("payment %s in state %s", square_payment_id,
+                            square_payment.status)
+                value = zero
+            if idx == 0:
+                payment = p
+            else:
+                payment = Payment(
+                    transaction=p.transaction,
+                    paytype=p.paytype,
+                    user=p.user,
+                    source=p.source,
+                )
+                td.s.add(payment)
+            payment.set_meta(payment_id_key, square_payment_id)
+            payment.set_meta(
+                payment_key, json.dumps(square_payment.source_data))
+            payment.amount = value
+            payment.pending = False
+            payment.text = f"{payment.paytype.description} "\
+                f"{square_payment_id[:6]}"
+        # payments_update() adds any additional payments to the
+        # register display
+        self.register.payments_update()
+        self.dismiss()
 
-class _SquareRefundProgress(ui.basicpopup):
+
+class _SquareRefundProgress(_SquareBackgroundCalls, ui.basicpopup):
     """Popup window that progresses a Square refund
     """
     def __init__(self, register, payment_instance):
         # At this point, register is guaranteed to be current. Every
-        # other time we are called (timeout) the register
-        # may have ceased to be current and this should be checked
-        # using register.entry_noninteractive(); if it returns False
-        # we should clean up and exit since the payment will now be
+        # other time we are called (timeout or completion of a call
+        # to Square) the register may have ceased to be current and
+        # this should be checked using
+        # register.entry_noninteractive(); if it returns False we
+        # should clean up and exit since the payment will now be
         # progressing on another terminal.
         log.debug("SquareRefundProgress starting")
         self.register = register
@@ -724,8 +782,7 @@ class _SquareRefundProgress(ui.basicpopup):
 
     def dismiss(self):
         log.debug("SquareRefundProgress dismiss")
-        self.session.close()
-        del self.session
+        self._close_session()
         super().dismiss()
 
     def _timer_update(self):
@@ -733,16 +790,14 @@ class _SquareRefundProgress(ui.basicpopup):
         with td.orm_session():
             self.update()
 
-    def update(self):
-        # Called by timer
-        log.debug("SquareRefundProgress update")
-        self.timeout = None
-        if not self.register.entry_noninteractive():
-            self.dismiss()
-            return
+    def _load_payments(self):
+        """Load the refund and the original payment
+
+        Returns (refund payment, original payment), or None if the
+        refund has been aborted.
+        """
         p = td.s.get(Payment, self.payment_id,
                      options=[joinedload(Payment.meta)])
-        failed = f"{p.paytype.description} refund failed"
         details = json.loads(p.meta[refund_details_key].value)
         op = td.s.get(Payment, details["till_payment_id"],
                       options=[joinedload(Payment.meta)])
@@ -753,85 +808,124 @@ class _SquareRefundProgress(ui.basicpopup):
             # We don't have enough details to continue
             # Abort the refund
             self.dismiss()
-            p.text = failed
+            p.text = f"{p.paytype.description} refund failed"
             p.pending = False
             self.register.payments_update()
             ui.infopopup(["The original payment could not be found or "
                           "was in an incorrect state."], title="Square error")
             return
-        # Fetch the card details from the original payment
-        op_sq = SquarePayment(json.loads(op.meta[payment_key].value))
-        card = op_sq.card_details.card
-        try:
-            if refund_id_key in p.meta:
-                # The refund has been created; we need to read it for
-                # an update.
-                refund = self.session.get_refund(
-                    p.meta[refund_id_key].value)
-            else:
-                # The refund has not been created yet, or we might have
-                # crashed after creating it but before committing its ID
-                # to the database.
-                refund = self.session.create_refund({
-                    "idempotency_key": details["idempotency_key"],
-                    "amount_money": details["amount"],
-                    "payment_id": op.meta[payment_id_key].value,
-                    "reason": f"Transaction {p.transid} refund {p.id}",
-                    "payment_version_token": details["payment_version_token"],
-                })
-        except _SquareAPIError as e:
-            # Abort the refund
-            if "VERSION_MISMATCH" in e:
-                # If this was a VERSION_MISMATCH we need to update the
-                # cached SquarePayment on the original payment before
-                # we exit, so we don't just get another
-                # VERSION_MISMATCH when we try again
-                self._update_original_payment(op)
+        return p, op
+
+    def update(self):
+        # Called by timer
+        log.debug("SquareRefundProgress update")
+        self.timeout = None
+        if not self.register.entry_noninteractive():
             self.dismiss()
-            p.text = failed
-            p.pending = False
-            self.register.payments_update()
-            for error in e.errors:
-                log.warning("Refund error code '%s'", error.get('code'))
             return
-        except requests.exceptions.RequestException as e:
-            log.error("Network error processing refund: %s", e)
-            self.timeout = tillconfig.mainloop.add_timeout(
-                10, self._timer_update, "square refund network error")
+        payments = self._load_payments()
+        if not payments:
             return
+        p, op = payments
+        if refund_id_key in p.meta:
+            # The refund has been created; we need to read it for
+            # an update.
+            refund_id = p.meta[refund_id_key].value
+            self._api_call(lambda: self.session.get_refund(refund_id),
+                           self._refund_updated, "square refund fetch")
+        else:
+            # The refund has not been created yet, or we might have
+            # crashed after creating it but before committing its ID
+            # to the database.
+            details = json.loads(p.meta[refund_details_key].value)
+            refund_data = {
+                "idempotency_key": details["idempotency_key"],
+                "amount_money": details["amount"],
+                "payment_id": op.meta[payment_id_key].value,
+                "reason": f"Transaction {p.transid} refund {p.id}",
+                "payment_version_token": details["payment_version_token"],
+            }
+            self._api_call(lambda: self.session.create_refund(refund_data),
+                           self._refund_updated, "square refund create")
 
-        p.set_meta(refund_id_key, refund.id)
-        p.set_meta(refund_key, json.dumps(refund.source_data))
-        p.set_meta(refund_card_key, json.dumps(card.source_data))
-        if refund.status not in ("PENDING", "COMPLETED"):
-            # The refund failed.
-            self.dismiss()
-            p.text = failed
+    def _refund_updated(self, future):
+        # Completion of a call to Square doesn't start database session
+        with td.orm_session():
+            if not self.register.entry_noninteractive():
+                self.dismiss()
+                return
+            payments = self._load_payments()
+            if not payments:
+                return
+            p, op = payments
+            failed = f"{p.paytype.description} refund failed"
+            try:
+                refund = future.result()
+            except _SquareAPIError as e:
+                # Abort the refund
+                if "VERSION_MISMATCH" in e:
+                    # If this was a VERSION_MISMATCH we need to update
+                    # the cached SquarePayment on the original payment,
+                    # so we don't just get another VERSION_MISMATCH
+                    # when we try again
+                    self._update_original_payment(op)
+                self.dismiss()
+                p.text = failed
+                p.pending = False
+                self.register.payments_update()
+                for error in e.errors:
+                    log.warning("Refund error code '%s'", error.get('code'))
+                return
+            except requests.exceptions.RequestException as e:
+                log.error("Network error processing refund: %s", e)
+                self.timeout = tillconfig.mainloop.add_timeout(
+                    10, self._timer_update, "square refund network error")
+                return
+
+            # Fetch the card details from the original payment
+            op_sq = SquarePayment(json.loads(op.meta[payment_key].value))
+            card = op_sq.card_details.card
+            p.set_meta(refund_id_key, refund.id)
+            p.set_meta(refund_key, json.dumps(refund.source_data))
+            p.set_meta(refund_card_key, json.dumps(card.source_data))
+            if refund.status not in ("PENDING", "COMPLETED"):
+                # The refund failed.
+                self.dismiss()
+                p.text = failed
+                p.pending = False
+                self.register.payments_update()
+                log.warning("Refund ended up in state '%s'", refund.status)
+                return
+            # The refund succeeded.
+            p.text = f"{p.paytype.description} refund {refund.id[:6]}"
+            p.amount = -refund.amount_money.as_decimal()
             p.pending = False
+            td.s.flush()
             self.register.payments_update()
-            log.warning("Refund ended up in state '%s'", refund.status)
-            return
-        # The refund succeeded.
-        p.text = f"{p.paytype.description} refund {refund.id[:6]}"
-        p.amount = -refund.amount_money.as_decimal()
-        p.pending = False
-        td.s.flush()
-        self.register.payments_update()
-        # Ensure refund committed even if orig update failed
-        td.s.commit()
-        # _update_original_payment requires self.session, which is deleted
-        # by self.dismiss()
-        self._update_original_payment(op)
-        self.dismiss()
+            self._update_original_payment(op)
+            self.dismiss()
 
     def _update_original_payment(self, p):
-        try:
-            sp = self.session.get_payment(p.meta[payment_id_key].value)
-        except _SquareAPIError:
-            log.warning(
-                "Could not fetch updated Square payment for %d", p.id)
-            return
-        p.set_meta(payment_key, json.dumps(sp.source_data))
+        # The update happens in the background; it must be started
+        # before the popup is dismissed, and the API session is closed
+        # when it has finished
+        payment_id = p.id
+        square_payment_id = p.meta[payment_id_key].value
+
+        def update():
+            # Called in a worker thread
+            try:
+                sp = self.session.get_payment(square_payment_id)
+            except (_SquareAPIError, requests.exceptions.RequestException):
+                log.warning(
+                    "Could not fetch updated Square payment for %d",
+                    payment_id)
+                return
+            with td.orm_session():
+                p = td.s.get(Payment, payment_id)
+                p.set_meta(payment_key, json.dumps(sp.source_data))
+
+        self._api_call(update, None, "square refund update original payment")
 
 
 def _load_driver(paytype):
@@ -922,7 +1016,7 @@ def _terminal_availability(t):
     return "Available"
 
 
-class _ManageTerminal(ui.dismisspopup):
+class _ManageTerminal(_SquareBackgroundCalls, ui.dismisspopup):
     """Popup window that fetches terminal details
 
     This popup does two entirely separate things. It fetches status
@@ -990,9 +1084,7 @@ class _ManageTerminal(ui.dismisspopup):
         if self.timeout:
             self.timeout.cancel()
             self.timeout = None
-        if self.session:
-            self.session.close()
-        del self.session
+        self._close_session()
         super().dismiss()
 
     def keypress(self, k):
@@ -1006,17 +1098,26 @@ class _ManageTerminal(ui.dismisspopup):
         self.timeout = None
         if not self.session:
             return
+        if not self.action_id:
+            self._api_call(
+                lambda: self.session.create_terminal_action(
+                    self.action_params),
+                self._action_updated, "square terminal manage create action")
+        else:
+            action_id = self.action_id
+            self._api_call(
+                lambda: self.session.get_terminal_action(action_id),
+                self._action_updated, "square terminal manage get action")
+
+    def _action_updated(self, future):
         try:
-            if not self.action_id:
-                action = self.session.create_terminal_action(self.action_params)
-                self.action_id = action.id
-            else:
-                action = self.session.get_terminal_action(self.action_id)
+            action = future.result()
         except Exception as e:
             self.status.set(str(e))
             self.session.close()
             self.session = None
             return
+        self.action_id = action.id
 
         if action.status == "PENDING":
             self.status.set("Waiting for terminal")
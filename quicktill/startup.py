@@ -16,6 +16,7 @@ import sys
 from pathlib import Path
 from types import ModuleType
 from . import tillconfig, td
+from .plugins import InstancePluginMount
 from .version import version
 
 # The following imports are to ensure subcommands are loaded
@@ -43,6 +44,23 @@ configurations = {
 """
 
 
+class StartupHook(metaclass=InstancePluginMount):
+    """Hooks for the till starting up
+
+    Plugins that have work to resume when the till starts, for
+    example work queued for an external service before the till was
+    last stopped, should subclass this.
+    """
+    def started(self):
+        """Called from the main loop once the till is running
+
+        The database listener is set up and the user interface is
+        ready.  This is not called when the configuration file is
+        read by other commands.
+        """
+        pass
+
+
 def _process_importsfile(path):
     with path.open() as f:
         for l in f.readlines():
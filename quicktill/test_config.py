@@ -121,6 +121,21 @@ class ConfigTest(unittest.TestCase):
         cfg._test_set("fiver")
         self.assertIsNone(cfg())
 
+    def test_snapshot(self):
+        # With no database, any attempt to query it would fail
+        self.addCleanup(setattr, config.ConfigItem, '_snapshot', None)
+        config.ConfigItem._snapshot = {"test:snapshot": "12"}
+        cfg = config.IntConfigItem("test:snapshot", 5)
+        changes = []
+        cfg.notify_on_change(lambda: changes.append(cfg()))
+        self.assertEqual(cfg(), 12)
+        version = config.ConfigItem.version
+        config.ConfigItem._update_snapshot("test:snapshot", "13")
+        config.ConfigItem._item_changed("test:snapshot")
+        self.assertEqual(changes, [13])
+        self.assertEqual(cfg(), 13)
+        self.assertEqual(config.ConfigItem.version, version + 1)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,148 @@
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+import django
+django.setup()
+
+from . import models
+from .tillweb import datatable
+from .tillweb.db import td
+import unittest
+import datetime
+import json
+from decimal import Decimal
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine
+
+TEST_DATABASE_NAME = "quicktill-test-datatable"
+
+
+class DatatableSeekTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        engine = create_engine("postgresql+psycopg2:///postgres", future=True)
+        raw_connection = engine.raw_connection()
+        with raw_connection.cursor() as cursor:
+            cursor.execute('commit')
+            cursor.execute(f'create database "{TEST_DATABASE_NAME}"')
+        raw_connection.close()
+        cls._engine = create_engine(
+            f"postgresql+psycopg2:///{TEST_DATABASE_NAME}", future=True)
+        models.metadata.create_all(cls._engine)
+        cls._sm = sessionmaker(cls._engine, future=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._engine.dispose()
+        del cls._engine
+        engine = create_engine("postgresql+psycopg2:///postgres", future=True)
+        raw_connection = engine.raw_connection()
+        with raw_connection.cursor() as cursor:
+            cursor.execute('commit')
+            cursor.execute(f'drop database "{TEST_DATABASE_NAME}"')
+        raw_connection.close()
+
+    def setUp(self):
+        self.connection = self._engine.connect()
+        self.connection.begin()
+        self.s = self._sm(bind=self.connection)
+        td.s = self.s
+        business = models.Business(
+            id=1, name='Test', abbrev='TEST', address='An address')
+        vatband = models.VatBand(band='A', business=business, rate=0.2)
+        dept = models.Department(id=1, description="Test", vat=vatband)
+        sale = models.TransCode(code='S', description='Sale')
+        session = models.Session(date=datetime.date(2026, 10, 1))
+        self.trans = models.Transaction(session=session)
+        self.s.add_all([business, vatband, dept, sale, session, self.trans])
+        self.base = datetime.datetime(2026, 10, 1, 12, 0)
+        # Several lines share each time, so the primary key is
+        # needed to tell them apart
+        for i in range(50):
+            self._add_line(self.base + datetime.timedelta(minutes=i // 3))
+        self.s.flush()
+        self.order = [(models.Transline.time, True, False)]
+        self.query = self.s.query(models.Transline)
+        self.keyset = datatable._keyset_columns(self.query, self.order)
+
+    def tearDown(self):
+        del td.s
+        self.s.close()
+        self.connection.close()
+
+    def _add_line(self, time):
+        self.s.add(models.Transline(
+            transaction=self.trans, items=1, amount=Decimal("1.00"),
+            dept_id=1, transcode='S', text="Test", time=time))
+
+    def _page(self, start, length, token=None):
+        q, query_hash = datatable._datatables_seek(
+            self.query, self.order, self.keyset, start, length, token)
+        rows = q.all()
+        return rows, datatable._seek_token(
+            query_hash, start + length, self.keyset, rows[-1])
+
+    def _offset_page(self, start, length):
+        return self.query\
+                   .order_by(models.Transline.time.desc(),
+                             models.Transline.id.desc())\
+                   .offset(start)\
+                   .limit(length)\
+                   .all()
+
+    def test_keyset(self):
+        self.assertEqual(self.keyset,
+                         [models.Transline.time, models.Transline.id])
+
+    def test_without_token_uses_offset(self):
+        for start in (0, 10, 45):
+            rows, _ = self._page(start, 10)
+            self.assertEqual(rows, self._offset_page(start, 10))
+
+    def test_next_page_after_inserts(self):
+        first, token = self._page(0, 10)
+        self.assertEqual(first, self._offset_page(0, 10))
+        # Rows arrive at the top of the table, and within the next
+        # page, while the first page is being looked at
+        self._add_line(self.base + datetime.timedelta(hours=1))
+        self._add_line(self.base + datetime.timedelta(hours=1))
+        self._add_line(self.base + datetime.timedelta(minutes=12))
+        self.s.flush()
+        second, _ = self._page(10, 10, token)
+        # The second page carries on from the last row the client was
+        # sent, without skipping or repeating rows
+        everything = self._offset_page(0, 100)
+        after = everything.index(first[-1]) + 1
+        self.assertEqual(second, everything[after:after + 10])
+        self.assertNotEqual(second, self._offset_page(10, 10))
+        self.assertFalse(set(first) & set(second))
+
+    def test_next_page_after_deletes(self):
+        first, token = self._page(0, 10)
+        self.s.delete(first[0])
+        self.s.delete(first[1])
+        self.s.flush()
+        second, _ = self._page(10, 10, token)
+        everything = self._offset_page(0, 100)
+        after = everything.index(first[-1]) + 1
+        self.assertEqual(second, everything[after:after + 10])
+
+    def test_token_for_another_page_ignored(self):
+        _, token = self._page(0, 10)
+        # Jumping to a later page can't use the token
+        rows, _ = self._page(30, 10, token)
+        self.assertEqual(rows, self._offset_page(30, 10))
+
+    def test_token_for_another_query_ignored(self):
+        _, token = self._page(0, 10)
+        self.query = self.query.filter(models.Transline.id > 5)
+        rows, _ = self._page(10, 10, token)
+        self.assertEqual(rows, self._offset_page(10, 10))
+
+    def test_bad_token_ignored(self):
+        _, token = self._page(0, 10)
+        query_hash, start, values = json.loads(token)
+        for bad in ("nonsense", json.dumps([query_hash, start, ["x", "y"]]),
+                    json.dumps([query_hash, start, values[:1]])):
+            rows, _ = self._page(10, 10, bad)
+            self.assertEqual(rows, self._offset_page(10, 10))
@@ -0,0 +1,248 @@
+from . import event
+from . import event_asyncio
+import asyncio
+import unittest
+import os
+import random
+import time
+
+
+class SelectorsMainLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.mainloop = event.SelectorsMainLoop()
+        # A pipe that is always readable, so that iterate() never
+        # blocks waiting for timeouts that are not yet due
+        self._r, self._w = os.pipe()
+        os.write(self._w, b"x")
+        self._watch = self.mainloop.add_fd(self._r, lambda: None)
+
+    def tearDown(self):
+        self._watch.remove()
+        os.close(self._r)
+        os.close(self._w)
+
+    def test_timeouts_called_in_order(self):
+        called = []
+        self.mainloop.add_timeout(0.02, lambda: called.append(2))
+        self.mainloop.add_timeout(0.01, lambda: called.append(1))
+        self.mainloop.add_timeout(0.01, lambda: called.append(1.5))
+        self.mainloop.add_timeout(60, lambda: called.append(3))
+        time.sleep(0.03)
+        self.mainloop.iterate()
+        self.assertEqual(called, [1, 1.5, 2])
+
+    def test_cancelled_timeout_not_called(self):
+        called = []
+        handle = self.mainloop.add_timeout(0, lambda: called.append(1))
+        handle.cancel()
+        # Cancelling twice, or after the timeout has been called, is allowed
+        handle.cancel()
+        self.mainloop.iterate()
+        self.assertEqual(called, [])
+
+    def test_cancel_from_earlier_callback(self):
+        called = []
+        handles = []
+        self.mainloop.add_timeout(0, lambda: handles[0].cancel())
+        handles.append(self.mainloop.add_timeout(
+            0, lambda: called.append(1)))
+        time.sleep(0.01)
+        self.mainloop.iterate()
+        self.assertEqual(called, [])
+        self.assertEqual(self.mainloop._cancelled_timeouts, 0)
+
+    def test_timeout_added_by_callback_runs_next_iteration(self):
+        called = []
+        self.mainloop.add_timeout(0, lambda: self.mainloop.add_timeout(
+            0, lambda: called.append(1)))
+        self.mainloop.iterate()
+        self.assertEqual(called, [])
+        self.mainloop.iterate()
+        self.assertEqual(called, [1])
+
+    def test_cancelled_timeouts_are_compacted(self):
+        handles = [self.mainloop.add_timeout(60, lambda: None)
+                   for _ in range(100)]
+        for h in handles[:60]:
+            h.cancel()
+        self.assertLess(len(self.mainloop._timeouts), 100)
+        self.assertEqual(
+            len([e for e in self.mainloop._timeouts
+                 if e[2]._func is not None]), 40)
+
+    def test_many_pending_timeouts(self):
+        # With a large heap of timeouts, only the ones that are due
+        # are called, in order of their due times, and cancelled ones
+        # are never called
+        called = []
+        later = [self.mainloop.add_timeout(60 + i, lambda: called.append(-1))
+                 for i in range(10000)]
+        due = list(range(100))
+        random.Random(1).shuffle(due)
+        handles = {i: self.mainloop.add_timeout(
+            0.001 * i, lambda i=i: called.append(i)) for i in due}
+        for i in range(0, 100, 3):
+            handles[i].cancel()
+        for h in later[::2]:
+            h.cancel()
+        time.sleep(0.12)
+        self.mainloop.iterate()
+        self.assertEqual(called, [i for i in range(100) if i % 3])
+        self.mainloop.iterate()
+        self.assertNotIn(-1, called)
+
+    def test_run_in_worker(self):
+        results = []
+
+        def fail():
+            raise ValueError("worker failed")
+
+        self.mainloop.run_in_worker(lambda: 42, results.append)
+        self.mainloop.run_in_worker(fail, results.append)
+        deadline = time.monotonic() + 5
+        while len(results) < 2 and time.monotonic() < deadline:
+            self.mainloop.iterate()
+        self.assertEqual(len(results), 2)
+        values = []
+        for future in results:
+            try:
+                values.append(future.result())
+            except ValueError as e:
+                values.append(str(e))
+        self.assertCountEqual(values, [42, "worker failed"])
+
+
+class AsyncioMainLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.mainloop = event_asyncio.AsyncioMainLoop()
+
+    def tearDown(self):
+        self.mainloop._loop.close()
+
+    def test_timeouts(self):
+        called = []
+        self.mainloop.add_timeout(0.02, lambda: called.append(2))
+        self.mainloop.add_timeout(0.01, lambda: called.append(1))
+        self.mainloop.add_timeout(0, lambda: called.append(0)).cancel()
+        while len(called) < 2:
+            self.mainloop.iterate()
+        self.assertEqual(called, [1, 2])
+
+    def test_fd(self):
+        r, w = os.pipe()
+        data = []
+        watch = self.mainloop.add_fd(r, lambda: data.append(os.read(r, 10)))
+        os.write(w, b"hello")
+        self.mainloop.iterate()
+        watch.remove()
+        os.close(r)
+        os.close(w)
+        self.assertEqual(data, [b"hello"])
+
+    def test_coroutine(self):
+        steps = []
+
+        async def coro():
+            steps.append("start")
+            await asyncio.sleep(0.01)
+            steps.append(await self.mainloop.run_blocking(lambda: 42))
+            return "done"
+
+        task = self.mainloop.create_task(coro())
+        while not task.done():
+            self.mainloop.iterate()
+        self.assertEqual(steps, ["start", 42])
+        self.assertEqual(task.result(), "done")
+
+    def test_coroutine_exception_raised_from_iterate(self):
+        async def coro():
+            await asyncio.sleep(0)
+            raise ValueError("coroutine failed")
+
+        self.mainloop.create_task(coro())
+        with self.assertRaises(ValueError):
+            for _ in range(10):
+                self.mainloop.iterate()
+
+    def test_further_exceptions_logged(self):
+        def fail(n):
+            raise ValueError(f"failure {n}")
+
+        # Both timeouts are called in the same iteration; only the
+        # first exception can be raised from iterate()
+        self.mainloop.add_timeout(0, lambda: fail(1))
+        self.mainloop.add_timeout(0, lambda: fail(2))
+        with self.assertLogs("quicktill.event_asyncio", "ERROR") as cm:
+            with self.assertRaisesRegex(ValueError, "failure 1"):
+                self.mainloop.iterate()
+        self.assertEqual(len(cm.records), 1)
+        self.assertEqual(str(cm.records[0].exc_info[1]), "failure 2")
+
+    def test_shutdown(self):
+        self.mainloop.add_timeout(0, lambda: self.mainloop.shutdown(3))
+        while self.mainloop.exit_code is None:
+            self.mainloop.iterate()
+        self.assertEqual(self.mainloop.exit_code, 3)
+
+
+class LoopStatsTest(unittest.TestCase):
+    def setUp(self):
+        event.stats = event.LoopStats()
+        self.mainloop = event.SelectorsMainLoop()
+
+    def tearDown(self):
+        event.stats = None
+
+    def test_stats_recorded(self):
+        r, w = os.pipe()
+        watch = self.mainloop.add_fd(r, lambda: None, desc="test pipe")
+        os.write(w, b"x")
+        self.mainloop.add_timeout(0, lambda: time.sleep(0.002),
+                                  desc="test timeout")
+        self.mainloop.iterate()
+        # The pipe is still readable; it has been ready since the
+        # first iteration
+        os.read(r, 1)
+        self.mainloop.add_timeout(0, lambda: None)
+        self.mainloop.iterate()
+        watch.remove()
+        os.close(r)
+        os.close(w)
+        h = event.stats.callbacks[("timeout", "test timeout")]
+        self.assertEqual(h.count, 1)
+        self.assertGreaterEqual(h.max, 0.002)
+        self.assertEqual(event.stats.callbacks[("doread", "test pipe")].count,
+                         1)
+        self.assertEqual(event.stats.lag.count, 2)
+        self.assertEqual(event.stats.fd_ready["test pipe"].count, 1)
+        report = event.stats.report()
+        self.assertIn("timeout test timeout", report)
+        self.assertIn("test pipe", report)
+
+
+def benchmark_iterate(pending=10000, iterations=1000):
+    """Time SelectorsMainLoop.iterate() with many timeouts pending
+
+    Not run as part of the tests; run "python -m quicktill.test_event"
+    to print the time taken per call.
+    """
+    mainloop = event.SelectorsMainLoop()
+    # A pipe that is always readable, so that iterate() never blocks
+    r, w = os.pipe()
+    os.write(w, b"x")
+    watch = mainloop.add_fd(r, lambda: None)
+    for i in range(pending):
+        mainloop.add_timeout(60 + i, lambda: None)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        mainloop.iterate()
+    elapsed = time.perf_counter() - start
+    watch.remove()
+    os.close(r)
+    os.close(w)
+    return elapsed / iterations
+
+
+if __name__ == "__main__":
+    print(f"iterate() with 10000 pending timeouts: "
+          f"{benchmark_iterate() * 1e6:.1f}µs per call")
@@ -1,14 +1,30 @@
 from . import models
+from . import linekeys, listen, td, user
 import unittest
 import datetime
 from decimal import Decimal
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, object_session
+from sqlalchemy import create_engine, select, func, event
 from sqlalchemy.exc import IntegrityError
 
 TEST_DATABASE_NAME = "quicktill-test"
 
 
+class FakeListener:
+    """Stands in for the database notification listener
+    """
+    def __init__(self):
+        self.connection = object()
+        self.channels = {}
+
+    def listen_for(self, channel, func):
+        self.channels.setdefault(channel, []).append(func)
+
+    def notify(self, channel, payload):
+        for f in self.channels.get(channel, []):
+            f(payload)
+
+
 class ModelTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -47,6 +63,19 @@ class ModelTest(unittest.TestCase):
         self.s.close()
         self.connection.close()
 
+    def fake_listener(self):
+        """Use the test session, and a fake notification listener
+
+        For code that uses td.s and listen.listener, such as the
+        caches.  Returns the listener.
+        """
+        listener = FakeListener()
+        saved = td.s, listen.listener
+        td.s, listen.listener = self.s, listener
+        self.addCleanup(setattr, td, 's', saved[0])
+        self.addCleanup(setattr, listen, 'listener', saved[1])
+        return listener
+
     def test_add_business(self):
         self.s.add(models.Business(
             id=1, name='Test', abbrev='TEST', address='An address'))
@@ -247,6 +276,84 @@ class ModelTest(unittest.TestCase):
         self.s.refresh(plu)
         self.assertEqual(plu.barcodes, [])
 
+    def test_binding_cache(self):
+        stockline, plu = self.template_stockline_and_plu_setup()
+        self.s.add_all([
+            models.KeyboardBinding(
+                keycode='K_ONE', menukey='', stockline=stockline),
+            models.KeyboardBinding(
+                keycode='K_TWO', menukey='', plu=plu),
+        ])
+        self.s.commit()
+        listener = self.fake_listener()
+        statements = []
+
+        @event.listens_for(self.connection, "before_cursor_execute")
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        self.addCleanup(
+            event.remove, self.connection, "before_cursor_execute", count)
+
+        cache = linekeys.BindingCache()
+        self.assertEqual(cache.bindings('K_ONE')[0].stockline, stockline)
+        self.assertEqual(cache.bindings('K_TWO')[0].plu, plu)
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        self.s.expunge_all()
+        del statements[:]
+        kb = cache.bindings('K_ONE')[0]
+        self.assertEqual(kb.stockline.name, "Test SL")
+        self.assertEqual(kb.stockline.stockonsale, [])
+        self.assertEqual(cache.bindings('K_TWO')[0].plu.price,
+                         Decimal("1.00"))
+        self.assertEqual(statements, [])
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+        # Notifications drop the entries that depend on what changed
+        listener.notify('plu_change', str(plu.id))
+        cache.bindings('K_ONE')
+        cache.bindings('K_TWO')
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+        listener.notify('keyboard_change', 'K_ONE')
+        listener.notify('stockline_change', str(stockline.id + 1))
+        cache.bindings('K_ONE')
+        cache.bindings('K_TWO')
+        self.assertEqual((cache.hits, cache.misses), (4, 4))
+
+        # Putting stock on sale notifies a change to the stock line
+        self.template_removecode_setup()
+        item = models.StockItem(
+            delivery=models.Delivery(
+                date=datetime.date.today(),
+                supplier=models.Supplier(name="Test supplier"),
+                docnumber="test"),
+            stocktype=self.template_stocktype_setup(),
+            description="Firkin", size=72, stockline=stockline,
+            onsale=datetime.datetime.now())
+        self.s.add(item)
+        self.s.commit()
+        listener.notify('stockitem_change', str(item.id))
+        listener.notify('stockline_change', str(stockline.id))
+        self.assertEqual(cache.bindings('K_ONE')[0].stockline.stockonsale,
+                         [item])
+        self.assertEqual((cache.hits, cache.misses), (4, 5))
+
+        # Selling stock doesn't drop the entry, but the quantities are
+        # reloaded
+        self.s.add(models.StockOut(stockitem=item, removecode_id='test',
+                                   qty=1))
+        self.s.commit()
+        listener.notify('stockitem_change', str(item.id))
+        self.s.expunge_all()
+        kb = cache.bindings('K_ONE')[0]
+        self.assertEqual((cache.hits, cache.misses), (5, 5))
+        self.assertEqual(kb.stockline.stockonsale[0].remaining,
+                         Decimal("71.0"))
+
+        # A new listener connection may have missed notifications
+        listener.connection = object()
+        cache.bindings('K_TWO')
+        self.assertEqual((cache.hits, cache.misses), (5, 6))
+
     def test_transline_void(self):
         self.template_setup()
         session = models.Session(date=datetime.date.today())
@@ -270,6 +377,87 @@ class ModelTest(unittest.TestCase):
         self.assertIsNone(transline.voided_by_id)
         self.assertEqual(trans.balance, Decimal("10.00"))
 
+    def test_session_summary(self):
+        self.template_setup()
+        user = self.template_user_setup()
+        self.s.add(models.Department(id=2, description="Other", vatband='A'))
+        session = models.Session(date=datetime.date.today())
+        self.s.add(session)
+        self.s.commit()
+        trans = models.Transaction(session=session)
+        self.s.add_all([
+            models.Transline(
+                transaction=trans, items=2, amount=Decimal("3.00"),
+                discount=Decimal("0.50"), discount_name="Test",
+                dept_id=1, user=user,
+                transcode='S', text="Test sale"),
+            models.Transline(
+                transaction=trans, items=1, amount=Decimal("4.00"),
+                dept_id=2, transcode='S', text="Test sale"),
+        ])
+        self.s.commit()
+        self.assertFalse(session.summarised)
+        live_depts = [tuple(x) for x in session.dept_totals]
+        live_closed = [tuple(x) for x in session.dept_totals_closed]
+        live_vat = session.vatband_totals
+        live_users = [tuple(x) for x in session.user_totals]
+        cash = models.PayType(paytype='CASH', description='Cash')
+        self.s.add(models.Payment(
+            transaction=trans, amount=Decimal("10.00"),
+            paytype=cash, text="Cash"))
+        self.s.commit()
+        trans.closed = True
+        session.endtime = datetime.datetime.now()
+        self.s.commit()
+        self.assertTrue(session.summarised)
+        self.assertEqual(session.total, Decimal("10.00"))
+        self.assertEqual(session.closed_total, Decimal("10.00"))
+        self.assertEqual(session.discount_total, Decimal("1.00"))
+        self.assertEqual([tuple(x) for x in session.dept_totals], live_depts)
+        self.assertEqual(session.vatband_totals, live_vat)
+        self.assertEqual([tuple(x) for x in session.user_totals], live_users)
+        # Closing the transaction moved the totals from pending to paid
+        self.assertEqual(
+            [(d, t, p) for d, t, p, _, _ in session.dept_totals_closed],
+            [(d, t, t) for d, t, _, _, _ in live_closed])
+
+        # A late correction to the closed session
+        correction = models.Transaction(session=session)
+        self.s.add(models.Transline(
+            transaction=correction, items=1, amount=Decimal("5.00"),
+            dept_id=1, transcode='S', text="Late sale"))
+        self.s.commit()
+        self.assertEqual(session.total, Decimal("15.00"))
+        self.assertEqual(session.closed_total, Decimal("10.00"))
+        self.assertEqual(
+            [(d.id, t) for d, t in session.dept_totals],
+            [(1, Decimal("11.00")), (2, Decimal("4.00"))])
+        self.s.delete(correction)
+        self.s.commit()
+        self.assertEqual(session.total, Decimal("10.00"))
+
+        sdt = models.SessionDeptTotal.all_sessions()
+        self.assertEqual(
+            self.s.query(sdt.c.dept, sdt.c.total)
+            .filter(sdt.c.sessionid == session.id)
+            .order_by(sdt.c.dept).all(),
+            [(1, Decimal("6.00")), (2, Decimal("4.00"))])
+
+        # Totals for many sessions at once match the per-session totals
+        open_session = models.Session(date=datetime.date.today())
+        self.s.add(open_session)
+        self.s.add(models.Transline(
+            transaction=models.Transaction(session=open_session),
+            items=1, amount=Decimal("2.40"), dept_id=2, transcode='S',
+            text="Test sale"))
+        self.s.commit()
+        totals = models.Session.vatband_totals_for(
+            self.s, [session, open_session])
+        self.assertEqual(totals[session.id], session.vatband_totals)
+        self.assertEqual(totals[open_session.id],
+                         open_session.vatband_totals)
+        self.assertEqual(totals[open_session.id][0][1], Decimal("2.40"))
+
     def test_delivery_costprice(self):
         self.template_setup()
         beer = self.template_stocktype_setup()
@@ -364,6 +552,425 @@ class ModelTest(unittest.TestCase):
         self.s.commit()
         self.assertEqual(beer.remaining, Decimal("143.0"))
 
+    def test_stock_totals(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        self.s.add(models.RemoveCode(id='sold', reason='Sold'))
+        beer = self.template_stocktype_setup()
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        item = models.StockItem(
+            delivery=delivery,
+            stocktype=beer,
+            description="Firkin",
+            size=72)
+        self.s.add(item)
+        self.s.commit()
+        self.assertEqual(item.used, Decimal("0.0"))
+        self.assertIsNone(item.firstsale)
+        t1 = datetime.datetime(2024, 1, 1, 12, 0)
+        t2 = datetime.datetime(2024, 1, 2, 12, 0)
+        first = models.StockOut(stockitem=item, removecode_id='sold',
+                                qty=1, time=t1)
+        last = models.StockOut(stockitem=item, removecode_id='sold',
+                               qty=2, time=t2)
+        waste = models.StockOut(stockitem=item, removecode_id='test',
+                                qty=Decimal("0.5"))
+        self.s.add_all([first, last, waste])
+        self.s.commit()
+        self.assertEqual(item.used, Decimal("3.5"))
+        self.assertEqual(item.sold, Decimal("3.0"))
+        self.assertEqual(item.remaining, Decimal("68.5"))
+        self.assertEqual(item.firstsale, t1)
+        self.assertEqual(item.lastsale, t2)
+        self.assertEqual(beer.instock, Decimal("68.5"))
+        self.assertEqual(beer.all_instock, Decimal("68.5"))
+        last.removecode_id = 'test'
+        self.s.commit()
+        self.assertEqual(item.sold, Decimal("1.0"))
+        self.assertEqual(item.lastsale, t1)
+        self.s.delete(first)
+        self.s.commit()
+        self.assertEqual(item.used, Decimal("2.5"))
+        self.assertEqual(item.sold, Decimal("0.0"))
+        self.assertIsNone(item.firstsale)
+        self.assertIsNone(item.lastsale)
+        self.assertEqual(models.StockTotals.discrepancies(self.s), [])
+        self.s.execute(models.StockTotals.__table__.update()
+                       .values(used=0))
+        self.assertEqual(models.StockTotals.discrepancies(self.s), [item.id])
+        self.s.execute(select(func.stock_totals_recalculate(item.id)))
+        self.assertEqual(models.StockTotals.discrepancies(self.s), [])
+
+    def test_stocktype_sales(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        self.s.add(models.RemoveCode(id='sold', reason='Sold'))
+        beer = self.template_stocktype_setup()
+        cider = models.StockType(
+            manufacturer="An Orchard", name="A Cider",
+            abv=6, unit=beer.unit, dept_id=1)
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        item = models.StockItem(
+            delivery=delivery,
+            stocktype=beer,
+            description="Firkin",
+            size=72)
+        self.s.add_all([cider, item])
+        self.s.commit()
+
+        def sales():
+            return self.s.execute(
+                select(models.StockTypeSales.stocktype_id,
+                       models.StockTypeSales.date,
+                       models.StockTypeSales.sold)
+                .order_by(models.StockTypeSales.stocktype_id,
+                          models.StockTypeSales.date)).all()
+
+        d1 = datetime.date(2024, 1, 1)
+        d2 = datetime.date(2024, 1, 2)
+        first = models.StockOut(stockitem=item, removecode_id='sold', qty=1,
+                                time=datetime.datetime(2024, 1, 1, 12, 0))
+        second = models.StockOut(stockitem=item, removecode_id='sold', qty=2,
+                                 time=datetime.datetime(2024, 1, 1, 23, 0))
+        third = models.StockOut(stockitem=item, removecode_id='sold', qty=1,
+                                time=datetime.datetime(2024, 1, 2, 12, 0))
+        waste = models.StockOut(stockitem=item, removecode_id='test',
+                                qty=Decimal("0.5"),
+                                time=datetime.datetime(2024, 1, 2, 13, 0))
+        self.s.add_all([first, second, third, waste])
+        self.s.commit()
+        self.assertEqual(sales(), [(beer.id, d1, Decimal("3.0")),
+                                   (beer.id, d2, Decimal("1.0"))])
+        second.time = datetime.datetime(2024, 1, 2, 0, 30)
+        self.s.commit()
+        self.assertEqual(sales(), [(beer.id, d1, Decimal("1.0")),
+                                   (beer.id, d2, Decimal("3.0"))])
+        self.s.delete(first)
+        waste.removecode_id = 'sold'
+        self.s.commit()
+        self.assertEqual(sales(), [(beer.id, d2, Decimal("3.5"))])
+        item.stocktype = cider
+        self.s.commit()
+        self.assertEqual(sales(), [(cider.id, d2, Decimal("3.5"))])
+        self.assertEqual(models.StockTypeSales.discrepancies(self.s), [])
+        self.s.execute(models.StockTypeSales.__table__.update()
+                       .values(sold=1))
+        self.assertEqual(models.StockTypeSales.discrepancies(self.s),
+                         [(cider.id, d2)])
+        self.s.execute(select(func.stocktype_sales_recalculate(cider.id, d2)))
+        self.assertEqual(models.StockTypeSales.discrepancies(self.s), [])
+
+    def test_stock_valuation(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        self.s.add(models.RemoveCode(id='sold', reason='Sold'))
+        beer = self.template_stocktype_setup()
+        supplier = models.Supplier(name="Test supplier")
+
+        def item(date, costprice):
+            delivery = models.Delivery(date=date, supplier=supplier,
+                                       docnumber="test", checked=True)
+            return models.StockItem(delivery=delivery, stocktype=beer,
+                                    description="Firkin", size=72,
+                                    costprice=costprice)
+
+        def value(time):
+            return [(d.id, v) for d, v in
+                    models.StockValuation.department_values(self.s, time)]
+
+        old = item(datetime.date(2024, 1, 1), Decimal("72.00"))
+        new = item(datetime.date(2024, 1, 3), Decimal("144.00"))
+        self.s.add_all([old, new])
+        self.s.add_all([
+            models.StockOut(stockitem=old, removecode_id='sold', qty=18,
+                            time=datetime.datetime(2024, 1, 1, 20, 0)),
+            models.StockOut(stockitem=old, removecode_id='test', qty=18,
+                            time=datetime.datetime(2024, 1, 2, 20, 0)),
+            # Used before its delivery date, which does happen
+            models.StockOut(stockitem=new, removecode_id='sold', qty=36,
+                            time=datetime.datetime(2024, 1, 2, 21, 0)),
+            models.StockOut(stockitem=new, removecode_id='sold', qty=18,
+                            time=datetime.datetime(2024, 1, 3, 20, 0)),
+        ])
+        self.s.commit()
+        times = [datetime.datetime(2024, 1, 1, 12, 0),
+                 datetime.datetime(2024, 1, 2, 12, 0),
+                 datetime.datetime(2024, 1, 3, 12, 0),
+                 datetime.datetime(2024, 1, 4, 12, 0)]
+        expected = [value(t) for t in times]
+        self.assertEqual(expected, [
+            [(1, Decimal("72.00"))],
+            [(1, Decimal("54.00"))],
+            [(1, Decimal("108.00"))],
+            [(1, Decimal("72.00"))],
+        ])
+        v = models.StockValuation.take(
+            self.s, datetime.datetime(2024, 1, 2, 12, 0))
+        self.s.commit()
+        self.assertEqual(v.total, Decimal("54.00"))
+        self.assertEqual([value(t) for t in times], expected)
+        old.finished = datetime.datetime(2024, 1, 3, 23, 0)
+        old.finishcode_id = 'empty'
+        self.s.add(models.FinishCode(id='empty', description='Empty'))
+        self.s.commit()
+        self.assertEqual(value(times[3]), [(1, Decimal("36.00"))])
+        self.assertEqual(models.StockValuation.nearest(self.s, times[3]), v)
+        self.assertIsNone(models.StockValuation.nearest(self.s, times[0]))
+        self.assertEqual(models.StockValuation.discrepancies(self.s), [])
+        # Stock used before the valuation, recorded after it was taken
+        self.s.add(models.StockOut(
+            stockitem=old, removecode_id='test', qty=1,
+            time=datetime.datetime(2024, 1, 1, 21, 0)))
+        self.s.commit()
+        self.assertEqual(models.StockValuation.discrepancies(self.s), [v.id])
+        self.s.delete(v)
+        self.s.commit()
+        self.assertEqual(models.StockValuation.discrepancies(self.s), [])
+
+    @staticmethod
+    def _commit_snapshot_by_item(stocktake, user):
+        # The original implementation of StockTake.commit_snapshot(),
+        # which deals with one stock item at a time
+        s = object_session(stocktake)
+        stocktake.commit_time = func.current_timestamp()
+        stocktake.commit_user = user
+        for ss in stocktake.snapshots:
+            if ss.finishcode:
+                ss.stockitem.finishcode = ss.finishcode
+                ss.stockitem.stockline = None
+                ss.stockitem.displayqty = None
+                if not ss.stockitem.finished:
+                    ss.stockitem.finished = func.current_timestamp()
+            if not ss.finishcode:
+                ss.stockitem.finishcode = None
+                ss.stockitem.finished = None
+            ss.stockitem.bestbefore = ss.newbestbefore
+            for a in ss.adjustments:
+                s.add(models.StockOut(
+                    stockitem=ss.stockitem,
+                    time=func.current_timestamp(),
+                    removecode=a.removecode,
+                    stocktake=stocktake,
+                    qty=a.qty))
+        s.query(models.StockType)\
+         .filter(models.StockType.stocktake == stocktake)\
+         .update({models.StockType.stocktake_id: None})
+
+    def test_stocktake_commit(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        self.s.add(models.RemoveCode(id='missing', reason='Missing'))
+        self.s.add(models.FinishCode(id='empty', description='Empty'))
+        user = self.template_user_setup()
+        beer = self.template_stocktype_setup()
+        stockline = models.StockLine(
+            name="Fridge", location="Test", linetype="display",
+            capacity=24, stocktype=beer)
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        items = [models.StockItem(
+            delivery=delivery, stocktype=beer, description="Case",
+            size=24, bestbefore=datetime.date(2024, 1, 1))
+            for _ in range(6)]
+        items[1].stockline = stockline
+        items[1].displayqty = 6
+        items[2].stockline = stockline
+        items[3].finished = datetime.datetime(2024, 1, 1, 12, 0)
+        items[3].finishcode_id = 'empty'
+        items[4].finished = datetime.datetime(2024, 1, 1, 12, 0)
+        items[4].finishcode_id = 'empty'
+        # Two unfinished items on the same line that are not yet in
+        # stockline_stocktype_log
+        items[5].stockline = stockline
+        self.s.add_all(items)
+        self.s.add(models.StockOut(
+            stockitem=items[1], removecode_id='test', qty=2))
+        stocktake = models.StockTake(description="Test", create_user=user)
+        beer.stocktake = stocktake
+        self.s.add(stocktake)
+        self.s.commit()
+        stocktake.take_snapshot()
+        self.s.commit()
+        # The test runs in a single transaction, so current_timestamp
+        # doesn't change
+        stocktake.start_time = datetime.datetime(2024, 1, 2, 12, 0)
+        # Finished items are added to a stock take by hand
+        bestbefore = datetime.date(2024, 1, 1)
+        self.s.add_all([
+            models.StockTakeSnapshot(
+                stocktake=stocktake, stockitem=items[3], qty=0,
+                finishcode_id='empty', bestbefore=bestbefore,
+                newbestbefore=bestbefore),
+            models.StockTakeSnapshot(
+                stocktake=stocktake, stockitem=items[4], qty=0,
+                finishcode_id='empty', bestbefore=bestbefore),
+        ])
+        self.s.commit()
+        snapshots = {ss.stock_id: ss for ss in stocktake.snapshots}
+        self.assertEqual(len(snapshots), 6)
+        for ss in snapshots.values():
+            ss.checked = True
+        snapshots[items[0].id].newbestbefore = datetime.date(2024, 2, 1)
+        snapshots[items[1].id].finishcode_id = 'empty'
+        snapshots[items[2].id].adjustments.append(
+            models.StockTakeAdjustment(removecode_id='test', qty=3))
+        snapshots[items[2].id].adjustments.append(
+            models.StockTakeAdjustment(removecode_id='missing', qty=1))
+        snapshots[items[4].id].finishcode_id = None
+        snapshots[items[4].id].adjustments.append(
+            models.StockTakeAdjustment(removecode_id='missing', qty=-4))
+        self.s.commit()
+
+        def result():
+            self.s.flush()
+            self.s.expire_all()
+            stock = self.s.execute(
+                select(models.StockItem.__table__)
+                .order_by(models.StockItem.id)).all()
+            stockout = self.s.execute(
+                select(models.StockOut.stockid, models.StockOut.removecode_id,
+                       models.StockOut.stocktake_id, models.StockOut.qty,
+                       models.StockOut.time)
+                .order_by(models.StockOut.stockid,
+                          models.StockOut.removecode_id)).all()
+            st = self.s.execute(
+                select(models.StockTake.__table__)).all()
+            scope = self.s.execute(
+                select(models.StockType.stocktake_id)).all()
+            return stock, stockout, st, scope
+
+        nested = self.s.begin_nested()
+        self._commit_snapshot_by_item(stocktake, user)
+        expected = result()
+        nested.rollback()
+        self.s.expire_all()
+        stocktake.commit_snapshot(user)
+        self.assertEqual(result(), expected)
+
+        stock, stockout, _, scope = expected
+        self.assertEqual(len(stockout), 4)
+        self.assertEqual(scope, [(None,)])
+        self.assertEqual(stock[1].finishcode, 'empty')
+        self.assertIsNone(stock[1].stocklineid)
+        self.assertEqual(stock[0].bestbefore, datetime.date(2024, 2, 1))
+        self.assertIsNone(stock[4].finished)
+
+    def test_stockline_auto_allocate(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        u = self.template_user_setup()
+        self.s.add(models.AnnotationType(id='start', description='Start'))
+        beer = self.template_stocktype_setup()
+        cider = models.StockType(
+            manufacturer="An Orchard", name="A Cider", abv=5,
+            unit=beer.unit, dept_id=1)
+        wine = models.StockType(
+            manufacturer="A Vineyard", name="A Wine", abv=12,
+            unit=beer.unit, dept_id=1)
+        fridge = models.StockLine(
+            name="Fridge", location="Test", linetype="display",
+            capacity=24, stocktype=beer)
+        cider_lines = [models.StockLine(
+            name=f"Cider {n}", location="Test", linetype="display",
+            capacity=24, stocktype=cider) for n in (1, 2)]
+        supplier = models.Supplier(name="Test supplier")
+        checked = models.Delivery(
+            date=datetime.date.today(), supplier=supplier,
+            docnumber="test", checked=True)
+        unchecked = models.Delivery(
+            date=datetime.date.today(), supplier=supplier,
+            docnumber="test2", checked=False)
+
+        def item(stocktype, delivery=checked, **kwargs):
+            return models.StockItem(
+                delivery=delivery, stocktype=stocktype, description="Case",
+                size=24, **kwargs)
+        items = [
+            item(beer),
+            item(beer),
+            item(beer, delivery=unchecked),
+            item(beer, stockline=fridge, displayqty=3),
+            item(cider),
+            item(wine),
+        ]
+        self.s.add_all([fridge, wine] + cider_lines + items)
+        self.s.add(models.StockOut(
+            stockitem=items[1], removecode_id='test', qty=2))
+        self.s.commit()
+        self.assertEqual(items[1].used, 2)
+
+        allocated, manual = models.StockLine.auto_allocate(self.s, user=u)
+        self.assertEqual(allocated, items[:2])
+        self.assertEqual(manual, [(items[4], cider_lines)])
+        self.s.commit()
+        self.assertEqual([i.stockline for i in items],
+                         [fridge, fridge, None, fridge, None, None])
+        self.assertEqual([i.displayqty for i in items[:2]], [0, 2])
+        self.assertEqual([log.stocktype for log in fridge.stocktype_log],
+                         [beer])
+        self.assertIsNotNone(items[0].onsale)
+        self.assertEqual(
+            [(a.type.id, a.text, a.user) for a in items[0].annotations],
+            [('start', "Fridge (auto-allocate)", u)])
+        self.assertEqual(items[3].annotations, [])
+
+        # Nothing left to allocate from the checked delivery
+        unchecked.checked = True
+        self.s.commit()
+        allocated, manual = models.StockLine.auto_allocate(
+            self.s, deliveryid=checked.id)
+        self.assertEqual(allocated, [])
+        allocated, manual = models.StockLine.auto_allocate(
+            self.s, deliveryid=unchecked.id)
+        self.assertEqual(allocated, [items[2]])
+        self.assertEqual(manual, [])
+        self.assertIsNone(items[2].annotations[0].user)
+
+    def test_display_stockline_calculate_sale(self):
+        self.template_setup()
+        self.template_removecode_setup()
+        beer = self.template_stocktype_setup()
+        stockline = models.StockLine(
+            name="Fridge", location="Test", linetype="display",
+            capacity=24, stocktype=beer)
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        items = [
+            models.StockItem(
+                delivery=delivery, stocktype=beer, description="Case",
+                size=24, stockline=stockline, displayqty=displayqty)
+            for displayqty in (2, 24, None)]
+        self.s.add_all(items)
+        self.s.add(models.StockOut(
+            stockitem=items[0], removecode_id='test', qty=1))
+        self.s.commit()
+        self.s.expire_all()
+
+        statements = []
+
+        @event.listens_for(self.connection, "before_cursor_execute")
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sell, unallocated, remaining = stockline.calculate_sale(Decimal(3))
+        event.remove(self.connection, "before_cursor_execute", count)
+        # One query to load the stock line, and one to load all the
+        # stock on sale along with its quantities
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(sell, [(items[1], Decimal(3))])
+        self.assertEqual(unallocated, Decimal(0))
+        self.assertEqual(remaining, (Decimal(22), Decimal(46)))
+
     def test_annotation_delete_cascade(self):
         self.template_setup()
         beer = self.template_stocktype_setup()
@@ -409,6 +1016,62 @@ class ModelTest(unittest.TestCase):
         self.assertIn(pa, permissions)
         self.assertNotIn(pb, permissions)
 
+    def test_permission_cache(self):
+        u = self.template_user_setup()
+        other = models.User(fullname="B User", shortname="B", enabled=True)
+        self.s.add(other)
+        self.s.commit()
+
+        listener = self.fake_listener()
+        cache = user.PermissionCache()
+        self.assertEqual(cache.permissions(u.id), frozenset(['frob']))
+        self.addCleanup(event.remove, self.s, 'after_rollback',
+                        cache._changed)
+        self.assertEqual(cache.permissions(other.id), frozenset())
+        self.s.commit()
+        self.assertEqual(cache.permissions(u.id), frozenset(['frob']))
+        self.assertEqual(cache.loads, 1)
+
+        # Changes are picked up when they are notified
+        group = self.s.get(models.Group, 'basic-users')
+        group.permissions.append(self.s.get(models.Permission, 'wibble'))
+        other.groups.append(group)
+        self.s.commit()
+        self.assertEqual(cache.permissions(other.id), frozenset())
+        listener.notify('group_membership_changed', '')
+        self.assertEqual(cache.permissions(u.id),
+                         frozenset(['frob', 'wibble']))
+        self.assertEqual(cache.permissions(other.id),
+                         frozenset(['frob', 'wibble']))
+        self.assertEqual(cache.loads, 2)
+        listener.notify('group_grants_changed', '')
+        cache.permissions(u.id)
+        self.assertEqual(cache.loads, 3)
+
+        # A new listener connection may have missed notifications
+        listener.connection = object()
+        cache.permissions(u.id)
+        self.assertEqual(cache.loads, 4)
+
+        # The user object for a login uses the cache
+        self.assertEqual(sorted(user.database_user(other).all_permissions),
+                         ['frob', 'wibble'])
+        self.assertEqual(cache.loads, 4)
+
+        # Rolling back another session doesn't affect the cache
+        with self._sm() as other_session:
+            other_session.execute(select(1))
+            other_session.rollback()
+        cache.permissions(u.id)
+        self.assertEqual(cache.loads, 4)
+
+        # The cache may have seen changes that are rolled back in the
+        # session it was loaded in
+        userid = u.id
+        self.s.rollback()
+        cache.permissions(userid)
+        self.assertEqual(cache.loads, 5)
+
     def test_group_rename(self):
         user = self.template_user_setup()
         group = self.s.get(models.Group, 'basic-users')
@@ -38,6 +38,24 @@ class PasswordTest(unittest.TestCase):
         hash_foo = passwords.encode_password("foo")
         self.assertTrue(passwords.check_password("foo", hash_foo))
 
+    def test_iterations(self):
+        hash_foo = passwords.encode_password("foo", iterations=1000)
+        self.assertEqual(hash_foo.split("$")[1], "1000")
+        self.assertTrue(passwords.check_password("foo", hash_foo))
+
+    def test_must_update(self):
+        hash_foo = passwords.encode_password("foo")
+        self.assertFalse(passwords.must_update(hash_foo))
+        self.assertTrue(passwords.must_update(hash_foo, iterations=1000))
+        self.assertFalse(passwords.must_update(pass_12345, iterations=720000))
+        self.assertTrue(passwords.must_update(pass_12345))
+
+    def test_calibrate(self):
+        hasher = passwords.get_hasher(None)
+        iterations = passwords.calibrate(0.05)
+        self.assertGreaterEqual(iterations, hasher.min_iterations)
+        self.assertEqual(int(str(iterations)[2:] or "0"), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
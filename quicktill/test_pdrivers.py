@@ -0,0 +1,243 @@
+from . import pdrivers, printer, tillconfig, event, ui
+import unittest
+from unittest import mock
+import io
+import socketserver
+import threading
+import time
+from PIL import Image
+
+
+class StandInPrinterHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.connections += 1
+        data = b""
+        while chunk := self.request.recv(1024):
+            data += chunk
+        if data:
+            self.server.received.append(data)
+
+
+class StandInPrinter(socketserver.ThreadingTCPServer):
+    """A network printer that records what is sent to it
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInPrinterHandler)
+        self.connections = 0
+        self.received = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _test_png():
+    """A small image with some transparent and coloured pixels
+    """
+    img = Image.new("RGBA", (16, 20), (255, 255, 255, 255))
+    for x in range(16):
+        for y in range(20):
+            if (x + y) % 5 == 0:
+                img.putpixel((x, y), (0, 0, 0, 255))
+            elif x < 4:
+                img.putpixel((x, y), (0, 0, 0, 0))
+            elif y > 15:
+                img.putpixel((x, y), (90, 40, 200, 255))
+    f = io.BytesIO()
+    img.save(f, format="PNG")
+    return f.getvalue()
+
+
+# _test_png() as printed by a driver with 24 dots per line, before
+# converted images were cached
+_TEST_PNG_ESCPOS = bytes.fromhex(
+    "1b33001b55011b2a2114000000000000000000000000002108400210840421"
+    "0808421010843c2108680210bc04212c08423810843421086c0210bc042128"
+    "08423c10842821087c0a1b55001b320d0a")
+
+
+def _qrcode_emulated_reference(driver, data, f):
+    """escpos._qrcode_emulated() as it was before it was rewritten
+    """
+    qrcode = pdrivers.qrcode
+    q = qrcode.QRCode(border=2,
+                      error_correction=qrcode.constants.ERROR_CORRECT_H)
+    q.add_data(data)
+    code = q.get_matrix()
+    f.write(pdrivers.escpos.ep_unidirectional_on)
+    lt = {
+        (False, False): bytes([0x00]),
+        (False, True): bytes([0x1c]),
+        (True, False): bytes([0xe0]),
+        (True, True): bytes([0xfc]),
+    }
+    while len(code) > 0:
+        if len(code) > 1:
+            row = zip(code[0], code[1])
+        else:
+            row = zip(code[0], [False] * len(code[0]))
+        code = code[1:]
+        row = b''.join(lt[x] * 3 for x in row)
+        width = len(row)
+        if width > driver.dpl:
+            # Code too wide for paper
+            break
+        padding = (driver.dpl - width) // 2
+        width = width + padding
+        padchars = bytes([0]) * padding
+        header = pdrivers.escpos.ep_bitimage_sd \
+            + bytes([width & 0xff, (width >> 8) & 0xff])
+        f.write(header + padchars + row + b'\r')
+        f.write(pdrivers.escpos.ep_half_dot_feed)
+        f.write(header + padchars + row + b'\r')
+        f.write(pdrivers.escpos.ep_short_feed)
+    f.write(pdrivers.escpos.ep_unidirectional_off)
+
+
+def wait_for(condition, mainloop=None):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        if mainloop:
+            # Don't let the main loop wait for longer than this
+            mainloop.add_timeout(0.01, lambda: None)
+            mainloop.iterate()
+        else:
+            time.sleep(0.01)
+
+
+class NetPrinterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInPrinter()
+        self.addCleanup(self.server.stop)
+        self.printer = pdrivers.netprinter(
+            self.server.server_address, pdrivers.Epson_TM_T20_driver(80))
+
+    def test_offline_does_not_wait(self):
+        # The first check is made in the background
+        release = threading.Event()
+
+        def slow_connect():
+            release.wait(5)
+            raise OSError("No route to host")
+        self.printer._open_socket = slow_connect
+        self.assertIsNone(self.printer.offline())
+        self.assertTrue(self.printer._probe_thread.is_alive())
+        release.set()
+        self.printer._probe_thread.join()
+        self.assertEqual(self.printer.offline(),
+                         "Could not connect to printer: No route to host")
+
+    def test_offline_cached(self):
+        self.assertIsNone(self.printer.offline())
+        self.printer._probe_thread.join()
+        wait_for(lambda: self.server.connections == 1)
+        self.assertEqual(self.server.connections, 1)
+
+        # Asking again within probe_interval doesn't check the printer
+        self.server.stop()
+        for _ in range(3):
+            self.assertIsNone(self.printer.offline())
+        self.assertFalse(self.printer._probe_thread.is_alive())
+        self.assertEqual(self.server.connections, 1)
+
+        # Once the result is old the printer is checked again
+        self.printer._status_time -= self.printer._probe_interval + 1
+        self.printer.offline()
+        self.printer._probe_thread.join()
+        self.assertIn("Could not connect to printer",
+                      self.printer.offline())
+
+    def test_kickout(self):
+        old_mainloop = getattr(tillconfig, 'mainloop', None)
+        tillconfig.mainloop = event.SelectorsMainLoop()
+        if old_mainloop:
+            self.addCleanup(setattr, tillconfig, 'mainloop', old_mainloop)
+        else:
+            self.addCleanup(delattr, tillconfig, 'mainloop')
+        printer.kickout(self.printer)
+        wait_for(lambda: self.server.received,
+                 mainloop=tillconfig.mainloop)
+        self.assertEqual(self.server.received, [pdrivers.escpos.ep_pulse])
+        # The printer is not left connected
+        self.assertIsNone(self.printer._socket)
+
+        # A failure is reported once the attempt has been made
+        self.server.stop()
+        with mock.patch.object(ui, 'infopopup') as infopopup:
+            printer.kickout(self.printer)
+            wait_for(lambda: infopopup.called,
+                     mainloop=tillconfig.mainloop)
+        infopopup.assert_called_once()
+        self.assertIn("Could not kick out the cash drawer",
+                      infopopup.call_args.args[0][0])
+
+
+class EscposImageTest(unittest.TestCase):
+    def setUp(self):
+        pdrivers.clear_image_cache()
+        self.addCleanup(pdrivers.clear_image_cache)
+        self.png = _test_png()
+
+    def _driver(self, dpl=24):
+        driver = pdrivers.escpos(cpl=(4, 6), dpl=dpl, coding='iso-8859-1')
+        rasterise = mock.patch.object(
+            driver, '_rasterise', wraps=driver._rasterise).start()
+        self.addCleanup(mock.patch.stopall)
+        return driver, rasterise
+
+    def _print(self, driver, image):
+        f = io.BytesIO()
+        driver._image(image, f)
+        return f.getvalue()
+
+    def test_image(self):
+        driver, _ = self._driver()
+        self.assertEqual(self._print(driver, self.png), _TEST_PNG_ESCPOS)
+        # Not an image: nothing is printed
+        self.assertEqual(self._print(driver, b"not an image"), b"")
+
+    def test_image_cached(self):
+        driver, rasterise = self._driver()
+        self._print(driver, self.png)
+        # Another driver with the same paper width uses the cache
+        other, other_rasterise = self._driver()
+        self.assertEqual(self._print(other, self.png), _TEST_PNG_ESCPOS)
+        self.assertEqual(rasterise.call_count, 1)
+        self.assertEqual(other_rasterise.call_count, 0)
+        # A driver with a different paper width doesn't
+        wide, wide_rasterise = self._driver(dpl=48)
+        self.assertNotEqual(self._print(wide, self.png), _TEST_PNG_ESCPOS)
+        self.assertEqual(wide_rasterise.call_count, 1)
+
+    def test_publogo_change_clears_cache(self):
+        driver, rasterise = self._driver()
+        self._print(driver, self.png)
+        printer._publogo_changed()
+        self.assertIsNone(printer._publogo)
+        self.assertEqual(self._print(driver, self.png), _TEST_PNG_ESCPOS)
+        self.assertEqual(rasterise.call_count, 2)
+
+
+@unittest.skipUnless(pdrivers._qrcode_supported,
+                     "qrcode library not installed")
+class EscposQRCodeTest(unittest.TestCase):
+    def test_qrcode_emulated(self):
+        # 192 dots per line
+        driver = pdrivers.Epson_TM_U220_driver(76)
+        for data in ("1", "https://quicktill.assorted.org.uk/",
+                     "x" * 100, "x" * 200):
+            with self.subTest(data=data):
+                expected = io.BytesIO()
+                _qrcode_emulated_reference(driver, data, expected)
+                f = mock.Mock(wraps=io.BytesIO())
+                driver._qrcode_emulated(data, f)
+                f.write.assert_called_once()
+                self.assertEqual(f.write.call_args.args[0],
+                                 expected.getvalue())
+        # The last code is too wide for the paper, so nothing is printed
+        self.assertEqual(f.write.call_args.args[0],
+                         pdrivers.escpos.ep_unidirectional_on
+                         + pdrivers.escpos.ep_unidirectional_off)
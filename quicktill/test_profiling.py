@@ -0,0 +1,191 @@
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+import django
+django.setup()
+
+from . import models
+from .tillweb import profiling, views
+from .tillweb import urls
+from .tillweb.db import td
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import include, path
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, select
+
+TEST_DATABASE_NAME = "quicktill-test-profiling"
+
+# Used as ROOT_URLCONF, so that the statistics view can reverse its URL
+urlpatterns = [path('', include(urls.tillurls))]
+
+
+class RequestProfileTest(unittest.TestCase):
+    def setUp(self):
+        profiling.reset()
+        self.addCleanup(profiling.reset)
+
+    def test_record(self):
+        profile = profiling.RequestProfile("test.view")
+        for i in range(profiling.slow_statements + 2):
+            profile.record(i / 1000, f"statement {i}")
+        self.assertEqual(profile.queries, profiling.slow_statements + 2)
+        self.assertAlmostEqual(profile.sql_time, 0.021)
+        # Only the slowest statements are kept, slowest first
+        self.assertEqual(
+            [statement for _, statement in profile.slowest],
+            [f"statement {i}" for i in range(6, 1, -1)])
+
+    def test_server_timing(self):
+        profile = profiling.RequestProfile("test.view")
+        profile.record(0.0125, "select 1")
+        profile.view_done()
+        profile.record(0.001, "select 2")
+        profile.finish()
+        self.assertEqual(profile.view_queries, 1)
+        timing = profile.server_timing()
+        self.assertTrue(
+            timing.startswith('sql;desc="2 queries";dur=13.5, view;dur='),
+            timing)
+        self.assertIn(", render;dur=", timing)
+
+    @override_settings(TILLWEB_QUERY_BUDGET=2)
+    def test_stats(self):
+        for queries in (1, 2):
+            profile = profiling.RequestProfile("test.view")
+            for i in range(queries):
+                profile.record(0.001, "select 1")
+            profiling.record(profile)
+        vs = profiling.stats["test.view"]
+        self.assertEqual(vs.requests, 2)
+        self.assertEqual(vs.queries, 3)
+        self.assertEqual(vs.max_queries, 2)
+        self.assertEqual(vs.mean_queries, 1.5)
+        self.assertEqual(vs.over_budget, 0)
+        self.assertEqual(len(vs.slowest), 3)
+
+    @override_settings(TILLWEB_QUERY_BUDGET=2)
+    def test_query_budget(self):
+        profile = profiling.RequestProfile("test.view")
+        profile.record(0.001, "select 1")
+        profile.view_done()
+        for i in range(2):
+            profile.record(0.001, "select 1")
+        with self.assertLogs(profiling.log, "WARNING") as cm:
+            profiling.record(profile)
+        self.assertEqual(cm.records[0].getMessage(),
+                         "Excessive queries in view test.view (1 pre render, "
+                         "2 during render, budget 2)")
+        self.assertEqual(profiling.stats["test.view"].over_budget, 1)
+
+
+def counting_view(request, info, queries):
+    for i in range(queries):
+        td.s.execute(select(i))
+    return HttpResponse("ok")
+
+
+class TillwebViewProfileTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        engine = create_engine("postgresql+psycopg2:///postgres", future=True)
+        raw_connection = engine.raw_connection()
+        with raw_connection.cursor() as cursor:
+            cursor.execute('commit')
+            cursor.execute(f'create database "{TEST_DATABASE_NAME}"')
+        raw_connection.close()
+        cls._engine = create_engine(
+            f"postgresql+psycopg2:///{TEST_DATABASE_NAME}", future=True)
+        models.metadata.create_all(cls._engine)
+        cls._sm = sessionmaker(cls._engine, future=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._engine.dispose()
+        del cls._engine
+        engine = create_engine("postgresql+psycopg2:///postgres", future=True)
+        raw_connection = engine.raw_connection()
+        with raw_connection.cursor() as cursor:
+            cursor.execute('commit')
+            cursor.execute(f'drop database "{TEST_DATABASE_NAME}"')
+        raw_connection.close()
+
+    def setUp(self):
+        profiling.reset()
+        self.addCleanup(profiling.reset)
+        self.connection = self._engine.connect()
+        self.connection.begin()
+        self.addCleanup(self.connection.close)
+        with self._sm(bind=self.connection) as s:
+            s.add_all([
+                models.User(fullname="Manager", shortname="Manager",
+                            webuser="manager", enabled=True,
+                            superuser=True),
+                models.User(fullname="Staff", shortname="Staff",
+                            webuser="staff", enabled=True),
+            ])
+            s.flush()
+        settings = override_settings(
+            TILLWEB_PUBNAME="Test",
+            TILLWEB_DEFAULT_ACCESS="M",
+            TILLWEB_DATABASE=lambda: self._sm(bind=self.connection),
+            TILLWEB_MONEY_SYMBOL="£",
+            TILLWEB_LOGIN_REQUIRED=False,
+            ROOT_URLCONF=__name__)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.view = views.tillweb_view(counting_view)
+        self.factory = RequestFactory()
+
+    def _get(self, view, user=None, **kwargs):
+        request = self.factory.get("/")
+        request.user = SimpleNamespace(
+            is_authenticated=user is not None, username=user)
+        return view(request, **kwargs)
+
+    def test_view(self):
+        response = self._get(self.view, queries=3)
+        self.assertTrue(
+            response['Server-Timing'].startswith('sql;desc="3 queries";'),
+            response['Server-Timing'])
+        self._get(self.view, queries=1)
+        vs = profiling.stats["test_profiling.counting_view"]
+        self.assertEqual(vs.requests, 2)
+        self.assertEqual(vs.queries, 4)
+        self.assertEqual(vs.max_queries, 3)
+        self.assertEqual(vs.over_budget, 0)
+
+    @override_settings(TILLWEB_QUERY_BUDGET=2)
+    def test_view_over_budget(self):
+        with self.assertLogs(profiling.log, "WARNING") as cm:
+            self._get(self.view, queries=3)
+        self.assertIn("Excessive queries in view "
+                      "test_profiling.counting_view (3 pre render",
+                      cm.records[0].getMessage())
+        self.assertEqual(
+            profiling.stats["test_profiling.counting_view"].over_budget, 1)
+
+    @override_settings(TILLWEB_PROFILE=False)
+    def test_disabled(self):
+        response = self._get(self.view, queries=1)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(profiling.stats, {})
+
+    def test_view_statistics(self):
+        self._get(self.view, queries=2)
+        with mock.patch.object(views, 'render',
+                               return_value=HttpResponse()) as render:
+            self._get(views.view_statistics, user="manager")
+        template, context = render.call_args.args[1:]
+        self.assertEqual(template, "tillweb/view-statistics.html")
+        self.assertEqual([vs.view for vs in context['views']],
+                         ["test_profiling.counting_view"])
+        self.assertEqual(context['views'][0].queries, 2)
+
+    def test_view_statistics_permission(self):
+        with self.assertRaises(PermissionDenied):
+            self._get(views.view_statistics, user="staff")
@@ -0,0 +1,126 @@
+from . import models
+from . import td, tillconfig, register, payment
+import unittest
+import datetime
+from decimal import Decimal
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine
+
+TEST_DATABASE_NAME = "quicktill-test-register"
+
+
+class _TestPage(register.page):
+    """Just enough of a register page to balance a transaction
+
+    The real page needs a display to draw on.
+    """
+    def __init__(self, transid):
+        self.transid = transid
+        self._autolock = None
+        self.locked = False
+        self.ml = set()
+        self.balance = models.zero
+        trans = self._gettrans()
+        self.dl = [register.tline(l.id) for l in trans.lines] \
+            + [payment.pline(p) for p in trans.payments]
+
+    def entry(self):
+        return True
+
+    def cursor_off(self):
+        pass
+
+    def _redraw(self):
+        pass
+
+
+class RegisterTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        engine = create_engine("postgresql+psycopg2:///postgres", future=True)
+        raw_connection = engine.raw_connection()
+        with raw_connection.cursor() as cursor:
+            cursor.execute('commit')
+            cursor.execute(f'create database "{TEST_DATABASE_NAME}"')
+        raw_connection.close()
+        cls._engine = create_engine(
+            f"postgresql+psycopg2:///{TEST_DATABASE_NAME}", future=True)
+        models.metadata.create_all(cls._engine)
+        cls._sm = sessionmaker(cls._engine, future=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._engine.dispose()
+        del cls._engine
+        engine = create_engine("postgresql+psycopg2:///postgres", future=True)
+        raw_connection = engine.raw_connection()
+        with raw_connection.cursor() as cursor:
+            cursor.execute('commit')
+            cursor.execute(f'drop database "{TEST_DATABASE_NAME}"')
+        raw_connection.close()
+
+    def setUp(self):
+        self.connection = self._engine.connect()
+        self.connection.begin()
+        self.s = self._sm(bind=self.connection)
+        self._saved_s = td.s
+        td.s = self.s
+        tillconfig.currency._test_set("£")
+
+    def tearDown(self):
+        td.s = self._saved_s
+        self.s.close()
+        self.connection.close()
+
+    def _transaction(self):
+        business = models.Business(
+            id=1, name='Test', abbrev='TEST', address='An address')
+        vatband = models.VatBand(band='A', business=business, rate=0.2)
+        dept = models.Department(id=1, description="Test", vat=vatband)
+        sale = models.TransCode(code='S', description='Sale')
+        self.card = models.PayType(paytype='CARD', description='Card')
+        session = models.Session(date=datetime.date.today())
+        trans = models.Transaction(session=session)
+        self.s.add_all([business, vatband, dept, sale, self.card, session,
+                        trans])
+        self.s.add(models.Transline(
+            transaction=trans, items=1, amount=Decimal("10.00"),
+            dept_id=1, transcode='S', text="Test sale"))
+        self.s.add(models.Payment(
+            transaction=trans, amount=Decimal("6.00"), paytype=self.card,
+            text="Card"))
+        self.s.flush()
+        return trans
+
+    def test_payments_added_outside_display(self):
+        # A payment method may add payments to the transaction
+        # without adding them to the register's display, for example
+        # when a card payment is split across several cards
+        trans = self._transaction()
+        page = _TestPage(trans.id)
+        self.assertEqual(page.running_totals(),
+                         (Decimal("10.00"), Decimal("0.00"),
+                          Decimal("6.00")))
+        self.s.add(models.Payment(
+            transaction=trans, amount=Decimal("4.00"), paytype=self.card,
+            text="Card"))
+        page.payments_update()
+        self.assertTrue(trans.closed)
+        self.assertEqual(page.balance, models.zero)
+        self.assertEqual(
+            [p.amount for p in page.dl if isinstance(p, payment.pline)],
+            [Decimal("6.00"), Decimal("4.00")])
+
+    def test_unbalanced_display_checked_against_database(self):
+        # If the database shows the transaction is balanced but the
+        # display doesn't, it is reloaded rather than left open
+        trans = self._transaction()
+        page = _TestPage(trans.id)
+        self.s.add(models.Payment(
+            transaction=trans, amount=Decimal("4.00"), paytype=self.card,
+            text="Card"))
+        self.s.flush()
+        reloaded = []
+        page._loadtrans = reloaded.append
+        page.close_if_balanced()
+        self.assertEqual(reloaded, [trans.id])
@@ -0,0 +1,136 @@
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from .tillweb import sheetstream
+import unittest
+import csv
+import datetime
+import io
+from decimal import Decimal
+from odf.opendocument import load
+from odf.namespaces import OFFICENS, TABLENS
+from odf import table, text
+import openpyxl
+
+SHEET_NAME = 'Sales & "costs" 1/2'
+DATE = datetime.date(2026, 10, 17)
+DATETIME = datetime.datetime(2026, 10, 17, 21, 30)
+SUM_FORMULA = "oooc:=SUM([.B2:.B3])"
+
+
+def _build(format):
+    doc = sheetstream.StreamingDocument("test", format=format)
+    sheet = doc.sheet(SHEET_NAME)
+    sheet.colstyle(0, doc.colwidth("3cm"))
+    sheet.cell(0, 0, doc.headercell("Date"))
+    sheet.cell(1, 0, doc.headercell("Amount"))
+    sheet.cell(2, 0, doc.textcell(None))
+    sheet.cell(0, 1, doc.datecell(DATE))
+    sheet.cell(1, 1, doc.moneycell(Decimal("1.50")))
+    sheet.cell(2, 1, doc.textcell("<b> & co"))
+    # Cells in a row can be set in any order
+    sheet.cell(1, 2, doc.moneycell(Decimal("2.25")))
+    sheet.cell(0, 2, doc.datetimecell(DATETIME))
+    # Row 3 is left empty
+    sheet.cell(1, 4, doc.moneycell(None, formula=SUM_FORMULA))
+    sheet.cell(3, 4, doc.intcell(3))
+    doc.add_table(sheet)
+    response = doc.as_response()
+    return response["Content-Type"], response.filename, \
+        b"".join(response.streaming_content)
+
+
+class StreamingDocumentTest(unittest.TestCase):
+    def test_ods(self):
+        mimetype, filename, content = _build("ods")
+        self.assertEqual(mimetype,
+                         "application/vnd.oasis.opendocument.spreadsheet")
+        self.assertEqual(filename, "test.ods")
+        doc = load(io.BytesIO(content))
+        tables = doc.spreadsheet.getElementsByType(table.Table)
+        self.assertEqual([t.getAttrNS(TABLENS, "name") for t in tables],
+                         [SHEET_NAME])
+        rows = []
+        for tr in tables[0].getElementsByType(table.TableRow):
+            row = []
+            for tc in tr.getElementsByType(table.TableCell):
+                repeat = int(tc.getAttrNS(
+                    TABLENS, "number-columns-repeated") or 1)
+                valuetype = tc.getAttrNS(OFFICENS, "value-type")
+                if valuetype == "string":
+                    value = "".join(str(p) for p in
+                                    tc.getElementsByType(text.P))
+                elif valuetype == "date":
+                    value = tc.getAttrNS(OFFICENS, "date-value")
+                else:
+                    value = tc.getAttrNS(OFFICENS, "value")
+                formula = tc.getAttrNS(TABLENS, "formula")
+                row.extend([(valuetype, value, formula)] * repeat)
+            repeat = int(tr.getAttrNS(TABLENS, "number-rows-repeated") or 1)
+            rows.extend([row] * repeat)
+        empty = (None, None, None)
+        self.assertEqual(rows, [
+            [("string", "Date", None), ("string", "Amount", None), empty],
+            [("date", "2026-10-17", None), ("currency", "1.50", None),
+             ("string", "<b> & co", None)],
+            [("date", "2026-10-17T21:30:00", None),
+             ("currency", "2.25", None)],
+            [empty],
+            [empty, ("currency", None, SUM_FORMULA), empty,
+             ("float", "3", None)],
+        ])
+
+    def test_xlsx(self):
+        mimetype, filename, content = _build("xlsx")
+        self.assertEqual(filename, "test.xlsx")
+        wb = openpyxl.load_workbook(io.BytesIO(content))
+        # Characters that Excel doesn't allow in sheet names are replaced
+        self.assertEqual(wb.sheetnames, ['Sales & "costs" 1_2'])
+        ws = wb.active
+        self.assertEqual(
+            [[c.value for c in row] for row in ws.iter_rows()],
+            [["Date", "Amount", None, None],
+             [datetime.datetime(2026, 10, 17), 1.5, "<b> & co", None],
+             [DATETIME, 2.25, None, None],
+             [None, None, None, None],
+             [None, "=SUM(B2:B3)", None, 3]])
+        self.assertTrue(ws["A2"].is_date)
+        self.assertEqual(ws["B2"].number_format, '"£"#,##0.00')
+        self.assertTrue(ws["A1"].font.b)
+
+    def test_xlsx_sheet_names_unique(self):
+        doc = sheetstream.StreamingDocument(format="xlsx")
+        for name in ("Stock", "stock", "x" * 40, "x" * 40):
+            doc.sheet(name).cell(0, 0, doc.textcell(name))
+        content = b"".join(doc.as_response().streaming_content)
+        wb = openpyxl.load_workbook(io.BytesIO(content))
+        self.assertEqual(wb.sheetnames, [
+            "Stock", "stock (2)", "x" * 31, "x" * 27 + " (2)"])
+
+    def test_csv(self):
+        mimetype, filename, content = _build("csv")
+        self.assertEqual(mimetype, "text/csv")
+        self.assertEqual(filename, "test.csv")
+        rows = list(csv.reader(io.StringIO(content.decode("utf-8"))))
+        self.assertEqual(rows, [
+            ["Date", "Amount", ""],
+            ["2026-10-17", "1.50", "<b> & co"],
+            ["2026-10-17 21:30:00", "2.25"],
+            [],
+            ["", "=SUM(B2:B3)", "", "3"],
+        ])
+
+    def test_csv_one_sheet(self):
+        doc = sheetstream.StreamingDocument(format="csv")
+        doc.sheet("One").cell(0, 0, doc.textcell("x"))
+        doc.sheet("Two").cell(0, 0, doc.textcell("y"))
+        with self.assertRaises(ValueError):
+            doc.as_response()
+
+    def test_rows_in_order(self):
+        doc = sheetstream.StreamingDocument()
+        sheet = doc.sheet("Test")
+        sheet.cell(0, 2, doc.textcell("x"))
+        with self.assertRaises(ValueError):
+            sheet.cell(0, 1, doc.textcell("y"))
@@ -0,0 +1,70 @@
+from . import event
+from . import spooler
+from . import tillconfig
+import unittest
+import time
+
+
+class FlakyPrinter:
+    """Records the canvases it prints; fails the first few attempts
+    """
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.printed = []
+
+    def print_canvas(self, canvas):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Printer on fire")
+        self.printed.append(canvas)
+
+
+class SpoolerTest(unittest.TestCase):
+    def setUp(self):
+        self._old_mainloop = getattr(tillconfig, 'mainloop', None)
+        tillconfig.mainloop = event.SelectorsMainLoop()
+        self.spooler = spooler.Spooler()
+        self.spooler.min_delay = 0
+
+    def tearDown(self):
+        if self._old_mainloop:
+            tillconfig.mainloop = self._old_mainloop
+        else:
+            del tillconfig.mainloop
+
+    def run_until_idle(self):
+        deadline = time.time() + 5
+        while any(q.jobs for q in self.spooler.queues):
+            self.assertLess(time.time(), deadline)
+            tillconfig.mainloop.iterate()
+
+    def test_jobs_printed_in_order_after_retry(self):
+        p = FlakyPrinter(failures=2)
+        jobs = [self.spooler.submit(p, n, f"job {n}") for n in range(3)]
+        self.run_until_idle()
+        self.assertEqual(p.printed, [0, 1, 2])
+        self.assertEqual(jobs[0].attempts, 3)
+        self.assertEqual(jobs[0].last_error, "Printer on fire")
+        self.assertEqual(jobs[1].attempts, 1)
+        self.assertEqual(self.spooler.printed, 3)
+        self.assertEqual(self.spooler.failed, 0)
+
+    def test_failing_printer_does_not_hold_up_others(self):
+        jammed = FlakyPrinter(failures=1000)
+        ok = FlakyPrinter()
+        self.spooler.min_delay = 60
+        self.spooler.submit(jammed, "a", "job a")
+        self.spooler.submit(ok, "b", "job b")
+        q = self.spooler.queues[0]
+        self.assertEqual(q.printer, jammed)
+        # Wait for job b to be printed and the first attempt at job a
+        # to have failed; they finish in either order
+        deadline = time.time() + 5
+        while not ok.printed or q.sending:
+            self.assertLess(time.time(), deadline)
+            tillconfig.mainloop.iterate()
+        self.assertEqual(ok.printed, ["b"])
+        self.assertTrue(q.state.startswith("waiting until"))
+        self.spooler.cancel(q, q.jobs[0])
+        self.assertEqual(q.state, "idle")
+        self.assertIsNone(q.retry_timeout)
@@ -0,0 +1,462 @@
+from . import models
+from . import td, session, delivery, startup, xero, secretstore
+import unittest
+from unittest import mock
+import datetime
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.parse
+import uuid
+import requests
+from cryptography.fernet import Fernet
+from decimal import Decimal
+from xml.etree.ElementTree import Element, SubElement, tostring, fromstring
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, delete
+
+TEST_DATABASE_NAME = "quicktill-test-xero"
+
+
+class StandInXeroHandler(http.server.BaseHTTPRequestHandler):
+    """Enough of the Xero API to accept invoices, bills and payments
+
+    Invoices with a line item for account "999" are rejected.  The
+    server's "statuses" list supplies error responses to send before
+    accepting any more requests.  If the server's "hold" is an Event,
+    replies to these requests wait until it is set.
+
+    Tokens are refreshed at /connect/token, and the tenant "tenant"
+    is listed at /connections.
+    """
+    def do_PUT(self):
+        url = urllib.parse.urlsplit(self.path)
+        body = urllib.parse.parse_qs(
+            self.rfile.read(int(self.headers['Content-Length'])).decode())
+        sent = fromstring(body['xml'][0])
+        self.server.requests.append(
+            (url.path, urllib.parse.parse_qs(url.query),
+             self.headers.get('Idempotency-Key'), sent))
+        if self.server.hold:
+            self.server.hold.wait(5)
+        if self.server.statuses:
+            body = b"<ApiException><Message>Not today</Message></ApiException>"
+            self.send_response(self.server.statuses.pop(0))
+            self.send_header('Retry-After', '7')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        response = Element("Response")
+        container = SubElement(response, sent.tag)
+        for element in sent:
+            reply = SubElement(container, element.tag)
+            reply.extend(element)
+            if element.tag != "Invoice":
+                continue
+            if element.find(".//LineItem[AccountCode='999']") is not None:
+                reply.set("status", "ERROR")
+                error = SubElement(SubElement(reply, "ValidationErrors"),
+                                   "ValidationError")
+                SubElement(error, "Message").text = \
+                    "Account code '999' is not valid"
+                continue
+            SubElement(reply, "InvoiceID").text = str(uuid.uuid4())
+            if reply.find("Status") is None:
+                SubElement(reply, "Status").text = "DRAFT"
+        body = tostring(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/connections":
+            self._send_json([{'tenantId': "tenant"}])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = urllib.parse.parse_qs(
+            self.rfile.read(int(self.headers['Content-Length'])).decode())
+        self.server.refreshes.append(body)
+        self._send_json({
+            'access_token': "new-access",
+            'refresh_token': "new-refresh",
+            'token_type': "Bearer",
+            'expires_in': 1800,
+        })
+
+    def _send_json(self, value):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInXeroIntegration(xero.XeroIntegration):
+    def xero_session(self, state=None, omit_tenant=False):
+        return requests.Session()
+
+
+class XeroExportTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Create the test database
+        engine = create_engine("postgresql+psycopg2:///postgres", future=True)
+        raw_connection = engine.raw_connection()
+        with raw_connection.cursor() as cursor:
+            cursor.execute('commit')
+            cursor.execute(f'create database "{TEST_DATABASE_NAME}"')
+        raw_connection.close()
+        cls._engine = create_engine(
+            f"postgresql+psycopg2:///{TEST_DATABASE_NAME}", future=True)
+        models.metadata.create_all(cls._engine)
+        cls._sm = sessionmaker(cls._engine, future=True)
+
+        cls._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), StandInXeroHandler)
+        cls._server.requests = []
+        cls._server.statuses = []
+        cls._server.refreshes = []
+        cls._server.hold = None
+        threading.Thread(target=cls._server.serve_forever,
+                         daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._server.shutdown()
+        cls._server.server_close()
+        # Dispose of the connection pool, closing all checked-in connections
+        cls._engine.dispose()
+        del cls._engine
+        engine = create_engine("postgresql+psycopg2:///postgres", future=True)
+        raw_connection = engine.raw_connection()
+        with raw_connection.cursor() as cursor:
+            cursor.execute('commit')
+            cursor.execute(f'drop database "{TEST_DATABASE_NAME}"')
+        raw_connection.close()
+
+    def setUp(self):
+        self.connection = self._engine.connect()
+        # Start a transaction that will be rolled back by
+        # self.s.close() in tearDown().  The export queue commits
+        # and rolls back, so the session uses savepoints inside it.
+        self.connection.begin()
+        self.s = self._sm(bind=self.connection,
+                          join_transaction_mode="create_savepoint")
+        self._saved_s = td.s
+        td.s = self.s
+        self._server.requests.clear()
+        self._server.statuses.clear()
+        self._server.refreshes.clear()
+        self._server.hold = None
+        self.server_url = f"http://127.0.0.1:{self._server.server_port}/"
+        self.xero = StandInXeroIntegration(config_prefix="xero-test")
+        self.xero.endpoint_url = self.server_url
+        self.xero.sales_contact_id._test_set("sales-contact")
+
+    def tearDown(self):
+        self._remove_integration(self.xero)
+        td.s = self._saved_s
+        self.s.close()
+        self.connection.close()
+
+    @staticmethod
+    def _remove_integration(integration):
+        xero.XeroIntegration._integrations.remove(integration)
+        for hooks in (session.SessionHooks, delivery.DeliveryHooks,
+                      startup.StartupHook):
+            hooks.instances[:] = [h for h in hooks.instances
+                                  if h.xero is not integration]
+
+    def template_setup(self):
+        business = models.Business(
+            id=1, name='Test', abbrev='TEST', address='An address')
+        vatband = models.VatBand(band='A', business=business, rate=0.2)
+        self.s.add_all([
+            business, vatband,
+            models.Department(id=1, description="Test", vat=vatband,
+                              sales_account="200", purchases_account="300"),
+            models.Department(id=2, description="Bad", vat=vatband,
+                              sales_account="999", purchases_account="300"),
+            models.TransCode(code='S', description='Sale'),
+            models.PayType(paytype='CASH', description='Cash',
+                           payments_account="090"),
+        ])
+        self.s.commit()
+
+    def closed_session(self, day, dept_id, amount):
+        s = models.Session(date=datetime.date(2024, 1, day))
+        trans = models.Transaction(session=s)
+        self.s.add(models.Transline(
+            transaction=trans, items=1, amount=amount, dept_id=dept_id,
+            transcode='S', text="Test sale"))
+        self.s.add(models.Payment(
+            transaction=trans, amount=amount, paytype_id='CASH', text="Cash"))
+        self.s.flush()
+        trans.closed = True
+        s.endtime = datetime.datetime(2024, 1, day, 23, 0)
+        self.s.add(models.SessionTotal(
+            session=s, paytype_id='CASH', amount=amount))
+        self.s.commit()
+        return s
+
+    def sent(self):
+        return [(path, root.tag, len(root), query.get('summarizeErrors'))
+                for path, query, key, root in self._server.requests]
+
+    def test_export_batches(self):
+        self.template_setup()
+        sessions = [self.closed_session(1, 1, Decimal("10.00")),
+                    self.closed_session(2, 1, Decimal("20.00")),
+                    self.closed_session(3, 2, Decimal("30.00"))]
+        d = models.Delivery(
+            supplier=models.Supplier(name="Test supplier",
+                                     accinfo="supplier-contact"),
+            date=datetime.date(2024, 1, 1), docnumber="INV1")
+        self.s.add(d)
+        self.s.commit()
+        for s in sessions:
+            self.xero.queue_session(s.id, True)
+        self.xero.queue_delivery(d.id)
+        self.s.commit()
+        self.xero.export_batch_size._test_set("2")
+
+        # Nothing is sent while Xero is limiting our request rate
+        self._server.statuses.append(429)
+        result = self.xero.export_queued()
+        self.assertTrue(result.rate_limited)
+        self.assertEqual(result.retry_in, 7)
+        self.assertEqual(result.sent, [])
+        self.assertEqual(self.s.query(models.AccountsExport).count(), 4)
+
+        self._server.requests.clear()
+        result = self.xero.export_queued()
+        self.assertIsNone(result.problem)
+        self.assertIsNone(result.retry_in)
+        self.assertEqual(self.sent(), [
+            ("/Invoices/", "Invoices", 2, ["false"]),
+            ("/Invoices/", "Invoices", 1, ["false"]),
+            ("/Invoices/", "Invoices", 1, ["false"]),
+            ("/Payments/", "Payments", 2, ["false"]),
+        ])
+        self.assertEqual(result.sent, [
+            f"invoice for session {sessions[0].id}",
+            f"invoice for session {sessions[1].id}",
+            f"bill for delivery {d.id}",
+            f"payments for session {sessions[0].id}",
+            f"payments for session {sessions[1].id}",
+        ])
+        self.assertIsNotNone(sessions[0].accinfo)
+        self.assertIsNotNone(sessions[1].accinfo)
+        self.assertIsNone(sessions[2].accinfo)
+        self.assertIsNotNone(d.accinfo)
+        # The payments were added to the invoices that were created
+        payments = self._server.requests[-1][3]
+        self.assertEqual(
+            [p.findtext("Invoice/InvoiceID") for p in payments],
+            [sessions[0].accinfo, sessions[1].accinfo])
+
+        # The rejected invoice stays in the queue until it is retried
+        # by hand
+        self.assertEqual(len(result.failed), 1)
+        self.assertIn("Account code '999' is not valid",
+                      result.failed[0][1])
+        failed = self.s.query(models.AccountsExport).one()
+        self.assertEqual(failed.sessionid, sessions[2].id)
+        self.assertTrue(failed.failed)
+        self.assertEqual(failed.attempts, 1)
+        self._server.requests.clear()
+        result = self.xero.export_queued()
+        self.assertEqual(self._server.requests, [])
+        self.assertIsNone(result.retry_in)
+
+        # A request that Xero rejects as a whole fails all its rows
+        self.xero.queue_delivery(d.id)
+        self.s.commit()
+        self._server.statuses.append(400)
+        result = self.xero.export_queued()
+        self.assertEqual(result.failed, [
+            (f"bill for delivery {d.id}", "Xero rejected invoices: Not today")])
+        self.assertEqual(
+            self.s.query(models.AccountsExport)
+            .filter(models.AccountsExport.failed == True).count(), 2)
+        self._server.requests.clear()
+
+        # Sessions whose invoice has been sent are not sent again
+        self.xero.queue_session(sessions[0].id, True)
+        self.s.commit()
+        result = self.xero.export_queued()
+        self.assertEqual(self._server.requests, [])
+        self.assertEqual(self.s.query(models.AccountsExport).count(), 2)
+
+    def test_export_retried_when_unavailable(self):
+        self.template_setup()
+        s = self.closed_session(1, 1, Decimal("10.00"))
+        self.xero.queue_session(s.id, False)
+        self.s.commit()
+
+        self._server.statuses.append(503)
+        result = self.xero.export_queued()
+        self.assertEqual(result.problem, "Received 503 response")
+        self.assertEqual(result.retry_in, self.xero.export_min_delay)
+        row = self.s.query(models.AccountsExport).one()
+        self.assertEqual(row.attempts, 1)
+        self.assertFalse(row.failed)
+        self.assertEqual(row.last_error, "Received 503 response")
+        self.assertGreater(row.next_attempt, row.queued)
+
+        # Not due yet
+        result = self.xero.export_queued()
+        self.assertEqual(len(self._server.requests), 1)
+
+        row.next_attempt = row.queued
+        self.s.commit()
+        result = self.xero.export_queued()
+        self.assertEqual(result.sent, [f"invoice for session {s.id}"])
+        self.assertIsNotNone(s.accinfo)
+        # The invoice was not approved, so no payments are queued
+        self.assertEqual(self.s.query(models.AccountsExport).count(), 0)
+        # The batch was sent again with the same idempotency key
+        keys = [key for path, query, key, root in self._server.requests]
+        self.assertEqual(len(keys), 2)
+        self.assertIsNotNone(keys[0])
+        self.assertEqual(keys[0], keys[1])
+
+    def test_retry_sends_same_batch(self):
+        self.template_setup()
+        sessions = [self.closed_session(day, 1, Decimal("10.00"))
+                    for day in (1, 2, 3)]
+        self.xero.queue_session(sessions[0].id, False)
+        self.xero.queue_session(sessions[1].id, False)
+        self.s.commit()
+
+        self._server.statuses.append(503)
+        result = self.xero.export_queued()
+        self.assertEqual(result.problem, "Received 503 response")
+
+        # More work is queued before the batch is tried again; it
+        # must not change what is in the batch
+        self.xero.queue_session(sessions[2].id, False)
+        self.s.commit()
+        for row in self.s.query(models.AccountsExport).all():
+            row.next_attempt = row.queued
+        self.s.commit()
+        result = self.xero.export_queued()
+        self.assertEqual(result.sent, [
+            f"invoice for session {s.id}" for s in sessions])
+        self.assertEqual(self.s.query(models.AccountsExport).count(), 0)
+
+        (_, _, key1, first), (_, _, key2, retry), (_, _, key3, new) = \
+            self._server.requests
+        self.assertEqual(key1, key2)
+        self.assertEqual(tostring(first), tostring(retry))
+        self.assertEqual(len(retry), 2)
+        self.assertEqual(len(new), 1)
+        self.assertNotEqual(key3, key1)
+
+    def token_setup(self, expires_in=3600):
+        """An integration that talks to the stand-in using a token
+
+        The test session is replaced by sessions that commit, so that
+        the token can be locked by one thread and not another.
+        """
+        td.s = scoped_session(self._sm)
+        self.addCleanup(td.s.remove)
+        self.addCleanup(self._delete_secrets)
+        secrets = secretstore.Secrets("xero-token-test", Fernet.generate_key())
+        with td.orm_session():
+            secrets.store('token', json.dumps({
+                'access_token': "access",
+                'refresh_token': "refresh",
+                'token_type': "Bearer",
+                'expires_at': time.time() + expires_in,
+            }), create=True)
+        integration = xero.XeroIntegration(
+            config_prefix="xero-token-test", secrets=secrets)
+        self.addCleanup(self._remove_integration, integration)
+        integration.endpoint_url = self.server_url
+        integration.client_id._test_set("client")
+        integration.tenant_id._test_set("tenant")
+        for patch in (
+                mock.patch.dict(os.environ,
+                                {'OAUTHLIB_INSECURE_TRANSPORT': "1"}),
+                mock.patch.object(xero, 'XERO_CONNECTIONS_URL',
+                                  self.server_url + "connections"),
+                mock.patch.object(xero, 'XERO_CONNECT_URL',
+                                  self.server_url + "connect/token")):
+            patch.start()
+            self.addCleanup(patch.stop)
+        return integration, secrets
+
+    def _delete_secrets(self):
+        with self._sm() as s:
+            s.execute(delete(models.Secret))
+            s.commit()
+
+    def test_token_not_locked_during_request(self):
+        integration, _ = self.token_setup()
+        self._server.hold = threading.Event()
+        self.addCleanup(self._server.hold.set)
+        errors = []
+
+        # The export worker sends work to Xero in its own session...
+        def export():
+            try:
+                with td.orm_session():
+                    integration._put("Invoices", [], "nothing")
+            except Exception as e:
+                errors.append(e)
+        worker = threading.Thread(target=export)
+        worker.start()
+        deadline = time.monotonic() + 5
+        while not self._server.requests and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self._server.requests), 1)
+
+        # ...and while it waits for the reply the main loop checks the
+        # connection, which must not wait for the export to finish
+        with td.orm_session():
+            self.assertTrue(integration.connection_ok())
+        self.assertTrue(worker.is_alive())
+
+        self._server.hold.set()
+        worker.join()
+        self.assertEqual(errors, [])
+
+    def test_request_timeout(self):
+        integration, _ = self.token_setup()
+        integration.request_timeout = 0.2
+        self._server.hold = threading.Event()
+        self.addCleanup(self._server.hold.set)
+        with td.orm_session():
+            with self.assertRaises(xero.XeroUnavailable):
+                integration._put("Invoices", [], "nothing")
+
+    def test_token_refresh(self):
+        integration, secrets = self.token_setup(expires_in=60)
+        with td.orm_session():
+            self.assertTrue(integration.connection_ok())
+        self.assertEqual(len(self._server.refreshes), 1)
+        self.assertEqual(self._server.refreshes[0]['grant_type'],
+                         ["refresh_token"])
+        self.assertEqual(self._server.refreshes[0]['refresh_token'],
+                         ["refresh"])
+        with td.orm_session():
+            token = json.loads(secrets.fetch('token'))
+        self.assertEqual(token['refresh_token'], "new-refresh")
+        self.assertGreater(token['expires_at'], time.time() + 1000)
+
+        # The new token is used until it is about to expire
+        with td.orm_session():
+            self.assertTrue(integration.connection_ok())
+        self.assertEqual(len(self._server.refreshes), 1)
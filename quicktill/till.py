@@ -8,6 +8,8 @@ import sys
 import logging
 import argparse
 import socket
+import signal
+import os
 import time
 from . import startup
 from . import ui
@@ -125,6 +127,11 @@ class runtill(cmdline.command):
             "--hardware-keyboard", dest="hwkeyboard", default=True,
             action=argparse.BooleanOptionalAction,
             help="Enable or disable support for hardware keyboard")
+        parser.add_argument(
+            "--loop-stats", dest="loop_stats", default=None,
+            action="store", metavar="FILENAME",
+            help="Collect event loop latency statistics and append them "
+            "to FILENAME on receipt of SIGUSR1 and at exit")
         debugp = parser.add_argument_group(
             title="debug / development arguments",
             description="These arguments may be useful during development "
@@ -137,6 +144,10 @@ class runtill(cmdline.command):
             "--glib-mainloop", action=argparse.BooleanOptionalAction,
             default=False, dest="glibmainloop",
             help="Use GLib mainloop")
+        debugp.add_argument(
+            "--asyncio-mainloop", action=argparse.BooleanOptionalAction,
+            default=False, dest="asynciomainloop",
+            help="Use asyncio mainloop")
         gtkp = parser.add_argument_group(
             title="display system arguments",
             description="The Gtk display system can be used instead of the "
@@ -197,6 +208,45 @@ class runtill(cmdline.command):
                 else:
                     ui.handle_keyboard_input(i)
 
+    class _loop_stats_signal:
+        """Write event loop statistics on receipt of SIGUSR1
+
+        The signal handler only writes a byte to a pipe; the report is
+        written when the main loop sees the pipe is readable.
+        """
+        def __init__(self, filename):
+            self.filename = filename
+            self.r, self.w = os.pipe()
+            os.set_blocking(self.r, False)
+            os.set_blocking(self.w, False)
+            tillconfig.mainloop.add_fd(
+                self.r, self.doread, desc="loop statistics signal")
+            signal.signal(signal.SIGUSR1, self.handler)
+
+        def handler(self, signum, frame):
+            try:
+                os.write(self.w, b"\0")
+            except BlockingIOError:
+                # A report is already pending
+                pass
+
+        def doread(self):
+            try:
+                os.read(self.r, 64)
+            except BlockingIOError:
+                return
+            runtill.write_loop_stats(self.filename)
+
+    @staticmethod
+    def write_loop_stats(filename):
+        from . import event
+        try:
+            with open(filename, "a") as f:
+                f.write(event.stats.report())
+                f.write("\n")
+        except OSError as e:
+            log.error("Could not write event loop statistics: %s", e)
+
     @staticmethod
     def update_notified(payload):
         log.info("Update notification received via database; exiting")
@@ -219,10 +269,18 @@ class runtill(cmdline.command):
             else:
                 log.error("GLib not available")
                 return 1
+        elif args.asynciomainloop:
+            from . import event_asyncio
+            tillconfig.mainloop = event_asyncio.AsyncioMainLoop()
         else:
             from . import event
             tillconfig.mainloop = event.SelectorsMainLoop()
 
+        if args.loop_stats:
+            from . import event
+            event.stats = event.LoopStats()
+            runtill._loop_stats_signal(args.loop_stats)
+
         # Initialise database notifications listener
         listen.listener = listen.db_listener(tillconfig.mainloop, td.engine)
 
@@ -258,6 +316,10 @@ class runtill(cmdline.command):
             td.s.flush()
             tillconfig.register_id = reg.id
 
+        for hook in startup.StartupHook.instances:
+            tillconfig.mainloop.add_timeout(0, hook.started,
+                                            desc="startup hook")
+
         dbg_kbd = None
         try:
             if args.keyboard and tillconfig.keyboard \
@@ -292,6 +354,8 @@ class runtill(cmdline.command):
             if dbg_kbd is not None:
                 dbg_kbd.stdin.close()
                 dbg_kbd.wait()
+            if args.loop_stats:
+                runtill.write_loop_stats(args.loop_stats)
 
         log.info("Shutting down")
         logging.shutdown()
@@ -1,10 +1,17 @@
 from .views import tillweb_view, colours
+import datetime
 import decimal
+import hashlib
+import json
+import threading
+import time
 from decimal import Decimal
 from itertools import cycle
 from django.http import JsonResponse
 from django.urls import reverse
-from sqlalchemy.sql.expression import func, or_, nullslast
+from sqlalchemy import Column, text
+from sqlalchemy.sql.expression import func, or_, nullslast, tuple_
+from sqlalchemy.orm import ColumnProperty, InstrumentedAttribute
 from sqlalchemy.orm import contains_eager
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import undefer, undefer_group
@@ -36,7 +43,72 @@ from quicktill.models import (
 
 
 # Utilities to help write views for datatables
-def _datatables_order(query, columns, params):
+
+# Counting rows is slow on large tables, and DataTables asks for both
+# the unfiltered and filtered counts on every page.  Counts of large
+# result sets are remembered for count_cache_time seconds; if the
+# unfiltered query is a whole table of more than estimate_rows_above
+# rows, the planner's estimate of the table size is used instead of
+# counting it.
+count_cache_time = 30
+cache_counts_above = 10000
+estimate_rows_above = 100000
+
+# Paging through a large table with OFFSET gets slower the further in
+# you go, because the database has to generate and throw away all the
+# rows before the page.  Where the ordering permits it, each response
+# includes a "seek" token holding the sort key of the last row sent.
+# The page script sends the token back when it asks for the next
+# page, and we seek straight to the row after it.  Without a token
+# that matches the request, we use OFFSET.
+
+_cache_lock = threading.Lock()
+_count_cache = {}
+
+
+def _cache_key(query):
+    # Identifies a query against a particular database
+    bind = td.s.get_bind()
+    compiled = query.statement.compile(dialect=bind.dialect)
+    return (str(bind.url), str(compiled),
+            repr(sorted(compiled.params.items())))
+
+
+def _estimated_rows(table):
+    return td.s.execute(
+        text("SELECT reltuples::bigint FROM pg_class "
+             "WHERE oid = to_regclass(:name)"),
+        {'name': table.fullname}).scalar()
+
+
+def _datatables_count(query):
+    key = _cache_key(query)
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _count_cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+    count = None
+    if query.whereclause is None:
+        table = query.column_descriptions[0]['entity'].__table__
+        estimate = _estimated_rows(table)
+        # reltuples is -1 (or 0 on older servers) if the table has
+        # never been analysed
+        if estimate is not None and estimate > estimate_rows_above:
+            count = estimate
+    if count is None:
+        count = query.count()
+    if count > cache_counts_above:
+        with _cache_lock:
+            for k in [k for k, v in _count_cache.items() if v[0] <= now]:
+                del _count_cache[k]
+            _count_cache[key] = (now + count_cache_time, count)
+    return count
+
+
+def _datatables_order_spec(columns, params):
+    # Returns a list of (expr, descending, nulls_last) tuples
+    order = []
     for onum in range(1000):
         order_col = params.get(f"order[{onum}][column]")
         order_dir = params.get(f"order[{onum}][dir]")
@@ -46,9 +118,18 @@ def _datatables_order(query, columns, params):
         # If expr is None then this is not an orderable column
         if expr is None:
             continue
-        if order_dir == "desc":
+        order.append((expr, order_dir == "desc",
+                      bool(params.get(f"columns[{order_col}][nullslast]",
+                                      False))))
+    return order
+
+
+def _datatables_order(query, columns, params):
+    for expr, descending, nulls_last in _datatables_order_spec(
+            columns, params):
+        if descending:
             expr = expr.desc()
-        if params.get(f"columns[{order_col}][nullslast]", False):
+        if nulls_last:
             expr = nullslast(expr)
         query = query.order_by(expr)
 
@@ -64,6 +145,96 @@ def _datatables_paginate(query, params):
     return query
 
 
+def _keyset_columns(query, order):
+    # We can seek to a row if the ordering is all in the same
+    # direction on non-null indexed columns of the table being
+    # queried.  Returns the list of attributes that make up the
+    # unique sort key of a row, ending with the primary key if it
+    # wasn't already present, or None if we can't seek.
+    if not order or len(query.column_descriptions) != 1:
+        return
+    if len(set(descending for _, descending, _ in order)) != 1:
+        return
+    entity = query.column_descriptions[0]['entity']
+    table = getattr(entity, '__table__', None)
+    if table is None or len(table.primary_key.columns) != 1:
+        return
+    attrs = []
+    for expr, _, nulls_last in order:
+        if nulls_last or not isinstance(expr, InstrumentedAttribute) \
+           or not isinstance(expr.property, ColumnProperty):
+            return
+        col = expr.property.columns[0]
+        if not isinstance(col, Column) or col.table is not table \
+           or col.nullable:
+            return
+        if not col.primary_key and not any(
+                list(ix.columns)[:1] == [col] for ix in table.indexes):
+            return
+        attrs.append(expr)
+        if col.primary_key:
+            return attrs
+    pk = entity.__mapper__.get_property_by_column(
+        list(table.primary_key.columns)[0])
+    attrs.append(getattr(entity, pk.key))
+    return attrs
+
+
+def _seek_value(attr, value):
+    # Convert a sort key value from a seek token back to the type of
+    # the column it came from
+    t = attr.type.python_type
+    if t in (datetime.date, datetime.datetime):
+        return t.fromisoformat(value)
+    return t(value)
+
+
+def _seek_token(query_hash, start, attrs, row):
+    """Token for seeking to the row after row, which is at start - 1
+    """
+    values = []
+    for attr in attrs:
+        value = getattr(row, attr.key)
+        values.append(value.isoformat() if isinstance(
+            value, (datetime.date, datetime.datetime)) else str(value))
+    return json.dumps([query_hash, start, values])
+
+
+def _datatables_seek(query, order, attrs, start, length, token):
+    # Returns the query for the page, and a hash that identifies
+    # the query for seek tokens
+    descending = order[0][1]
+    for attr in attrs:
+        query = query.order_by(attr.desc() if descending else attr)
+    compiled = query.statement.compile(dialect=td.s.get_bind().dialect)
+    query_hash = hashlib.sha256(
+        repr((str(compiled), sorted(compiled.params.items())))
+        .encode("utf-8")).hexdigest()[:16]
+    values = None
+    if token:
+        try:
+            token_hash, token_start, token_values = json.loads(token)
+            if token_hash == query_hash and token_start == start \
+               and len(token_values) == len(attrs):
+                values = [_seek_value(attr, value)
+                          for attr, value in zip(attrs, token_values)]
+        except (ValueError, TypeError, NotImplementedError):
+            pass
+    if values:
+        if len(attrs) == 1:
+            sortkey, values = attrs[0], values[0]
+        else:
+            sortkey = tuple_(*attrs)
+            values = tuple_(*values)
+        query = query.filter(sortkey < values if descending
+                             else sortkey > values)
+    elif start:
+        query = query.offset(start)
+    if length >= 0:
+        query = query.limit(length)
+    return query, query_hash
+
+
 def _datatables_json(request, query, filtered_query, columns, rowfunc):
     order_columns = []
     error = None
@@ -89,14 +260,35 @@ def _datatables_json(request, query, filtered_query, columns, rowfunc):
     if error:
         return JsonResponse({'error': error})
 
-    q = _datatables_order(filtered_query, order_columns, request.GET)
-    q = _datatables_paginate(q, request.GET)
+    order = _datatables_order_spec(order_columns, request.GET)
+    keyset = _keyset_columns(filtered_query, order)
+    if keyset:
+        start = int(request.GET.get("start", "0"))
+        length = int(request.GET.get("length", "100"))
+        q, query_hash = _datatables_seek(
+            filtered_query, order, keyset, start, length,
+            request.GET.get("seek"))
+    else:
+        q = _datatables_order(filtered_query, order_columns, request.GET)
+        q = _datatables_paginate(q, request.GET)
+    rows = q.all()
+    seek = None
+    if keyset and length > 0 and len(rows) == length:
+        seek = {
+            'start': start + length,
+            'token': _seek_token(query_hash, start + length, keyset,
+                                 rows[-1]),
+        }
+    records_total = _datatables_count(query)
     r = {
         'draw': int(request.GET.get("draw", "1")),
-        'recordsTotal': query.count(),
-        'recordsFiltered': filtered_query.count(),
-        'data': [rowfunc(x) for x in q.all()],
+        'recordsTotal': records_total,
+        'recordsFiltered': records_total if filtered_query is query
+        else _datatables_count(filtered_query),
+        'data': [rowfunc(x) for x in rows],
     }
+    if seek:
+        r['seek'] = seek
     if error:
         r['error'] = error
     return JsonResponse(r)
@@ -0,0 +1,211 @@
+# Per-request profiling for tillweb views
+
+# Every request handled by a @tillweb_view records the number of
+# database queries it made, the time spent in them, its slowest
+# statements and the time spent in the view and rendering its
+# template.  The timings are returned to the browser in a
+# Server-Timing header and are added up per view, for the statistics
+# page.  Requests that make more queries than the budget are logged,
+# so that a view that has started issuing a query per row is noticed.
+#
+# Statistics are kept in memory, so they are per process and are
+# lost when the process restarts.
+
+import copy
+import threading
+import time
+import weakref
+import logging
+import sqlalchemy
+from django.conf import settings
+from .db import td
+
+log = logging.getLogger(__name__)
+
+# Number of slowest statements to keep for each view
+slow_statements = 5
+
+_lock = threading.Lock()
+_instrumented = weakref.WeakSet()
+stats = {}
+since = time.time()
+
+
+def enabled():
+    return getattr(settings, 'TILLWEB_PROFILE', True)
+
+
+def query_budget():
+    """Maximum number of queries a request should make
+    """
+    return getattr(settings, 'TILLWEB_QUERY_BUDGET',
+                   3 if settings.DEBUG else 30)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if getattr(td, 'profile', None) is None:
+        return
+    conn.info.setdefault('tillweb_query_start', []).append(
+        time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    profile = getattr(td, 'profile', None)
+    starts = conn.info.get('tillweb_query_start')
+    if profile is None or not starts:
+        return
+    profile.record(time.perf_counter() - starts.pop(), statement)
+
+
+def instrument(engine):
+    """Make sure queries on an engine are recorded
+
+    The event listeners are only added once per engine, and do
+    nothing outside a profiled request.
+    """
+    if engine in _instrumented:
+        return
+    with _lock:
+        if engine in _instrumented:
+            return
+        sqlalchemy.event.listen(engine, "before_cursor_execute",
+                                _before_cursor_execute)
+        sqlalchemy.event.listen(engine, "after_cursor_execute",
+                                _after_cursor_execute)
+        _instrumented.add(engine)
+
+
+def _keep_slowest(slowest, items):
+    slowest.extend(items)
+    slowest.sort(key=lambda x: x[0], reverse=True)
+    del slowest[slow_statements:]
+
+
+class RequestProfile:
+    """Queries and timings for a single request
+    """
+    def __init__(self, view):
+        self.view = view
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        # List of (duration, statement), slowest first
+        self.slowest = []
+        self.view_queries = None
+        self.view_time = None
+        self.total_time = None
+
+    def record(self, duration, statement):
+        self.queries += 1
+        self.sql_time += duration
+        if len(self.slowest) < slow_statements \
+           or duration > self.slowest[-1][0]:
+            _keep_slowest(self.slowest, [(duration, statement)])
+
+    def view_done(self):
+        """Note that the view has returned and rendering is starting
+        """
+        self.view_queries = self.queries
+        self.view_time = time.perf_counter() - self.start
+
+    def finish(self):
+        if self.total_time is not None:
+            return
+        self.total_time = time.perf_counter() - self.start
+        if self.view_time is None:
+            self.view_done()
+
+    @property
+    def render_time(self):
+        return self.total_time - self.view_time
+
+    def server_timing(self):
+        """Value for the Server-Timing response header
+        """
+        return (f'sql;desc="{self.queries} queries";'
+                f'dur={self.sql_time * 1000:.1f}, '
+                f'view;dur={self.view_time * 1000:.1f}, '
+                f'render;dur={self.render_time * 1000:.1f}')
+
+
+class ViewStats:
+    """Totals for all profiled requests to a view
+    """
+    def __init__(self, view):
+        self.view = view
+        self.requests = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.queries = 0
+        self.max_queries = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.over_budget = 0
+        self.slowest = []
+
+    def add(self, profile, budget):
+        self.requests += 1
+        self.total_time += profile.total_time
+        self.max_time = max(self.max_time, profile.total_time)
+        self.queries += profile.queries
+        self.max_queries = max(self.max_queries, profile.queries)
+        self.sql_time += profile.sql_time
+        self.render_time += profile.render_time
+        if profile.queries > budget:
+            self.over_budget += 1
+        _keep_slowest(self.slowest, profile.slowest)
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.requests
+
+    @property
+    def mean_queries(self):
+        return self.queries / self.requests
+
+    @property
+    def mean_sql_time(self):
+        return self.sql_time / self.requests
+
+    @property
+    def mean_render_time(self):
+        return self.render_time / self.requests
+
+
+def record(profile):
+    """Add a finished request to the statistics for its view
+    """
+    profile.finish()
+    budget = query_budget()
+    with _lock:
+        vs = stats.get(profile.view)
+        if not vs:
+            vs = stats[profile.view] = ViewStats(profile.view)
+        vs.add(profile, budget)
+    if profile.queries > budget:
+        log.warning(
+            "Excessive queries in view %s (%d pre render, %d during "
+            "render, budget %d)", profile.view, profile.view_queries,
+            profile.queries - profile.view_queries, budget)
+
+
+def snapshot():
+    """Return a copy of the statistics for each view, busiest first
+    """
+    with _lock:
+        views = []
+        for vs in stats.values():
+            vs = copy.copy(vs)
+            vs.slowest = list(vs.slowest)
+            views.append(vs)
+    views.sort(key=lambda vs: vs.total_time, reverse=True)
+    return views
+
+
+def reset():
+    global since
+    with _lock:
+        stats.clear()
+        since = time.time()
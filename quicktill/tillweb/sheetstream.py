@@ -0,0 +1,591 @@
+# Spreadsheets written a row at a time
+#
+# spreadsheets.Document builds the whole document as an odfpy DOM
+# before writing any of it out, which is slow and takes a lot of
+# memory for large reports.  StreamingDocument has the same cell and
+# sheet API, but writes each row out as soon as the report moves on
+# to the next one, so reports can be generated from a query using a
+# server-side cursor in constant memory.  The document is assembled
+# in a temporary file which is returned as the response.
+#
+# Rows must be filled in order: once a report has put a cell in a
+# row, it can't go back and put cells in earlier rows.  Cells in the
+# current row can be set in any order.  Sheets are written one at a
+# time; starting a new sheet finishes the previous one.
+#
+# Documents can be written as OpenDocument (ods), Office Open XML
+# (xlsx) or CSV.  CSV documents can only have one sheet.
+
+from django.http import FileResponse
+from collections import namedtuple
+from xml.sax.saxutils import escape, quoteattr
+import csv
+import datetime
+import io
+import re
+import tempfile
+import zipfile
+
+_LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def cellref(col, row, scol=False, srow=False):
+    """Reference to a cell.
+
+    If scol is set then makes a specific reference to that column;
+    if srow is set then makes a specific reference to that row.
+    Otherwise makes a relative reference.
+    """
+    c = col + 1
+    cv = []
+    while c:
+        c, r = divmod(c - 1, len(_LETTERS))
+        cv[:0] = _LETTERS[r]
+    return "{}{}{}{}".format("$" if scol else "",
+                             "".join(cv),
+                             "$" if srow else "",
+                             row + 1)
+
+
+# A cell, independent of the output format.  valuetype is "float",
+# "string", "date" or "currency"; style is a style name or None.
+Cell = namedtuple("Cell", ["valuetype", "value", "formula", "style"])
+
+
+def _excel_formula(formula):
+    """Convert an OpenFormula formula as used in ods files for Excel
+
+    For example "oooc:=SUM([.E2:.J2])" becomes "SUM(E2:J2)".
+    """
+    formula = formula.split(":=", 1)[-1].lstrip("=")
+    return re.sub(r"\[\.([^\]:]+)(?::\.([^\]]+))?\]",
+                  lambda m: m.group(1) + (
+                      ":" + m.group(2) if m.group(2) else ""),
+                  formula)
+
+
+class Sheet:
+    """A table in a streaming spreadsheet
+
+    Create using StreamingDocument.sheet()
+    """
+    def __init__(self, doc, name):
+        self.name = name
+        self._doc = doc
+        self._columnstyles = {}
+        self._row = 0
+        self._cells = {}
+        self._started = False
+        self.finished = False
+
+    def cell(self, col, row, contents):
+        if self.finished:
+            raise ValueError(f"Sheet {self.name} has already been written")
+        if row < self._row:
+            raise ValueError(f"Row {row} of sheet {self.name} has "
+                             f"already been written")
+        if row > self._row:
+            self._flush()
+            self._row = row
+        self._cells[col] = contents
+        return contents
+
+    def colstyle(self, col, style):
+        if self._started:
+            raise ValueError("Column styles must be set before any rows "
+                             "are written")
+        self._columnstyles[col] = style
+
+    ref = staticmethod(cellref)
+
+    def _flush(self):
+        if not self._cells:
+            return
+        if not self._started:
+            self._doc._writer.start_sheet(self.name, self._columnstyles)
+            self._started = True
+        self._doc._writer.row(self._row, sorted(self._cells.items()))
+        self._cells = {}
+
+    def finish(self):
+        if self.finished:
+            return
+        self._flush()
+        if not self._started:
+            self._doc._writer.start_sheet(self.name, self._columnstyles)
+        self._doc._writer.end_sheet()
+        self.finished = True
+
+
+class _ODSWriter:
+    extension = "ods"
+    mimetype = 'application/vnd.oasis.opendocument.spreadsheet'
+
+    _namespaces = (
+        'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+        'xmlns:style="urn:oasis:names:tc:opendocument:xmlns:style:1.0" '
+        'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+        'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" '
+        'xmlns:fo="urn:oasis:names:tc:opendocument:xmlns:'
+        'xsl-fo-compatible:1.0" '
+        'xmlns:number="urn:oasis:names:tc:opendocument:xmlns:'
+        'datastyle:1.0" '
+        'office:version="1.2"')
+
+    _styles = (
+        '<number:currency-style style:name="PoundsN">'
+        '<number:currency-symbol number:language="en" number:country="GB">'
+        '£</number:currency-symbol>'
+        '<number:number number:decimal-places="2" '
+        'number:min-integer-digits="1" number:grouping="true"/>'
+        '</number:currency-style>'
+        '<number:date-style style:name="DateN" '
+        'number:automatic-order="true" number:format-source="language">'
+        '<number:day/><number:text>/</number:text><number:month/>'
+        '<number:text>/</number:text><number:year/></number:date-style>'
+        '<number:date-style style:name="DateTimeN" '
+        'number:automatic-order="true" number:format-source="language">'
+        '<number:day/><number:text>/</number:text><number:month/>'
+        '<number:text>/</number:text><number:year/><number:text> </number:text>'
+        '<number:hours/><number:text>:</number:text><number:minutes/>'
+        '</number:date-style>'
+        '<style:style style:name="Table Contents" style:family="paragraph">'
+        '<style:paragraph-properties text:number-lines="false" '
+        'text:line-number="0"/></style:style>'
+        '<style:style style:name="Pounds" style:family="table-cell" '
+        'style:parent-style-name="Default" style:data-style-name="PoundsN"/>'
+        '<style:style style:name="BoldPounds" style:family="table-cell" '
+        'style:parent-style-name="Pounds">'
+        '<style:text-properties fo:font-weight="bold"/></style:style>'
+        '<style:style style:name="BoldText" style:family="table-cell">'
+        '<style:text-properties fo:font-weight="bold"/></style:style>'
+        '<style:style style:name="ColumnHeader" style:family="table-cell">'
+        '<style:paragraph-properties fo:text-align="center"/>'
+        '<style:text-properties fo:font-weight="bold"/></style:style>'
+        '<style:style style:name="Date" style:family="table-cell" '
+        'style:parent-style-name="Default" style:data-style-name="DateN"/>'
+        '<style:style style:name="DateTime" style:family="table-cell" '
+        'style:parent-style-name="Default" '
+        'style:data-style-name="DateTimeN"/>')
+
+    def __init__(self, output):
+        self._output = output
+        # content.xml needs the column width styles before the body,
+        # so the body is written to a temporary file and copied into
+        # place at the end
+        self._body = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        self._colwidths = set()
+
+    def start_sheet(self, name, columnstyles):
+        self._body.write(f'<table:table table:name={quoteattr(name)}>')
+        if columnstyles:
+            for col in range(max(columnstyles) + 1):
+                style = columnstyles.get(col)
+                if style:
+                    self._colwidths.add(style)
+                    self._body.write(
+                        f'<table:table-column table:style-name="W{style}"/>')
+                else:
+                    self._body.write('<table:table-column/>')
+        else:
+            self._body.write('<table:table-column/>')
+        self._nextrow = 0
+
+    def row(self, row, cells):
+        if row > self._nextrow:
+            self._body.write(
+                f'<table:table-row table:number-rows-repeated='
+                f'"{row - self._nextrow}"><table:table-cell/>'
+                f'</table:table-row>')
+        out = ['<table:table-row>']
+        nextcol = 0
+        for col, cell in cells:
+            if col > nextcol:
+                out.append(f'<table:table-cell table:number-columns-repeated='
+                           f'"{col - nextcol}"/>')
+            out.append(self._cell(cell))
+            nextcol = col + 1
+        out.append('</table:table-row>')
+        self._body.write(''.join(out))
+        self._nextrow = row + 1
+
+    @staticmethod
+    def _cell(cell):
+        if cell.value is None and not cell.formula:
+            # An empty cell, for example textcell(None)
+            if cell.style:
+                return f'<table:table-cell ' \
+                    f'table:style-name={quoteattr(cell.style)}/>'
+            return '<table:table-cell/>'
+        a = [f'office:value-type="{cell.valuetype}"']
+        text = None
+        if cell.valuetype == "string":
+            text = cell.value
+        elif cell.valuetype == "date":
+            a.append(f'office:date-value="{cell.value.isoformat()}"')
+        else:
+            if cell.valuetype == "currency":
+                a.append('office:currency="GBP"')
+            if cell.value is not None:
+                a.append(f'office:value="{cell.value}"')
+        if cell.formula:
+            a.append(f'table:formula={quoteattr(cell.formula)}')
+        if cell.style:
+            a.append(f'table:style-name={quoteattr(cell.style)}')
+        if text is None:
+            return f'<table:table-cell {" ".join(a)}/>'
+        return f'<table:table-cell {" ".join(a)}>' \
+            f'<text:p>{escape(text)}</text:p></table:table-cell>'
+
+    def end_sheet(self):
+        if not self._nextrow:
+            # A table must have at least one row
+            self._body.write('<table:table-row><table:table-cell/>'
+                             '</table:table-row>')
+        self._body.write('</table:table>')
+
+    def finish(self):
+        with zipfile.ZipFile(self._output, "w") as z:
+            # The mimetype must be first, and uncompressed
+            z.writestr("mimetype", self.mimetype,
+                       compress_type=zipfile.ZIP_STORED)
+            z.writestr(
+                "META-INF/manifest.xml",
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<manifest:manifest xmlns:manifest="urn:oasis:names:tc:'
+                'opendocument:xmlns:manifest:1.0" manifest:version="1.2">'
+                '<manifest:file-entry manifest:full-path="/" '
+                f'manifest:media-type="{self.mimetype}"/>'
+                '<manifest:file-entry manifest:full-path="content.xml" '
+                'manifest:media-type="text/xml"/>'
+                '<manifest:file-entry manifest:full-path="styles.xml" '
+                'manifest:media-type="text/xml"/>'
+                '</manifest:manifest>',
+                compress_type=zipfile.ZIP_DEFLATED)
+            z.writestr(
+                "styles.xml",
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                f'<office:document-styles {self._namespaces}>'
+                f'<office:styles>{self._styles}</office:styles>'
+                '</office:document-styles>',
+                compress_type=zipfile.ZIP_DEFLATED)
+            colwidths = ''.join(
+                f'<style:style style:name="W{w}" style:family="table-column">'
+                f'<style:table-column-properties style:column-width="{w}"/>'
+                f'</style:style>' for w in sorted(self._colwidths))
+            with z.open("content.xml", "w", force_zip64=True) as f:
+                f.write(
+                    '<?xml version="1.0" encoding="UTF-8"?>'
+                    f'<office:document-content {self._namespaces}>'
+                    f'<office:automatic-styles>{colwidths}'
+                    '</office:automatic-styles>'
+                    '<office:body><office:spreadsheet>'.encode("utf-8"))
+                self._body.seek(0)
+                while chunk := self._body.read(1 << 16):
+                    f.write(chunk.encode("utf-8"))
+                f.write('</office:spreadsheet></office:body>'
+                        '</office:document-content>'.encode("utf-8"))
+        self._body.close()
+
+
+class _XLSXWriter:
+    extension = "xlsx"
+    mimetype = 'application/vnd.openxmlformats-officedocument' \
+        '.spreadsheetml.sheet'
+
+    _ns = 'xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+    _relns = 'http://schemas.openxmlformats.org/officeDocument/2006/' \
+        'relationships'
+
+    # Index into cellXfs in styles.xml for each style name
+    _style_index = {
+        "Pounds": 1,
+        "BoldPounds": 2,
+        "BoldText": 3,
+        "ColumnHeader": 4,
+        "Date": 5,
+        "DateTime": 6,
+    }
+
+    _stylesheet = (
+        '<numFmts count="2">'
+        '<numFmt numFmtId="164" formatCode="&quot;£&quot;#,##0.00"/>'
+        '<numFmt numFmtId="165" formatCode="dd/mm/yyyy hh:mm"/>'
+        '</numFmts>'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border/></borders>'
+        '<cellStyleXfs count="1"><xf/></cellStyleXfs>'
+        '<cellXfs count="7">'
+        '<xf/>'
+        '<xf numFmtId="164" applyNumberFormat="1"/>'
+        '<xf numFmtId="164" fontId="1" applyNumberFormat="1" '
+        'applyFont="1"/>'
+        '<xf fontId="1" applyFont="1"/>'
+        '<xf fontId="1" applyFont="1" applyAlignment="1">'
+        '<alignment horizontal="center"/></xf>'
+        '<xf numFmtId="14" applyNumberFormat="1"/>'
+        '<xf numFmtId="165" applyNumberFormat="1"/>'
+        '</cellXfs>'
+        '<cellStyles count="1">'
+        '<cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>')
+
+    _epoch = datetime.datetime(1899, 12, 30)
+
+    def __init__(self, output):
+        self._zip = zipfile.ZipFile(output, "w",
+                                    compression=zipfile.ZIP_DEFLATED)
+        self._sheets = []
+        self._f = None
+
+    def start_sheet(self, name, columnstyles):
+        # Excel sheet names are limited to 31 characters, can't
+        # contain some characters, and must be unique
+        name = re.sub(r'[\[\]:*?/\\]', '_', name)[:31] or "Sheet"
+        base, n = name, 1
+        while name.lower() in (s.lower() for s in self._sheets):
+            n += 1
+            suffix = f" ({n})"
+            name = base[:31 - len(suffix)] + suffix
+        self._sheets.append(name)
+        self._f = self._zip.open(
+            f"xl/worksheets/sheet{len(self._sheets)}.xml", "w",
+            force_zip64=True)
+        out = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+               f'<worksheet {self._ns}>']
+        if columnstyles:
+            out.append('<cols>')
+            for col, width in sorted(columnstyles.items()):
+                out.append(f'<col min="{col + 1}" max="{col + 1}" '
+                           f'width="{self._width(width):.1f}" '
+                           f'customWidth="1"/>')
+            out.append('</cols>')
+        out.append('<sheetData>')
+        self._f.write(''.join(out).encode("utf-8"))
+
+    @staticmethod
+    def _width(width):
+        # Column widths are measured in characters, about 5.4 per cm
+        # in the default font
+        if width.endswith("cm"):
+            return float(width[:-2]) * 5.4
+        return 10
+
+    def row(self, row, cells):
+        out = [f'<row r="{row + 1}">']
+        for col, cell in cells:
+            out.append(self._cell(cellref(col, row), cell))
+        out.append('</row>')
+        self._f.write(''.join(out).encode("utf-8"))
+
+    def _cell(self, ref, cell):
+        style = self._style_index.get(cell.style)
+        if style is None and cell.valuetype == "currency":
+            style = self._style_index["Pounds"]
+        s = f' s="{style}"' if style else ''
+        if cell.value is None and not cell.formula:
+            return f'<c r="{ref}"{s}/>'
+        if cell.valuetype == "string":
+            return f'<c r="{ref}" t="inlineStr"{s}><is>' \
+                f'<t xml:space="preserve">{escape(cell.value)}</t></is></c>'
+        value = cell.value
+        if cell.valuetype == "date" and value is not None:
+            if not isinstance(value, datetime.datetime):
+                value = datetime.datetime.combine(value, datetime.time())
+            value = (value - self._epoch) / datetime.timedelta(days=1)
+        inner = ''
+        if cell.formula:
+            inner += f'<f>{escape(_excel_formula(cell.formula))}</f>'
+        if value is not None:
+            inner += f'<v>{value}</v>'
+        return f'<c r="{ref}"{s}>{inner}</c>'
+
+    def end_sheet(self):
+        self._f.write(b'</sheetData></worksheet>')
+        self._f.close()
+        self._f = None
+
+    def finish(self):
+        z = self._zip
+        sheets = range(1, len(self._sheets) + 1)
+        z.writestr(
+            "[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+            'content-types">'
+            '<Default Extension="rels" ContentType="application/'
+            'vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/styles.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+            + ''.join(
+                f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                'ContentType="application/vnd.openxmlformats-'
+                'officedocument.spreadsheetml.worksheet+xml"/>'
+                for i in sheets)
+            + '</Types>')
+        z.writestr(
+            "_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/'
+            'package/2006/relationships">'
+            f'<Relationship Id="rId1" Type="{self._relns}/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>')
+        z.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<workbook {self._ns} xmlns:r="{self._relns}"><sheets>'
+            + ''.join(
+                f'<sheet name={quoteattr(name)} sheetId="{i}" r:id="rId{i}"/>'
+                for i, name in enumerate(self._sheets, start=1))
+            + '</sheets></workbook>')
+        z.writestr(
+            "xl/_rels/workbook.xml.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/'
+            'package/2006/relationships">'
+            + ''.join(
+                f'<Relationship Id="rId{i}" Type="{self._relns}/worksheet" '
+                f'Target="worksheets/sheet{i}.xml"/>' for i in sheets)
+            + f'<Relationship Id="rId{len(self._sheets) + 1}" '
+            f'Type="{self._relns}/styles" Target="styles.xml"/>'
+            '</Relationships>')
+        z.writestr(
+            "xl/styles.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<styleSheet {self._ns}>{self._stylesheet}</styleSheet>')
+        z.close()
+
+
+class _CSVWriter:
+    extension = "csv"
+    mimetype = "text/csv"
+
+    def __init__(self, output):
+        self._text = io.TextIOWrapper(output, encoding="utf-8", newline="")
+        self._csv = csv.writer(self._text)
+        self._sheets = 0
+
+    def start_sheet(self, name, columnstyles):
+        self._sheets += 1
+        if self._sheets > 1:
+            raise ValueError("CSV documents can only have one sheet")
+        self._nextrow = 0
+
+    def row(self, row, cells):
+        for _ in range(self._nextrow, row):
+            self._csv.writerow([])
+        out = []
+        for col, cell in cells:
+            out.extend([""] * (col - len(out)))
+            out.append(self._cell(cell))
+        self._csv.writerow(out)
+        self._nextrow = row + 1
+
+    @staticmethod
+    def _cell(cell):
+        if cell.formula and cell.value is None:
+            return "=" + _excel_formula(cell.formula)
+        if cell.value is None:
+            return ""
+        if cell.valuetype == "date":
+            return cell.value.isoformat(sep=" ") \
+                if isinstance(cell.value, datetime.datetime) \
+                else cell.value.isoformat()
+        return str(cell.value)
+
+    def end_sheet(self):
+        pass
+
+    def finish(self):
+        self._text.flush()
+        self._text.detach()
+
+
+_writers = {w.extension: w for w in (_ODSWriter, _XLSXWriter, _CSVWriter)}
+
+# Choices for a format field on a report form
+formats = [
+    ("ods", "OpenDocument spreadsheet (.ods)"),
+    ("xlsx", "Excel spreadsheet (.xlsx)"),
+    ("csv", "Comma-separated values (.csv)"),
+]
+
+
+class StreamingDocument:
+    """A spreadsheet written a row at a time
+
+    filename should not include an extension: it is added to suit
+    the format, which is one of "ods", "xlsx" or "csv".
+    """
+    # Documents bigger than this are moved from memory to disk
+    max_memory_size = 16 * 1024 * 1024
+
+    currencystyle = "Pounds"
+    boldcurrencystyle = "BoldPounds"
+    boldtextstyle = "BoldText"
+    headerstyle = "ColumnHeader"
+    datestyle = "Date"
+    datetimestyle = "DateTime"
+
+    def __init__(self, filename=None, format="ods"):
+        writer = _writers[format]
+        self.mimetype = writer.mimetype
+        self.filename = f"{filename}.{writer.extension}" if filename \
+            else None
+        self._output = tempfile.SpooledTemporaryFile(
+            max_size=self.max_memory_size)
+        self._writer = writer(self._output)
+        self._sheet = None
+
+    def sheet(self, name):
+        """Start a new sheet, finishing the previous one
+        """
+        if self._sheet:
+            self._sheet.finish()
+        self._sheet = Sheet(self, name)
+        return self._sheet
+
+    def add_table(self, table):
+        """Finish a sheet
+
+        Present for compatibility with spreadsheets.Document; sheets
+        are written as they are filled in.
+        """
+        table.finish()
+
+    def intcell(self, val):
+        return Cell("float", val, None, None)
+
+    numbercell = intcell
+
+    def textcell(self, text):
+        return Cell("string", text, None, None)
+
+    def datecell(self, date, style=None):
+        return Cell("date", date, None, style or self.datestyle)
+
+    def datetimecell(self, datetime, style=None):
+        return Cell("date", datetime, None, style or self.datetimestyle)
+
+    def moneycell(self, m, formula=None, style=None):
+        return Cell("currency", m, formula, style or self.currencystyle)
+
+    def headercell(self, text, style=None):
+        return Cell("string", text, None, style or self.headerstyle)
+
+    def colwidth(self, width):
+        return width
+
+    def as_response(self):
+        if self._sheet:
+            self._sheet.finish()
+        self._writer.finish()
+        self._output.seek(0)
+        return FileResponse(
+            self._output, content_type=self.mimetype,
+            as_attachment=bool(self.filename), filename=self.filename or "")
@@ -5,6 +5,7 @@ from quicktill.models import (
     Transline,
     Session,
     SessionTotal,
+    SessionDeptTotal,
     RemoveCode,
     StockOut,
     StockType,
@@ -25,13 +26,12 @@ from odf.text import P
 from odf.table import Table, TableColumn, TableRow, TableCell
 import odf.number as number
 from .db import td
+from .sheetstream import StreamingDocument, cellref
 
 
 class Sheet:
     """A table in a spreadsheet"""
 
-    _LETTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-
     def __init__(self, name):
         self.name = name
         # Indexed by tuples of (col, row)
@@ -46,22 +46,7 @@ class Sheet:
     def colstyle(self, col, style):
         self._columnstyles[col] = style
 
-    def ref(self, col, row, scol=False, srow=False):
-        """Reference to a cell.
-
-        If scol is set then makes a specific reference to that column;
-        if srow is set then makes a specific reference to that row.
-        Otherwise makes a relative reference.
-        """
-        c = col + 1
-        cv = []
-        while c:
-            c, r = divmod(c - 1, len(self._LETTERS))
-            cv[:0] = self._LETTERS[r]
-        return "{}{}{}{}".format("$" if scol else "",
-                                 "".join(cv),
-                                 "$" if srow else "",
-                                 row + 1)
+    ref = staticmethod(cellref)
 
     def as_table(self):
         """Convert to a odf.table.Table object"""
@@ -247,11 +232,12 @@ class Document:
         return r
 
 
-def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
+def sessionrange(start=None, end=None, rows="Sessions", tillname="Till",
+                 format="ods"):
     """A spreadsheet summarising sessions between the start and end date.
     """
     depts = td.s.query(Department).order_by(Department.id).all()
-    tf = func.sum(Transline.items * Transline.amount).label("depttotal")
+    sdt = SessionDeptTotal.all_sessions()
     # I believe weeks run Monday to Sunday!
     weeks = func.div(Session.date - datetime.date(2002, 8, 5), 7)
 
@@ -262,11 +248,10 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
 
     if rows == "Sessions":
         depttotals = \
-            td.s.query(Session, Department.id, tf)\
+            td.s.query(Session, sdt.c.dept, sdt.c.total)\
                 .select_from(Session)\
                 .options(undefer(Session.actual_total))\
-                .order_by(Session.id, Department.id)\
-                .group_by(Session.id, Department.id)\
+                .order_by(Session.id, sdt.c.dept)\
                 .filter(
                     select(func.count(SessionTotal.sessionid))
                     .filter(SessionTotal.sessionid == Session.id)
@@ -275,9 +260,7 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
                 .filter(Session.endtime != None)\
                 .filter(Session.date >= start)\
                 .filter(Session.date <= end)\
-                .join(Transaction)\
-                .join(Transline)\
-                .join(Department)
+                .join(sdt, sdt.c.sessionid == Session.id)
     else:
         dateranges = td.s.query(func.min(Session.date).label("start"),
                                 func.max(Session.date).label("end"))\
@@ -293,20 +276,19 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
 
         depttotals = td.s.query(dateranges.c.start,
                                 dateranges.c.end,
-                                Transline.dept_id,
-                                tf)\
+                                sdt.c.dept,
+                                func.sum(sdt.c.total))\
                          .select_from(
                              dateranges.join(
                                  Session,
                                  and_(
                                      Session.date >= dateranges.c.start,
                                      Session.date <= dateranges.c.end)
-                             ).join(Transaction)
-                             .join(Transline))\
+                             ).join(sdt, sdt.c.sessionid == Session.id))\
                          .group_by(dateranges.c.start,
                                    dateranges.c.end,
-                                   Transline.dept_id)\
-                         .order_by(dateranges.c.start, Transline.dept_id)
+                                   sdt.c.dept)\
+                         .order_by(dateranges.c.start, sdt.c.dept)
 
         acttotals = td.s.query(dateranges.c.start, dateranges.c.end,
                                select(func.sum(SessionTotal.amount))
@@ -336,11 +318,10 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
         filename += "-daily"
     if rows == "Weeks":
         filename += "-weekly"
-    filename = filename + ".ods"
 
-    doc = Document(filename=filename)
+    doc = StreamingDocument(filename=filename, format=format)
 
-    table = Sheet(tillname)
+    table = doc.sheet(tillname)
 
     widthshort = doc.colwidth("2.0cm")
     widthtotal = doc.colwidth("2.2cm")
@@ -396,7 +377,7 @@ def sessionrange(start=None, end=None, rows="Sessions", tillname="Till"):
 
     row = 0
     prev_row = None
-    for x in depttotals:
+    for x in depttotals.yield_per(1000):
         if rows == "Sessions":
             session, dept, total = x
             actual_total = session.actual_total
@@ -710,7 +691,8 @@ def waste(start=None, end=None, cols="depts", tillname="Till"):
     return doc.as_response()
 
 
-def stocksold(start=None, end=None, dates="transaction", tillname="Till"):
+def stocksold(start=None, end=None, dates="transaction", tillname="Till",
+              format="ods"):
     sold = td.s.query(StockType, func.sum(StockOut.qty))\
                .options(contains_eager(StockType.department))\
                .join(Department)\
@@ -736,10 +718,10 @@ def stocksold(start=None, end=None, dates="transaction", tillname="Till"):
             sold = sold.filter(
                 StockOut.time < (end + datetime.timedelta(days=1)))
 
-    filename = "{}-stock-sold.ods".format(tillname)
-    doc = Document(filename)
+    filename = "{}-stock-sold".format(tillname)
+    doc = StreamingDocument(filename, format=format)
 
-    sheet = Sheet("Stock sold")
+    sheet = doc.sheet("Stock sold")
     # Columns are:
     # Manufacturer  Name  ABV  Dept  qty  Unit
     sheet.cell(0, 0, doc.headercell("Manufacturer"))
@@ -750,7 +732,7 @@ def stocksold(start=None, end=None, dates="transaction", tillname="Till"):
     sheet.cell(5, 0, doc.headercell("Unit"))
 
     row = 1
-    for st, qty in sold.all():
+    for st, qty in sold.yield_per(1000):
         sheet.cell(0, row, doc.textcell(st.manufacturer))
         sheet.cell(1, row, doc.textcell(st.name))
         if st.abv:
@@ -765,7 +747,8 @@ def stocksold(start=None, end=None, dates="transaction", tillname="Till"):
 
 
 def translinesummary(start=None, end=None, dates="transaction",
-                     department=None, simplify=False, tillname="Till"):
+                     department=None, simplify=False, tillname="Till",
+                     format="ods"):
     what = Transline.text
 
     if simplify:
@@ -793,10 +776,10 @@ def translinesummary(start=None, end=None, dates="transaction",
             tl = tl.filter(
                 Transline.time < (end + datetime.timedelta(days=1)))
 
-    filename = "{}-transline-summary.ods".format(tillname)
-    doc = Document(filename)
+    filename = "{}-transline-summary".format(tillname)
+    doc = StreamingDocument(filename, format=format)
 
-    sheet = Sheet("Transaction line summary")
+    sheet = doc.sheet("Transaction line summary")
     # Columns are:
     # Text  Count
     # Manufacturer  Name  ABV  Dept  qty  Unit
@@ -804,7 +787,7 @@ def translinesummary(start=None, end=None, dates="transaction",
     sheet.cell(1, 0, doc.headercell("Count"))
 
     row = 1
-    for text, count in tl.all():
+    for text, count in tl.yield_per(1000):
         sheet.cell(0, row, doc.textcell(text))
         sheet.cell(1, row, doc.numbercell(count))
         row += 1
@@ -122,6 +122,8 @@ tillurls = [
     path('reports/translines/', views.transline_summary_report,
          name="tillweb-report-transline-summary"),
     path('reports/refusals/', views.refusals, name="tillweb-refusals"),
+    path('reports/view-statistics/', views.view_statistics,
+         name="tillweb-view-statistics"),
 
     path('datatable/sessions.json', datatable.sessions,
          name="tillweb-datatable-sessions"),
@@ -7,9 +7,11 @@ from django.shortcuts import render, redirect
 from django.conf import settings
 from django import forms
 from django.core.exceptions import ValidationError
+from django.core.exceptions import PermissionDenied
 import sqlalchemy
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm import selectinload
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm import lazyload
 from sqlalchemy.orm import defaultload
@@ -29,10 +31,13 @@ from quicktill.models import (
     Department,
     Session,
     SessionTotal,
+    SessionDeptTotal,
     StockLine,
     StockLineTypeLog,
     StockAnnotation,
     StockItem,
+    StockTypeSales,
+    StockValuation,
     Transaction,
     Delivery,
     Supplier,
@@ -51,7 +56,6 @@ from quicktill.models import (
     Config,
     Payment,
     PayType,
-    money,
     money_max_digits,
     money_decimal_places,
     qty_max_digits,
@@ -65,6 +69,8 @@ from quicktill.models import (
 )
 from quicktill.version import shortversion
 from . import spreadsheets
+from . import sheetstream
+from . import profiling
 import datetime
 import logging
 from .db import td
@@ -197,6 +203,7 @@ class user:
 
 def tillweb_view(view):
     tillweb_login_required = getattr(settings, 'TILLWEB_LOGIN_REQUIRED', True)
+    viewname = f"{view.__module__.rpartition('.')[2]}.{view.__name__}"
 
     def new_view(request, *args, **kwargs):
         # There used to be a "pubname" kwarg here, but it is now redundant.
@@ -208,26 +215,22 @@ def tillweb_view(view):
         session = settings.TILLWEB_DATABASE()
         money = settings.TILLWEB_MONEY_SYMBOL
 
-        # At this point, access will be "R", "M" or "F".
-        # For anything other than "R" access, we need a quicktill.models.User
-        tilluser = None
-        if request.user.is_authenticated:
-            tilluser = session.query(User)\
-                              .options(joinedload(User.permissions))\
-                              .filter(User.webuser == request.user.username)\
-                              .one_or_none()
+        profile = None
+        if profiling.enabled():
+            profile = profiling.RequestProfile(viewname)
+            profiling.instrument(session.get_bind())
+            td.profile = profile
 
         try:
-            if settings.DEBUG:
-                queries_before_render = 0
-                queries = []
-
-                def querylog_callback(_conn, _cur, query, params, *_):
-                    queries.append(query)
-
-                sqlalchemy.event.listen(
-                    session.get_bind(), "before_cursor_execute",
-                    querylog_callback)
+            # At this point, access will be "R", "M" or "F".
+            # For anything other than "R" access, we need a
+            # quicktill.models.User
+            tilluser = None
+            if request.user.is_authenticated:
+                tilluser = session.query(User)\
+                    .options(joinedload(User.permissions))\
+                    .filter(User.webuser == request.user.username)\
+                    .one_or_none()
 
             info = viewutils(
                 access=access,
@@ -239,23 +242,28 @@ def tillweb_view(view):
             td.info = info
             td.s = session
             result = view(request, info, *args, **kwargs)
-            if settings.DEBUG:
-                queries_before_render = len(queries)
+            if profile:
+                profile.view_done()
             if isinstance(result, HttpResponse):
-                return result
-            t, d = result
-            # till is the name of the till
-            # access is 'R','M','F'
-            defaults = {
-                'till': tillname,
-                'access': access,
-                'tilluser': tilluser,
-                'dtf': dtf,
-                'version': shortversion,
-                'money': money,
-            }
-            defaults.update(d)
-            return render(request, 'tillweb/' + t, defaults)
+                response = result
+            else:
+                t, d = result
+                # till is the name of the till
+                # access is 'R','M','F'
+                defaults = {
+                    'till': tillname,
+                    'access': access,
+                    'tilluser': tilluser,
+                    'dtf': dtf,
+                    'version': shortversion,
+                    'money': money,
+                }
+                defaults.update(d)
+                response = render(request, 'tillweb/' + t, defaults)
+            if profile:
+                profile.finish()
+                response['Server-Timing'] = profile.server_timing()
+            return response
         except OperationalError as oe:
             return render(request, "tillweb/operationalerror.html",
                           {'till': tillname,
@@ -263,17 +271,9 @@ def tillweb_view(view):
                            'error': oe},
                           status=503)
         finally:
-            if settings.DEBUG:
-                sqlalchemy.event.remove(
-                    session.get_bind(), "before_cursor_execute",
-                    querylog_callback)
-                if len(queries) > 3:
-                    log.warning(
-                        "Excessive queries in view (%d pre render, %d "
-                        "during render)",
-                        queries_before_render,
-                        len(queries) - queries_before_render)
-
+            if profile:
+                td.profile = None
+                profiling.record(profile)
             td.s = None
             td.request = None
             td.info = None
@@ -299,13 +299,12 @@ def business_totals(firstday, lastday):
     # This query is wrong in that it ignores the 'business' field in
     # VatRate objects.  Fixes that don't involve a database round-trip
     # per session are welcome!
-    return td.s.query(Business,
-                      func.sum(Transline.items * Transline.amount))\
+    sdt = SessionDeptTotal.all_sessions()
+    return td.s.query(Business, func.sum(sdt.c.total))\
                .join(VatBand)\
                .join(Department)\
-               .join(Transline)\
-               .join(Transaction)\
-               .join(Session)\
+               .join(sdt, sdt.c.dept == Department.id)\
+               .join(Session, Session.id == sdt.c.sessionid)\
                .filter(Session.date <= lastday)\
                .filter(Session.date >= firstday)\
                .order_by(Business.id)\
@@ -419,6 +418,7 @@ class SessionSheetForm(DatePeriodForm):
         ("Days", "Days"),
         ("Weeks", "Weeks"),
     ])
+    format = forms.ChoiceField(label="Format", choices=sheetstream.formats)
 
 
 @tillweb_view
@@ -431,7 +431,8 @@ def sessions(request, info):
                 start=cd['startdate'],
                 end=cd['enddate'],
                 rows=cd['rows'],
-                tillname=info.tillname)
+                tillname=info.tillname,
+                format=cd['format'])
     else:
         rangeform = SessionSheetForm()
 
@@ -2398,6 +2399,35 @@ class StockCheckForm(forms.Form):
         query_filter=lambda q: q.order_by(Department.id))
 
 
+def _buylist(stocktype_filter, ahead, behind, min_sale):
+    """Stock types that need to be bought
+
+    Returns a list of (stocktype, sold per day, in stock, to buy)
+    tuples for stock types matching stocktype_filter that sold more
+    than min_sale base units per day over the period behind, most
+    needed first.  Quantities are in stock units.
+    """
+    sold = func.sum(StockTypeSales.sold) / behind.days
+    r = td.s.query(StockType, sold)\
+            .join(StockTypeSales,
+                  StockTypeSales.stocktype_id == StockType.id)\
+            .options(lazyload(StockType.department),
+                     lazyload(StockType.unit),
+                     undefer(StockType.all_instock))\
+            .filter(StockTypeSales.date > func.current_date() - behind.days)\
+            .filter(stocktype_filter)\
+            .having(sold > min_sale)\
+            .group_by(StockType)\
+            .all()
+    return sorted(
+        ((st, sold / st.unit.base_units_per_stock_unit,
+          st.all_instock / st.unit.base_units_per_stock_unit,
+          (sold * ahead.days - st.all_instock)
+          / st.unit.base_units_per_stock_unit)
+         for st, sold in r),
+        key=lambda x: x[3], reverse=True)
+
+
 @tillweb_view
 def stockcheck(request, info):
     buylist = []
@@ -2409,26 +2439,8 @@ def stockcheck(request, info):
             behind = datetime.timedelta(days=cd['months_behind'] * 30.4)
             min_sale = cd['minimum_sold']
             dept = cd['department']
-            r = td.s.query(StockType, func.sum(StockOut.qty) / behind.days)\
-                    .select_from(StockType)\
-                    .join(StockItem)\
-                    .join(StockOut)\
-                    .options(lazyload(StockType.department),
-                             lazyload(StockType.unit),
-                             undefer(StockType.all_instock))\
-                    .filter(StockOut.removecode_id == 'sold')\
-                    .filter((func.now() - StockOut.time) < behind)\
-                    .filter(StockType.department == dept)\
-                    .having(func.sum(StockOut.qty) / behind.days > min_sale)\
-                    .group_by(StockType)\
-                    .all()
-            buylist = sorted(
-                ((st, sold / st.unit.base_units_per_stock_unit,
-                  st.all_instock / st.unit.base_units_per_stock_unit,
-                  (sold * ahead.days - st.all_instock)
-                  / st.unit.base_units_per_stock_unit)
-                 for st, sold in r),
-                key=lambda x: x[3], reverse=True)
+            buylist = _buylist(StockType.department == dept,
+                               ahead, behind, min_sale)
     else:
         form = StockCheckForm()
     return ('stockcheck.html', {
@@ -2477,26 +2489,8 @@ def stockcheck_supplier(request, info):
                 .join(Delivery)\
                 .where((func.now() - Delivery.date) < supplier_behind)\
                 .where(Delivery.supplierid == supplier.id)
-            r = td.s.query(StockType, func.sum(StockOut.qty) / behind.days)\
-                    .select_from(StockType)\
-                    .join(StockItem)\
-                    .join(StockOut)\
-                    .options(lazyload(StockType.department),
-                             lazyload(StockType.unit),
-                             undefer(StockType.all_instock))\
-                    .filter(StockOut.removecode_id == 'sold')\
-                    .filter((func.now() - StockOut.time) < behind)\
-                    .filter(StockType.id.in_(stocktypes))\
-                    .having(func.sum(StockOut.qty) / behind.days > min_sale)\
-                    .group_by(StockType)\
-                    .all()
-            buylist = sorted(
-                ((st, sold / st.unit.base_units_per_stock_unit,
-                  st.all_instock / st.unit.base_units_per_stock_unit,
-                  (sold * ahead.days - st.all_instock)
-                  / st.unit.base_units_per_stock_unit)
-                 for st, sold in r),
-                key=lambda x: x[3], reverse=True)
+            buylist = _buylist(StockType.id.in_(stocktypes),
+                               ahead, behind, min_sale)
     else:
         form = SupplierStockCheckForm()
     return ('stockcheck-supplier.html', {
@@ -2832,6 +2826,7 @@ def vatband(request, info, vatband):
 def reportindex(request, info):
     return ('reports.html', {
         'nav': [("Reports", reverse("tillweb-reports"))],
+        'may_view_statistics': info.user_has_perm("view-web-statistics"),
     })
 
 
@@ -2870,6 +2865,7 @@ class StockSoldReportForm(DatePeriodForm):
         ("transaction", "Transaction Date"),
         ("stockusage", "Date entered"),
     ])
+    format = forms.ChoiceField(label="Format", choices=sheetstream.formats)
 
 
 @tillweb_view
@@ -2882,7 +2878,8 @@ def stock_sold_report(request, info):
                 start=cd['startdate'],
                 end=cd['enddate'],
                 dates=cd['dates'],
-                tillname=info.tillname)
+                tillname=info.tillname,
+                format=cd['format'])
     else:
         stocksoldform = StockSoldReportForm(prefix="stocksold")
 
@@ -2907,44 +2904,31 @@ class StockValueForm(forms.Form):
 def stock_value_report(request, info):
     depts = None
     total = None
+    base = None
 
     if request.method == 'POST':
         form = StockValueForm(request.POST)
         if form.is_valid():
             time = form.cleaned_data['time'] or datetime.datetime.now()
-
-            used = func.coalesce(
-                (select(func.sum(StockOut.qty))
-                 .correlate(StockItem.__table__)
-                 .where(StockOut.time < time)
-                 .where(StockOut.stockid == StockItem.id)
-                 .as_scalar()), "0.0")
-            # XXX consider what happens for stock items discovered
-            # during a stock take — although their cost price will
-            # generally be null so will not affect this query.  The
-            # correct appropach would probably be to add a column
-            # property to StockItem for "delivery date" which can pull
-            # from the Delivery or StockTake as appropriate.
-            depts = td.s.query(Department, func.sum(
-                func.cast(
-                    func.coalesce(StockItem.costprice, zero)
-                    * ("1.0" - (used / StockItem.size)),
-                    money
-                )))\
-                .select_from(StockItem)\
-                .join(Delivery)\
-                .join(StockType)\
-                .join(Department)\
-                .filter(Delivery.date < time)\
-                .group_by(Department)\
-                .order_by(Department.id)\
-                .filter(or_(StockItem.finished == None,
-                            StockItem.finished >= time))\
-                .all()
+            depts = StockValuation.department_values(td.s, time)
+            base = StockValuation.nearest(td.s, time)
             total = sum((b for _, b in depts), start=zero)
     else:
         form = StockValueForm()
 
+    valuations = td.s.query(StockValuation)\
+                     .order_by(StockValuation.time.desc())\
+                     .options(selectinload(StockValuation.departments))\
+                     .limit(10)\
+                     .all()
+    valuation_depts = sorted(
+        {d.department for v in valuations for d in v.departments},
+        key=lambda d: d.id)
+    valuations = [
+        (v, [{d.department: d.value for d in v.departments}.get(dept)
+             for dept in valuation_depts])
+        for v in valuations]
+
     return ('stock-value-report.html', {
         'nav': [
             ("Reports", reverse("tillweb-reports")),
@@ -2953,6 +2937,9 @@ def stock_value_report(request, info):
         'form': form,
         'departments': depts,
         'total': total,
+        'base': base,
+        'valuations': valuations,
+        'valuation_depts': valuation_depts,
     })
 
 
@@ -2978,7 +2965,8 @@ def transline_summary_report(request, info):
                 dates=cd['dates'],
                 department=cd['department'],
                 simplify=cd['simplify'],
-                tillname=info.tillname)
+                tillname=info.tillname,
+                format=cd['format'])
     else:
         form = TranslineSummaryReportForm()
 
@@ -3000,3 +2988,32 @@ def refusals(request, info):
             ("Refusals", reverse("tillweb-refusals")),
         ],
     })
+
+
+@tillweb_view
+def view_statistics(request, info):
+    if not info.user_has_perm("view-web-statistics"):
+        raise PermissionDenied
+
+    if request.method == "POST" and 'submit_reset' in request.POST:
+        profiling.reset()
+        messages.info(request, "Statistics reset")
+        return HttpResponseRedirect(reverse("tillweb-view-statistics"))
+
+    views = profiling.snapshot()
+    slowest = sorted(
+        ((duration, vs.view, statement) for vs in views
+         for duration, statement in vs.slowest),
+        key=lambda x: x[0], reverse=True)[:20]
+
+    return ('view-statistics.html', {
+        'nav': [
+            ("Reports", reverse("tillweb-reports")),
+            ("View statistics", reverse("tillweb-view-statistics")),
+        ],
+        'since': datetime.datetime.fromtimestamp(profiling.since),
+        'budget': profiling.query_budget(),
+        'enabled': profiling.enabled(),
+        'views': views,
+        'slowest': slowest,
+    })
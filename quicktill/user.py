@@ -14,7 +14,10 @@ indicate restricted functionality.
 """
 
 from . import ui, td, keyboard, tillconfig, cmdline, config, passwords
-from .models import User, UserToken, Permission, Group, LogEntry
+from . import listen
+from .models import User, UserToken, Permission, Group, LogEntry, Config
+from .models import group_grants_table, group_membership_table
+from sqlalchemy import select, event
 from sqlalchemy.orm import joinedload
 from sqlalchemy.exc import IntegrityError
 import socket
@@ -47,6 +50,15 @@ allow_password_only_login = config.BooleanConfigItem(
                  'to be present on the keyboard.'),
 )
 
+password_hash_iterations = config.PositiveIntConfigItem(
+    'user:password_hash_iterations', passwords.PBKDF2Hasher.iterations,
+    display_name='Password hash iterations',
+    description=('Number of iterations used when storing passwords. More '
+                 'iterations make stored passwords harder to crack, but '
+                 'make logging in slower. Passwords stored with a different '
+                 'number of iterations are stored again when their users '
+                 'next log in. "runtill passwordcost" suggests a value.'),
+)
 
 # We declare 'log' later on for writing log entries to the database
 debug_log = logging.getLogger(__name__)
@@ -281,6 +293,73 @@ class built_in_user:
                      colour=ui.colour_info)
 
 
+class PermissionCache(listen.NotifiedCache):
+    """Flattened permissions of every user, cached in memory
+
+    A user's permissions come from the groups they have been granted,
+    so working them out needs a query joining through the groups.
+    This cache loads the permissions of all users in one query and
+    keeps them until the database notifies a change to group
+    membership or grants, so logging in doesn't need a permissions
+    query.
+
+    It is loaded in the till's ORM session so that it agrees with
+    changes made earlier in the session, and is cleared when that
+    session is rolled back in case it saw changes that were then
+    abandoned.
+    """
+    def __init__(self):
+        super().__init__()
+        self._permissions = None  # userid: frozenset of permission names
+        self.loads = 0
+
+    def _listen(self, listener):
+        listener.listen_for('group_membership_changed', self._changed)
+        listener.listen_for('group_grants_changed', self._changed)
+        event.listen(td.s, 'after_rollback', self._changed)
+
+    def _changed(self, *args):
+        self._permissions = None
+
+    def clear(self):
+        self._permissions = None
+
+    @staticmethod
+    def _query(userid=None):
+        q = select(group_grants_table.c.user,
+                   group_membership_table.c.permission)\
+            .select_from(group_grants_table.join(
+                group_membership_table,
+                group_grants_table.c.group == group_membership_table.c.group))
+        if userid is not None:
+            q = q.where(group_grants_table.c.user == userid)
+        permissions = {}
+        for u, p in td.s.execute(q):
+            permissions.setdefault(u, set()).add(p)
+        return {u: frozenset(p) for u, p in permissions.items()}
+
+    def permissions(self, userid):
+        """The names of a user's permissions, as a frozenset
+
+        This ignores the superuser flag.
+        """
+        if not self._usable():
+            return self._query(userid).get(userid, frozenset())
+        if self._permissions is None:
+            self._permissions = self._query()
+            self.loads += 1
+        return self._permissions.get(userid, frozenset())
+
+    def __str__(self):
+        if self._permissions is None:
+            return f"Not loaded; loaded {self.loads} times"
+        return f"{len(self._permissions)} users cached; " \
+            f"loaded {self.loads} times"
+
+
+permission_cache = PermissionCache()
+
+
 class database_user(built_in_user):
     """A user loaded from the database.
 
@@ -290,7 +369,7 @@ class database_user(built_in_user):
     def __init__(self, user):
         super().__init__(
             user.fullname, user.shortname,
-            permissions=[p.id for p in user.permissions],
+            permissions=sorted(permission_cache.permissions(user.id)),
             is_superuser=user.superuser)
         self.userid = user.id
         self.password_set = (user.password is not None)
@@ -387,8 +466,7 @@ def token_login(t):
     _check_permissions()
 
     dbt = td.s.get(UserToken, t.usertoken, options=[
-        joinedload(UserToken.user),
-        joinedload(UserToken.user).joinedload(User.permissions)])
+        joinedload(UserToken.user)])
     if not dbt:
         ui.toast(f"User token '{t.usertoken}' not recognised.")
         return
@@ -450,43 +528,136 @@ class _dismiss_on_token_or_login_key:
         super().hotkeypress(k)
 
 
-class _password_prompt(_dismiss_on_token_or_login_key, ui.dismisspopup):
+def _check_password(password, encoded, iterations):
+    """Check a password, and encode it again if necessary
+
+    Called in a worker thread.  Returns a tuple of (correct, new
+    encoded password); the new encoded password is None unless the
+    password is correct and the old one needs updating.
+    """
+    if not passwords.check_password(password, encoded):
+        return False, None
+    if passwords.must_update(encoded, iterations=iterations):
+        return True, passwords.encode_password(
+            password, iterations=iterations)
+    return True, None
+
+
+class _background_password_check:
+    """Mixin class for popups that check passwords
+
+    Checking a password takes long enough to make the till
+    unresponsive, so it is done in a worker thread.  At most one
+    check is in progress at a time; if another is requested before it
+    finishes, the most recent request is started when it does.
+    """
+    _checking = None
+    _next_check = None
+    _dismissed = False
+
+    def check_password_in_background(self, password, userid, cont):
+        """Check a user's password
+
+        cont is called with the User and whether the password was
+        correct, unless the popup has been dismissed in the meantime.
+        If the password is correct and was stored with a different
+        number of iterations, it is stored again first.
+        """
+        if self._checking:
+            checking_password, checking_userid, _ = self._checking
+            if (password, userid) == (checking_password, checking_userid):
+                # Same check already in progress; just note what to do
+                # with the answer
+                self._checking = (password, userid, cont)
+                self._next_check = None
+            else:
+                self._next_check = (password, userid, cont)
+            return
+        encoded = td.s.get(User, userid).password
+        iterations = password_hash_iterations()
+        self._checking = (password, userid, cont)
+        tillconfig.mainloop.run_in_worker(
+            lambda: _check_password(password, encoded, iterations),
+            lambda future: self._password_checked(userid, encoded, future),
+            desc="check password")
+
+    def _password_checked(self, userid, encoded, future):
+        # Completion of a worker doesn't start database session
+        with td.orm_session():
+            _, _, cont = self._checking
+            self._checking = None
+            if self._dismissed:
+                return
+            if self._next_check:
+                # The result of this check is no longer wanted
+                next_check = self._next_check
+                self._next_check = None
+                self.check_password_in_background(*next_check)
+                return
+            with ui.exception_guard("checking the password"):
+                correct, new_encoded = future.result()
+                dbu = td.s.get(User, userid)
+                if new_encoded and dbu.password == encoded:
+                    dbu.password = new_encoded
+                cont(dbu, correct)
+
+    def dismiss(self):
+        self._dismissed = True
+        super().dismiss()
+
+
+class _password_prompt(_dismiss_on_token_or_login_key,
+                       _background_password_check, ui.dismisspopup):
     def __init__(self, dbt):
         super().__init__(8, 40, title=dbt.user.shortname,
                          colour=ui.colour_input)
         self.t = dbt.token
+        self.userid = dbt.user.id
         self.win.wrapstr(2, 2, 36,
                          'Please enter your password.')
         self.password = ui.editfield(5, 2, 36, keymap={
-            keyboard.K_CASH: (self.wrong_password, None)}, hidden=True)
+            keyboard.K_CASH: (self.enter, None)}, hidden=True)
         self.password.sethook = self.check_password
         self.password.focus()
 
     def check_password(self):
+        # Called as the password is typed: log in as soon as it is
+        # correct
         if not self.password.f:
             return
+        self.check_password_in_background(
+            self.password.f, self.userid, self._typed_checked)
 
-        dbt = td.s.get(UserToken, self.t, options=[
-            joinedload(UserToken.user),
-            joinedload(UserToken.user).joinedload(User.permissions)])
-
-        if passwords.check_password(self.password.f, dbt.user.password):
-            dbt.last_successful_login = datetime.datetime.now()
-            self.dismiss()
-            _finish_login(dbt.user)
-
-    def wrong_password(self):
+    def enter(self):
         if not self.password.f:
             ui.infopopup(["You must provide a password."], title="Error")
             return
+        self.check_password_in_background(
+            self.password.f, self.userid, self._entered_checked)
+
+    def _typed_checked(self, dbu, correct):
+        if correct:
+            self._login()
 
+    def _entered_checked(self, dbu, correct):
+        if correct:
+            self._login()
+            return
         ui.infopopup(["Incorrect password. If you have forgotten your "
                       "password, call your manager for help resetting it."],
                      title="Error")
         self.password.clear()
 
+    def _login(self):
+        dbt = td.s.get(UserToken, self.t, options=[
+            joinedload(UserToken.user)])
+        dbt.last_successful_login = datetime.datetime.now()
+        self.dismiss()
+        _finish_login(dbt.user)
+
 
-class _password_login_prompt(_dismiss_on_token_or_login_key, ui.dismisspopup):
+class _password_login_prompt(_dismiss_on_token_or_login_key,
+                             _background_password_check, ui.dismisspopup):
     def __init__(self):
         super().__init__(10, 40, title="Log In",
                          colour=ui.colour_input)
@@ -563,7 +734,11 @@ class _password_login_prompt(_dismiss_on_token_or_login_key, ui.dismisspopup):
             self.uid.clear()
             return
 
-        if not passwords.check_password(self.password.f, dbu.password):
+        self.check_password_in_background(
+            self.password.f, dbu.id, self._password_checked_cont)
+
+    def _password_checked_cont(self, dbu, correct):
+        if not correct:
             ui.infopopup(["Incorrect password. If you have forgotten your "
                           "password, call your manager for help resetting it."],
                          title="Error")
@@ -742,7 +917,8 @@ class change_user_password(permission_checked, ui.dismisspopup):
             if ui.current_user() and user.id != ui.current_user().userid:
                 log(f'Cleared password for {user.logref}')
         else:
-            user.password = passwords.encode_password(self.password.f)
+            user.password = passwords.encode_password(
+                self.password.f, iterations=password_hash_iterations())
             ui.toast(f'Password for user "{user.fullname}" changed.')
 
             # If this popup is over the lock screen or anonymous stock
@@ -1288,6 +1464,39 @@ class listusers(cmdline.command):
                 print(f"{u.id:>4}: {u.fullname} ({u.shortname})")
 
 
+class passwordcost(cmdline.command):
+    """Choose the number of iterations used when storing passwords.
+
+    Times password hashing on this machine and reports the number of
+    iterations that takes the target time.  Every terminal checks
+    the same stored passwords, so run this on the slowest one.
+    """
+    help = "suggest the number of iterations used to store passwords"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "-t", "--time", type=float, default=0.5,
+            help="target time to check a password, in seconds "
+            "(default %(default)s)")
+        parser.add_argument(
+            "-s", "--set", action="store_true",
+            help="store the suggested value in the till configuration")
+
+    @staticmethod
+    def run(args):
+        iterations = passwords.calibrate(args.time)
+        print(f"{iterations} iterations take about {args.time} seconds "
+              f"on this machine.")
+        with td.orm_session():
+            print(f"The current setting is {password_hash_iterations()}.")
+            if args.set:
+                td.s.get(Config, password_hash_iterations.key).value = \
+                    password_hash_iterations.to_db(iterations)
+                print("Setting updated; passwords will be stored again "
+                      "when their users next log in.")
+
+
 class show_usertoken(cmdline.command):
     """Display user token
     """
@@ -1330,6 +1539,8 @@ class show_usertoken(cmdline.command):
 action_descriptions['edit-config'] = "Modify the till configuration"
 action_descriptions['edit-department'] = "Create or alter departments"
 action_descriptions['edit-group'] = "Modify permission groups"
+action_descriptions['view-web-statistics'] = \
+    "View query and timing statistics for the web interface"
 
 
 class default_groups:
@@ -1,11 +1,13 @@
 # Add quicktill.xero to /etc/quicktill/default-imports to enable Xero
 # setup command-line options
 
+import requests
 from requests_oauthlib import OAuth2Session
 from oauthlib.oauth2 import WebApplicationClient
 from oauthlib.oauth2.rfc6749.errors import InvalidGrantError, AccessDeniedError
 from xml.etree.ElementTree import Element, SubElement, tostring, fromstring
 import datetime
+import time
 import secrets
 import hashlib
 import base64
@@ -15,14 +17,20 @@ from . import session
 from . import payment
 from . import ui
 from . import td
+from . import tillconfig
 from . import user
 from . import delivery
 from . import keyboard
 from . import cmdline
 from . import config
 from . import secretstore
+from . import startup
 from .models import Session, zero
 from .models import Delivery, Supplier
+from .models import AccountsExport
+from sqlalchemy.sql import select, func
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm import Session as ORMSession
 log = logging.getLogger(__name__)
 
 # Zap the very unhelpful behaviour from oauthlib when Xero returns
@@ -62,6 +70,21 @@ class XeroError(Exception):
     pass
 
 
+class XeroUnavailable(XeroError):
+    """Xero could not be reached, or had a problem; try again later
+    """
+    pass
+
+
+class XeroRateLimited(XeroUnavailable):
+    """Xero has asked us to wait before making any more requests
+    """
+    def __init__(self, retry_after):
+        super().__init__(f"Xero rate limit reached; wait {retry_after} "
+                         f"seconds before trying again")
+        self.retry_after = retry_after
+
+
 def xero_not_connected():
     ui.infopopup(
         ["The till is not connected to Xero. If it was previously connected, "
@@ -88,30 +111,21 @@ class XeroSessionHooks(session.SessionHooks):
         session = td.s.get(Session, sessionid)
         if self.xero.start_date() and self.xero.start_date() > session.date:
             return
+        self.xero.queue_session(sessionid, self.xero.auto_approve_invoice())
         # Commit at this point to ensure the totals are recorded in
-        # the till database.
+        # the till database before the export queue looks at them.
         td.s.commit()
         ui.toast("Sending session details to accounting system...")
-        try:
-            with ui.exception_guard("creating the Xero invoice",
-                                    suppress_exception=False):
-                invid, negative_totals = self.xero._create_invoice_for_session(
-                    sessionid, approve=self.xero.auto_approve_invoice())
-        except XeroError:
-            return
-        # Record the Xero invoice ID
-        session.accinfo = invid
-        # We want to commit the invoice ID to the database even if adding
-        # payments fails, so we can try again later
-        td.s.commit()
-        if self.xero.auto_approve_invoice() and not negative_totals:
-            try:
-                with ui.exception_guard("adding payments to the Xero invoice",
-                                        suppress_exception=False):
-                    self.xero._add_payments_for_session(sessionid, invid)
-            except XeroError:
-                return
-        ui.toast("Session details uploaded to Xero.")
+        self.xero.export_worker.kick()
+
+
+class XeroStartupHook(startup.StartupHook):
+    def __init__(self, xero):
+        self.xero = xero
+
+    def started(self):
+        # Send any work left in the queue when the till last stopped
+        self.xero.export_worker.kick()
 
 
 class XeroDeliveryHooks(delivery.DeliveryHooks):
@@ -141,6 +155,83 @@ class XeroDeliveryHooks(delivery.DeliveryHooks):
         self.xero._send_delivery(deliveryid)
 
 
+class ExportResult:
+    """What happened during a run of the export queue
+    """
+    def __init__(self):
+        # Descriptions of the work that was sent
+        self.sent = []
+        # (description, error) for work that was rejected by Xero or
+        # has run out of attempts
+        self.failed = []
+        # Why Xero couldn't be reached, if it couldn't
+        self.problem = None
+        self.rate_limited = False
+        # Seconds until the remaining work is due, or None
+        self.retry_in = None
+
+
+class XeroExportWorker:
+    """Send the export queue to Xero in the background
+
+    kick() starts a run of the export queue in a worker thread; if a
+    run is already in progress, another one follows it.  When work
+    is left in the queue to be tried again later, a run is scheduled
+    for when it is due.
+    """
+    def __init__(self, xero):
+        self.xero = xero
+        self.running = False
+        self._again = False
+        self._timeout = None
+
+    def kick(self):
+        if self._timeout:
+            self._timeout.cancel()
+            self._timeout = None
+        if self.running:
+            self._again = True
+            return
+        self.running = True
+        tillconfig.mainloop.run_in_worker(
+            self._run, self._done, desc="xero export")
+
+    def _run(self):
+        with td.orm_session():
+            return self.xero.export_queued()
+
+    def _done(self, future):
+        self.running = False
+        result = None
+        with ui.exception_guard("sending work to Xero"):
+            result = future.result()
+            self._report(result)
+        if self._again:
+            self._again = False
+            self.kick()
+        elif result and result.retry_in is not None:
+            self._timeout = tillconfig.mainloop.add_timeout(
+                result.retry_in, self.kick, desc="xero export retry")
+
+    @staticmethod
+    def _report(result):
+        if result.failed:
+            ui.infopopup(
+                ["Some work could not be sent to Xero:", ""]
+                + [f"{what}: {error}" for what, error in result.failed]
+                + ["", "Once the problem has been fixed, use \"Work "
+                   "waiting to be sent to Xero\" on the Xero options menu "
+                   "to try again."],
+                title="Xero error")
+        elif result.problem:
+            ui.toast(f"Couldn't send to Xero: {result.problem}.  "
+                     f"Will try again later.")
+        elif len(result.sent) > 3:
+            ui.toast(f"{len(result.sent)} items sent to Xero.")
+        elif result.sent:
+            ui.toast(f"Sent to Xero: {', '.join(result.sent)}.")
+
+
 class XeroIntegration:
     """Xero accounting system integration
 
@@ -151,6 +242,23 @@ class XeroIntegration:
     """
     _integrations = []
 
+    endpoint_url = XERO_ENDPOINT_URL
+
+    # When Xero can't be reached, queued work is tried again after
+    # export_min_delay seconds, doubling after each attempt up to
+    # export_max_delay seconds.  After export_max_attempts attempts it
+    # is marked as failed.
+    export_min_delay = 60
+    export_max_delay = 3600
+    export_max_attempts = 24
+
+    # Seconds to wait for Xero to respond to a request
+    request_timeout = 30
+
+    # The token is refreshed before it is used if it will expire
+    # within this many seconds
+    token_refresh_margin = 300
+
     def __init__(self,
                  config_prefix="xero",
                  secrets=None,
@@ -253,9 +361,17 @@ class XeroIntegration:
             description="If set, sessions and deliveries will only be sent "
             "to Xero if they are on or after this date.",
             allow_none=True)
+        self.export_batch_size = config.PositiveIntConfigItem(
+            f"{config_prefix}:export_batch_size", 50,
+            display_name="Xero export batch size",
+            description="Maximum number of invoices, bills or sets of "
+            "payments to send to Xero in a single request.")
+
+        self.export_worker = XeroExportWorker(self)
 
         XeroSessionHooks(self)
         XeroDeliveryHooks(self)
+        XeroStartupHook(self)
 
         if obsolete_kwargs:
             log.warning(
@@ -267,10 +383,11 @@ class XeroIntegration:
             self.secrets.fetch('token')
         except secretstore.SecretException:
             return False
-        session = self.xero_session(omit_tenant=True)
         try:
-            r = session.get(XERO_CONNECTIONS_URL)
-        except InvalidGrantError:
+            session = self.xero_session(omit_tenant=True)
+            r = session.get(XERO_CONNECTIONS_URL,
+                            timeout=self.request_timeout)
+        except (requests.RequestException, InvalidGrantError):
             return False
         if r.status_code != 200:
             return False
@@ -280,24 +397,39 @@ class XeroIntegration:
                 return True
         return False
 
-    def xero_session(self, state=None, omit_tenant=False):
+    def _fresh_token(self):
+        """Fetch the token, refreshing it first if it is about to expire
+
+        A refresh token can only be used once, so the token is locked
+        while it is refreshed in case another till is refreshing it
+        too.  This is done in a database session of its own, which is
+        finished before the token is used: the lock is not held while
+        waiting for other requests to Xero.
+
+        Returns None if there is no token.
+        """
+        with ORMSession(td.s.get_bind()) as session:
+            try:
+                token = json.loads(self.secrets.fetch(
+                    'token', lock_for_update=True, session=session))
+            except secretstore.SecretException:
+                return None
+            if token.get('expires_at', 0) \
+               > time.time() + self.token_refresh_margin:
+                return token
+            token = OAuth2Session(self.client_id(), token=token)\
+                .refresh_token(XERO_CONNECT_URL, client_id=self.client_id(),
+                               timeout=self.request_timeout)
+            self.secrets.store('token', json.dumps(token), session=session)
+            session.commit()
+        return token
+
+    def xero_session(self, state=None, omit_tenant=False, with_token=True):
         kwargs = {}
-        try:
-            token = self.secrets.fetch('token', lock_for_update=True)
-            kwargs['token'] = json.loads(token)
-        except secretstore.SecretException:
-            pass
-
-        def token_updater(token):
-            nonlocal self
-            self.secrets.store('token', json.dumps(token),
-                               create=True)
-
-        kwargs['token_updater'] = token_updater
-        kwargs['auto_refresh_kwargs'] = {
-            'client_id': self.client_id(),
-        }
-        kwargs['auto_refresh_url'] = XERO_CONNECT_URL
+        if with_token:
+            token = self._fresh_token()
+            if token:
+                kwargs['token'] = token
         if state:
             kwargs['state'] = state
 
@@ -378,6 +510,8 @@ class XeroIntegration:
              ("Re-send a delivery to Xero as a bill",
               choose_delivery,
               (self._send_delivery, self.start_date(), True)),
+             ("Work waiting to be sent to Xero",
+              self._export_queue_menu, ()),
              ("Test the connection to Xero",
               self.check_connection, ()),
              ("Xero debug menu",
@@ -473,14 +607,7 @@ class XeroIntegration:
         if len(codes) > 1:
             return codes[1]
 
-    def _create_invoice_for_session(self, sessionid, approve=False):
-        """Create an invoice for a session
-
-        Returns the invoice's GUID, and whether any negative payment
-        method totals were added to the invoice.  Does not check
-        whether the invoice has already been created, or record the
-        GUID against the session.
-        """
+    def _check_session(self, sessionid):
         session = td.s.get(Session, sessionid)
         if not session:
             raise XeroError(f"Session {sessionid} does not exist")
@@ -488,11 +615,26 @@ class XeroIntegration:
             raise XeroError(f"Session {sessionid} is still open")
         if not session.actual_totals:
             raise XeroError(f"Session {sessionid} has no totals recorded")
+        return session
+
+    def _check_delivery(self, deliveryid):
+        d = td.s.get(Delivery, deliveryid)
+        if not d:
+            raise XeroError(f"Delivery {deliveryid} does not exist")
+        if not d.supplier.accinfo:
+            raise XeroError(f"Supplier {d.supplier.name} is not linked to "
+                            "a Xero contact")
+        return d
+
+    def _invoice_for_session(self, session, approve):
+        """Build the invoice for a session
 
+        Returns an Invoice element, and whether any negative payment
+        method totals were added to it.
+        """
         negative_totals = False
 
-        invoices = Element("Invoices")
-        inv = SubElement(invoices, "Invoice")
+        inv = Element("Invoice")
         inv.append(_textelem("Type", "ACCREC"))
         inv.append(self._get_sales_contact(session))
         inv.append(_textelem("LineAmountTypes", "Inclusive"))
@@ -575,46 +717,15 @@ class XeroIntegration:
 
         if approve and not negative_totals:
             inv.append(_textelem("Status", "AUTHORISED"))
-        xml = tostring(invoices)
-        r = self.xero_session().put(
-            XERO_ENDPOINT_URL + "Invoices/", data={'xml': xml})
-        if r.status_code == 400:
-            root = fromstring(r.text)
-            messages = [e.text for e in root.findall(".//Message")]
-            raise XeroError("Xero rejected invoice: {}".format(
-                ", ".join(messages)))
-        if r.status_code != 200:
-            raise XeroError(f"Received {r.status_code} response")
-        root = fromstring(r.text)
-        if root.tag != "Response":
-            raise XeroError(
-                f"Response root tag '{root.tag}' was not 'Response'")
-        i = root.find("./Invoices/Invoice")
-        if not i:
-            raise XeroError("Response did not contain invoice details")
-        invid = _fieldtext(i, "InvoiceID")
-        if not invid:
-            raise XeroError("No invoice ID was returned")
-        # warnings = [w.text for w in i.findall("./Warnings/Warning/Message")]
-        return invid, negative_totals
+        return inv, negative_totals
 
-    def _add_payments_for_session(self, sessionid, invoice):
-        """Add payments for a session to an existing invoice
+    def _payments_for_session(self, session, invoice):
+        """Build the payments for a session
 
-        The invoice is specified by its Xero InvoiceID.  It must be
-        Approved, otherwise adding payments will fail.  This call does
-        not check the invoice state, or whether payments have already
-        been added.
+        Returns a list of Payment elements to be added to the invoice
+        with the specified InvoiceID.
         """
-        session = td.s.get(Session, sessionid)
-        if not session:
-            raise XeroError(f"Session {sessionid} does not exist")
-        if not session.endtime:
-            raise XeroError(f"Session {sessionid} is still open")
-        if not session.actual_totals:
-            raise XeroError(f"Session {sessionid} has no totals recorded")
-
-        payments = Element("Payments")
+        payments = []
         for total in session.actual_totals:
             if total.payment_amount == zero:
                 continue
@@ -628,38 +739,21 @@ class XeroIntegration:
             account = total.paytype.payments_account
             date = dp(session.date)
             ref = f"{total.paytype} takings"
-            p = SubElement(payments, "Payment")
+            p = Element("Payment")
             SubElement(p, "Invoice").append(_textelem("InvoiceID", invoice))
             SubElement(p, "Account").append(_textelem("Code", account))
             p.append(_textelem("Date", date.isoformat()))
             p.append(_textelem("Amount", str(total.payment_amount)))
             p.append(_textelem("Reference", ref))
+            payments.append(p)
+        return payments
 
-        xml = tostring(payments)
-        r = self.xero_session().put(
-            XERO_ENDPOINT_URL + "Payments/", data={'xml': xml})
-        if r.status_code == 400:
-            root = fromstring(r.text)
-            messages = [e.text for e in root.findall(".//Message")]
-            raise XeroError("Xero rejected payments: {}".format(
-                ", ".join(messages)))
-        if r.status_code != 200:
-            raise XeroError(f"Received {r.status_code} response")
-        root = fromstring(r.text)
-        if root.tag != "Response":
-            raise XeroError(
-                f"Response root tag '{root.tag}' was not 'Response'")
-
-    def _create_bill_for_delivery(self, deliveryid):
-        d = td.s.get(Delivery, deliveryid)
-        if not d:
-            raise XeroError(f"Delivery {deliveryid} does not exist")
-        if not d.supplier.accinfo:
-            raise XeroError(f"Supplier {d.supplier.name} is not linked to "
-                            "a Xero contact")
+    def _bill_for_delivery(self, d):
+        """Build the bill for a delivery
 
-        invoices = Element("Invoices")
-        inv = SubElement(invoices, "Invoice")
+        Returns an Invoice element.
+        """
+        inv = Element("Invoice")
         inv.append(_textelem("Type", "ACCPAY"))
         contact = SubElement(inv, "Contact")
         contact.append(_textelem("ContactID", d.supplier.accinfo))
@@ -700,29 +794,328 @@ class XeroIntegration:
             if tracking:
                 li.append(tracking)
             previtem = item
+        return inv
 
-        xml = tostring(invoices)
-        r = self.xero_session().put(
-            XERO_ENDPOINT_URL + "Invoices/", data={'xml': xml})
+    def _put(self, path, elements, what, idempotency_key=None,
+             summarize_errors=True):
+        """Send a list of elements to Xero
+
+        The elements are sent together in a single request, inside an
+        element named after path, eg. "Invoices".  If summarize_errors
+        is False, Xero deals with each element separately: problems
+        with individual elements are reported in the response instead
+        of the whole request being rejected.
+
+        Returns the root element of the response.  Raises
+        XeroUnavailable for problems that are worth trying again
+        later, and XeroError for other problems.
+        """
+        container = Element(path)
+        container.extend(elements)
+        headers = {}
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        params = {}
+        if not summarize_errors:
+            params['summarizeErrors'] = "false"
+        try:
+            r = self.xero_session().put(
+                self.endpoint_url + path + "/", params=params,
+                headers=headers, data={'xml': tostring(container)},
+                timeout=self.request_timeout)
+        except (requests.RequestException, InvalidGrantError) as e:
+            raise XeroUnavailable(f"Could not reach Xero: {e}")
+        if r.status_code == 429:
+            try:
+                retry_after = int(r.headers.get('Retry-After', 60))
+            except ValueError:
+                retry_after = 60
+            raise XeroRateLimited(retry_after)
+        if r.status_code >= 500:
+            raise XeroUnavailable(f"Received {r.status_code} response")
         if r.status_code == 400:
             root = fromstring(r.text)
             messages = [e.text for e in root.findall(".//Message")]
-            raise XeroError("Xero rejected invoice: {}".format(
-                ", ".join(messages)))
+            raise XeroError("Xero rejected {}: {}".format(
+                what, ", ".join(messages)))
         if r.status_code != 200:
             raise XeroError(f"Received {r.status_code} response")
         root = fromstring(r.text)
         if root.tag != "Response":
             raise XeroError(
                 f"Response root tag '{root.tag}' was not 'Response'")
-        i = root.find("./Invoices/Invoice")
-        if not i:
-            raise XeroError("Response did not contain invoice details")
-        invid = _fieldtext(i, "InvoiceID")
-        if not invid:
-            raise XeroError("No invoice ID was returned")
-        # warnings = [w.text for w in i.findall("./Warnings/Warning/Message")]
-        return invid
+        return root
+
+    def _create_invoice_for_session(self, sessionid, approve=False):
+        """Create an invoice for a session
+
+        Returns the invoice's GUID, and whether any negative payment
+        method totals were added to the invoice.  Does not check
+        whether the invoice has already been created, or record the
+        GUID against the session.
+        """
+        session = self._check_session(sessionid)
+        inv, negative_totals = self._invoice_for_session(session, approve)
+        root = self._put("Invoices", [inv], "invoice")
+        return _invoice_id(root.find("./Invoices/Invoice")), negative_totals
+
+    def _add_payments_for_session(self, sessionid, invoice):
+        """Add payments for a session to an existing invoice
+
+        The invoice is specified by its Xero InvoiceID.  It must be
+        Approved, otherwise adding payments will fail.  This call does
+        not check the invoice state, or whether payments have already
+        been added.
+        """
+        session = self._check_session(sessionid)
+        self._put("Payments", self._payments_for_session(session, invoice),
+                  "payments")
+
+    def _create_bill_for_delivery(self, deliveryid):
+        d = self._check_delivery(deliveryid)
+        root = self._put("Invoices", [self._bill_for_delivery(d)], "invoice")
+        return _invoice_id(root.find("./Invoices/Invoice"))
+
+    # The export queue: invoices and payments for sessions and bills
+    # for deliveries are queued in the accounts_export_queue table,
+    # and sent by export_queued().  This is called in a worker thread
+    # by XeroExportWorker, and by the "xero-export" command.
+
+    def queue_session(self, sessionid, approve):
+        """Queue the invoice for a session
+
+        If the invoice is approved when it is created, the payments
+        for the session are queued to be added to it.
+        """
+        td.s.add(AccountsExport(
+            kind='invoice', sessionid=sessionid, approve=approve))
+
+    def queue_delivery(self, deliveryid):
+        """Queue a bill for a delivery
+        """
+        td.s.add(AccountsExport(kind='bill', deliveryid=deliveryid))
+
+    def export_queued(self):
+        """Send the work in the export queue that is due
+
+        Work is sent a batch at a time: up to export_batch_size rows
+        of the same kind are sent to Xero in a single request, and
+        the results are committed once Xero has replied.  Rows that
+        another till is sending at the moment are skipped.  Must be
+        called in a database session.
+
+        Returns an ExportResult.
+        """
+        result = ExportResult()
+        while True:
+            rows = self._claim_batch()
+            if not rows:
+                break
+            ids = [row.id for row in rows]
+            try:
+                self._export_batch(rows, result)
+            except XeroRateLimited as e:
+                td.s.rollback()
+                result.problem = str(e)
+                result.rate_limited = True
+                result.retry_in = e.retry_after
+                return result
+            except XeroUnavailable as e:
+                td.s.rollback()
+                result.problem = str(e)
+                self._postpone(ids, str(e), result)
+                td.s.commit()
+                break
+            except XeroError as e:
+                # Xero rejected the whole request
+                td.s.rollback()
+                for row in td.s.query(AccountsExport)\
+                               .filter(AccountsExport.id.in_(ids))\
+                               .all():
+                    self._export_failed(row, str(e), result)
+            td.s.commit()
+        result.retry_in = self._next_due_in()
+        return result
+
+    def _claim_batch(self):
+        """Lock the next batch of work in the export queue
+
+        A batch that has been sent before is sent again with exactly
+        the same rows.  Otherwise a new batch is made from the oldest
+        row that is due and the rows of the same kind that are due
+        after it, and recorded before it is sent.
+        """
+        earlier = aliased(AccountsExport)
+        while True:
+            # Only the first row of a batch is considered, so that a
+            # batch that is locked by another till is skipped as a
+            # whole
+            first = td.s.query(AccountsExport)\
+                        .filter(AccountsExport.due())\
+                        .filter(~select(earlier.id)
+                                .where(earlier.batch == AccountsExport.batch,
+                                       earlier.id < AccountsExport.id,
+                                       earlier.failed == False)
+                                .exists())\
+                        .order_by(AccountsExport.id)\
+                        .with_for_update(skip_locked=True)\
+                        .first()
+            if not first:
+                return []
+            if first.batch:
+                break
+            batch = secrets.token_hex(16)
+            for row in td.s.query(AccountsExport)\
+                           .filter(AccountsExport.due())\
+                           .filter(AccountsExport.kind == first.kind)\
+                           .filter(AccountsExport.batch == None)\
+                           .order_by(AccountsExport.id)\
+                           .with_for_update(skip_locked=True)\
+                           .limit(self.export_batch_size())\
+                           .all():
+                row.batch = batch
+            # Committing releases the locks; the batch is claimed
+            # again on the next time round
+            td.s.commit()
+        return td.s.query(AccountsExport)\
+                   .filter(AccountsExport.batch == first.batch)\
+                   .filter(AccountsExport.failed == False)\
+                   .order_by(AccountsExport.id)\
+                   .with_for_update()\
+                   .all()
+
+    def _elements_for_export(self, row):
+        """Build the elements to send to Xero for a row
+
+        Returns an empty list if there is nothing to send.
+        """
+        if row.kind == 'invoice':
+            session = self._check_session(row.sessionid)
+            if session.accinfo:
+                # Already sent
+                return []
+            inv, _ = self._invoice_for_session(session, row.approve)
+            return [inv]
+        if row.kind == 'payments':
+            session = self._check_session(row.sessionid)
+            if not session.accinfo:
+                raise XeroError(f"Session {session.id} has no invoice")
+            return self._payments_for_session(session, session.accinfo)
+        if row.kind == 'bill':
+            return [self._bill_for_delivery(
+                self._check_delivery(row.deliveryid))]
+        raise XeroError(f"Unknown kind of export '{row.kind}'")
+
+    @staticmethod
+    def _idempotency_key(rows):
+        """Key that is the same each time a batch is sent
+
+        If the reply to a batch is lost, the batch is sent again
+        later.  Xero recognises the key and repeats its reply instead
+        of creating the invoices a second time.  Trying failed work
+        again by hand puts it in a new batch, with a new key.
+        """
+        h = hashlib.sha256()
+        h.update(f"{rows[0].batch}\n".encode())
+        for row in rows:
+            h.update(f"{row.id}\n".encode())
+        return h.hexdigest()
+
+    def _export_batch(self, rows, result):
+        """Send a batch of rows of the same kind in a single request
+        """
+        batch = []
+        for row in rows:
+            try:
+                elements = self._elements_for_export(row)
+            except XeroError as e:
+                self._export_failed(row, str(e), result)
+                continue
+            if not elements:
+                td.s.delete(row)
+                continue
+            batch.append((row, elements))
+        if not batch:
+            return
+        path = "Payments" if rows[0].kind == 'payments' else "Invoices"
+        root = self._put(
+            path, [e for row, elements in batch for e in elements],
+            path.lower(),
+            idempotency_key=self._idempotency_key([row for row, _ in batch]),
+            summarize_errors=False)
+        # Xero replies with an element for each element sent, in the
+        # same order
+        replies = root.findall(f"./{path}/{path[:-1]}")
+        if len(replies) != sum(len(elements) for _, elements in batch):
+            raise XeroUnavailable(
+                f"Xero replied with {len(replies)} {path.lower()} instead "
+                f"of {sum(len(elements) for _, elements in batch)}")
+        for row, elements in batch:
+            mine = replies[:len(elements)]
+            del replies[:len(elements)]
+            errors = [m.text for reply in mine
+                      for m in reply.findall(".//ValidationError/Message")]
+            if errors or any(reply.get("status") == "ERROR"
+                             for reply in mine):
+                self._export_failed(
+                    row, "Xero rejected {}: {}".format(
+                        row, ", ".join(errors) or "no reason given"),
+                    result)
+                continue
+            try:
+                self._exported(row, mine)
+            except XeroError as e:
+                self._export_failed(row, str(e), result)
+                continue
+            result.sent.append(str(row))
+
+    def _exported(self, row, replies):
+        """Record the result of sending a row, and remove it from the queue
+        """
+        if row.kind == 'invoice':
+            row.session.accinfo = _invoice_id(replies[0])
+            # Payments can only be added to approved invoices
+            if _fieldtext(replies[0], "Status") == "AUTHORISED":
+                td.s.add(AccountsExport(
+                    kind='payments', sessionid=row.sessionid))
+        elif row.kind == 'bill':
+            row.delivery.accinfo = _invoice_id(replies[0])
+        td.s.delete(row)
+
+    def _export_failed(self, row, error, result):
+        log.warning("Could not send %s to Xero: %s", row, error)
+        row.attempts += 1
+        row.failed = True
+        row.last_error = error
+        result.failed.append((str(row), error))
+
+    def _postpone(self, ids, error, result):
+        """Try rows again later, after Xero could not be reached
+        """
+        for row in td.s.query(AccountsExport)\
+                       .filter(AccountsExport.id.in_(ids))\
+                       .all():
+            row.attempts += 1
+            row.last_error = error
+            if row.attempts >= self.export_max_attempts:
+                self._export_failed(row, error, result)
+                continue
+            delay = min(self.export_min_delay * 2 ** (row.attempts - 1),
+                        self.export_max_delay)
+            row.next_attempt = func.current_timestamp() \
+                + datetime.timedelta(seconds=delay)
+
+    def _next_due_in(self):
+        """Number of seconds until queued work is due, or None
+        """
+        wait = td.s.execute(
+            select(func.min(AccountsExport.next_attempt)
+                   - func.current_timestamp())
+            .where(AccountsExport.failed == False)).scalar()
+        if wait is None:
+            return
+        # Work that is already due is being sent by another till
+        return max(wait.total_seconds(), self.export_min_delay)
 
     def _send_delivery(self, deliveryid):
         d = td.s.get(Delivery, deliveryid)
@@ -732,19 +1125,77 @@ class XeroIntegration:
                  f"{d.supplier.name} is not linked to a Xero contact."],
                 title="Error")
             return
-        with ui.exception_guard("sending bill for delivery to Xero"):
-            iid = self._create_bill_for_delivery(deliveryid)
-            d.accinfo = iid
-            td.s.flush()
-            ui.toast("Delivery sent to Xero as draft bill")
+        self.queue_delivery(deliveryid)
+        # The delivery must be committed before the worker thread can
+        # see it
+        td.s.commit()
+        ui.toast("Sending delivery to Xero as a draft bill...")
+        self.export_worker.kick()
+
+    def _export_queue_menu(self):
+        rows = td.s.query(AccountsExport).order_by(AccountsExport.id).all()
+        if not rows:
+            ui.infopopup(["There is nothing waiting to be sent to Xero."],
+                         title="Xero export queue", colour=ui.colour_info,
+                         dismiss=keyboard.K_CASH)
+            return
+        f = ui.tableformatter(' l l r l ')
+        header = f("Queued", "Work", "Attempts", "Status")
+        lines = [("Try everything again now", self._retry_export, (None,))]
+        lines.extend(
+            (f(f"{r.queued:%Y-%m-%d %H:%M}", str(r), r.attempts,
+               "Failed" if r.failed else f"Next try {r.next_attempt:%H:%M}"),
+             self._export_row_menu, (r.id,))
+            for r in rows)
+        ui.menu(lines, title="Xero export queue",
+                blurb=["Choose an item to try it again or remove it "
+                       "from the queue.", header])
+
+    def _export_row_menu(self, rowid):
+        row = td.s.get(AccountsExport, rowid)
+        if not row:
+            ui.toast("That item has already been sent.")
+            return
+        ui.keymenu(
+            [("1", "Try again now", self._retry_export, (rowid,)),
+             ("2", "Remove from the queue", self._remove_export, (rowid,))],
+            blurb=row.last_error or [], title=str(row).capitalize())
+
+    def _retry_export(self, rowid):
+        """Queue failed work again, and send it now
+
+        If rowid is None, all the work in the queue is retried.
+        """
+        q = td.s.query(AccountsExport)
+        if rowid:
+            q = q.filter(AccountsExport.id == rowid)
+        for row in q.all():
+            if row.failed:
+                row.batch = None
+            row.failed = False
+            row.attempts = 0
+            row.last_error = None
+            row.queued = func.current_timestamp()
+            row.next_attempt = func.current_timestamp()
+        td.s.commit()
+        ui.toast("Sending to Xero...")
+        self.export_worker.kick()
+
+    def _remove_export(self, rowid):
+        row = td.s.get(AccountsExport, rowid)
+        if row:
+            log.info("Removing %s from the Xero export queue", row)
+            td.s.delete(row)
+            ui.toast(f"{str(row).capitalize()} will not be sent to Xero.")
 
     def _link_supplier_with_contact(self, supplierid):
         s = td.s.get(Supplier, supplierid)
         # Fetch possible contacts
         w = f"Name.ToLower().Contains(\"{s.name.lower()}\")"
         r = self.xero_session().get(
-            XERO_ENDPOINT_URL + "Contacts/", params={
-                "where": w, "order": "Name"})
+            self.endpoint_url + "Contacts/", params={
+                "where": w, "order": "Name"},
+            timeout=self.request_timeout)
         if r.status_code != 200:
             ui.infopopup([f"Failed to retrieve contacts from Xero: "
                           f"error code {r.status_code}"],
@@ -808,7 +1259,8 @@ class XeroIntegration:
         if not self.connection_ok():
             xero_not_connected()
             return True
-        r = self.xero_session().get(XERO_ENDPOINT_URL + "Organisation/")
+        r = self.xero_session().get(self.endpoint_url + "Organisation/",
+                                    timeout=self.request_timeout)
         if r.status_code != 200:
             ui.infopopup([f"Failed to retrieve organisation details from Xero: "
                           f"error code {r.status_code}"],
@@ -881,6 +1333,15 @@ def _fieldtext(c, field):
     return f.text
 
 
+def _invoice_id(i):
+    if i is None:
+        raise XeroError("Response did not contain invoice details")
+    invid = _fieldtext(i, "InvoiceID")
+    if not invid:
+        raise XeroError("No invoice ID was returned")
+    return invid
+
+
 def choose_supplier(cont, link_only):
     q = td.s.query(Supplier).order_by(Supplier.name)
     if link_only:
@@ -938,7 +1399,7 @@ class connect(cmdline.command):
             print("The Xero integration does not have a secret store "
                   "configured.")
             return 1
-        session = i.xero_session(omit_tenant=True)
+        session = i.xero_session(omit_tenant=True, with_token=False)
         auth_url, state = session.authorization_url(XERO_AUTHORIZE_URL)
         print(f"Visit this page in your browser:\n{auth_url}\n")
         auth_response = input("After authorising, paste the URL provided "
@@ -958,7 +1419,7 @@ class connect(cmdline.command):
             return 1
 
         # Fetch the list of tenants
-        r = session.get(XERO_CONNECTIONS_URL)
+        r = session.get(XERO_CONNECTIONS_URL, timeout=i.request_timeout)
         if r.status_code != 200:
             print("Failed to get the list of Xero tenants")
             r.raise_for_status()
@@ -972,3 +1433,55 @@ class connect(cmdline.command):
         print(f"Set the appropriate tenant ID using the {i.tenant_id.key} "
               "configuration key")
         i.secrets.store('token', json.dumps(token), create=True)
+
+
+class export(cmdline.command):
+    """Send work waiting in the Xero export queue.
+
+    Sessions and deliveries can be queued first: this is useful for
+    sending a number of past sessions.  Sessions whose invoice has
+    already been sent are skipped.  Work that has failed is not
+    tried again; use the Xero options menu on the till for that.
+    """
+    command = "xero-export"
+    help = "send queued invoices, payments and bills to Xero"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument(
+            "-s", "--session", type=int, nargs="+", action="extend",
+            default=[], metavar="SESSIONID",
+            help="queue the invoice for a session")
+        parser.add_argument(
+            "-d", "--delivery", type=int, nargs="+", action="extend",
+            default=[], metavar="DELIVERYID",
+            help="queue the bill for a delivery")
+
+    @staticmethod
+    def run(args):
+        if len(XeroIntegration._integrations) != 1:
+            print("The Xero integration is not configured.")
+            return 1
+        i = XeroIntegration._integrations[0]
+        with td.orm_session():
+            for sessionid in args.session:
+                i.queue_session(sessionid, i.auto_approve_invoice())
+            for deliveryid in args.delivery:
+                i.queue_delivery(deliveryid)
+            td.s.commit()
+            while True:
+                result = i.export_queued()
+                for what in result.sent:
+                    print(f"Sent {what}")
+                for what, error in result.failed:
+                    print(f"Failed to send {what}: {error}")
+                if not result.rate_limited:
+                    break
+                print(f"Rate limited by Xero; waiting {result.retry_in} "
+                      f"seconds")
+                time.sleep(result.retry_in)
+        if result.problem:
+            print(f"Couldn't send to Xero: {result.problem}")
+        if result.retry_in is not None:
+            print("Some work is still waiting to be sent.")
+        return 1 if result.failed or result.problem else 0